@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Script to compute the bathymetry of many reaches, possibly under several discharges
+# The reaches are read from csv, Parquet or Arrow files, or from .npy column bundles (see BasicColumnIO), with the same
+# fields as in Basic_bathy_main.py (dist, z_ws, width, Q): either all the reaches of a folder, or the reaches listed in a
+# manifest (csv file with a 'path' column, the paths being relative to the manifest). Only these four fields are read.
+# Every (reach, discharge) pair is processed independently on a pool of processes. A failure on one reach is recorded in
+# the summary table but does not stop the batch.
+# With a cache folder, the results of the smoothing and of the bathymetry assessment are stored on disk and reused when a
+# reach is processed again with the same inputs and parameters (see BasicStageCache).
+
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from BasicWSSmoothing import *
+from BasicBedAssessment import *
+from BasicRiverDataStructure import *
+from BasicInstrumentation import instrumented_run
+from BasicColumnIO import INPUT_FIELDS, ReachWriter, is_reach_path, read_columns, write_columns
+from BasicStageCache import StageCache, cached_WSsmoothing, cached_BedAssessment
+
+OUTPUT_FIELDS = ["dist", "z_ws", "ztosmooth", "z_smoothed", "z", "Fr", "ws_validation"]
+
+
+def list_reaches(input_path):
+    # Return the list of reach files to process, from a folder or from a manifest file
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, file) for file in os.listdir(input_path)
+                      if is_reach_path(os.path.join(input_path, file)))
+    manifest = pd.read_csv(input_path)
+    folder = os.path.dirname(os.path.abspath(input_path))
+    return [os.path.join(folder, path) for path in manifest['path']]
+
+
+def read_reach(path):
+    # Read the input fields of a reach, as a dictionary of arrays
+    return read_columns(path, INPUT_FIELDS)
+
+
+def execute_pipeline(df_data, manning, min_slope, epsilon, smoothing_params=None, cache=None):
+    # Full processing of one reach, as in Basic_bathy_main.py: water surface smoothing, bathymetry assessment,
+    # Ramer-Douglas-Peucker reduction and validation. Return the full and the reduced data browsers.
+    # df_data is a pandas dataframe or a dictionary of arrays (see read_reach).
+    # If cache (StageCache) is provided, the smoothing and bathymetry assessment results are read from it if available.
+    if isinstance(df_data, pd.DataFrame):
+        data = Databrowser(df_data)
+    else:
+        data = Databrowser.from_columns(df_data)
+    cached_WSsmoothing(data, cache, **(smoothing_params or {}))
+    cached_BedAssessment(data, manning, min_slope, cache)
+    data_reduced = data.reduce_bedpoints_RDP(epsilon)
+    execute_SimpleHydro(data_reduced, manning, data_reduced.get_first_point().s)
+    return data, data_reduced
+
+
+def _output_name(path, q_factor, output_format):
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    name = "{}_Q{:g}_bed".format(name, q_factor)
+    return name if output_format == "npy" else name + "." + output_format
+
+
+def _process_task(path, q_factor, output_folder, params):
+    # Process one reach under one discharge and return its line of the summary table, along with the metrics of the
+    # run (see BasicInstrumentation)
+    summary = {"reach": path, "q_factor": q_factor, "status": "ok", "nb_points": None, "nb_added_points": None,
+               "nb_reduced_points": None, "output": None, "runtime": None, "error": None}
+    start = time.perf_counter()
+    with instrumented_run("{} Q x{:g}".format(path, q_factor)) as report:
+        _run_task(path, q_factor, output_folder, params, summary)
+    summary["runtime"] = time.perf_counter() - start
+    summary["metrics"] = report.to_dict()
+    return summary
+
+
+def _run_task(path, q_factor, output_folder, params, summary):
+    try:
+        columns = read_reach(path)
+        summary["nb_points"] = len(columns['dist'])
+        columns['Q'] = columns['Q'] * q_factor
+        params = dict(params)
+        output_format = params.pop("output_format")
+        combined = params.pop("combined_output")
+        data, data_reduced = execute_pipeline(columns, **params)
+        summary["nb_added_points"] = data.get_nb_added_points()
+        summary["nb_reduced_points"] = len(data_reduced)
+        if combined:
+            # The bed profile is returned to the main process, which writes it in the combined output
+            summary["columns"] = {field: data_reduced.get_column(field) for field in OUTPUT_FIELDS}
+            return
+        output = os.path.join(output_folder, _output_name(path, q_factor, output_format))
+        write_columns(output, data_reduced, OUTPUT_FIELDS)
+        summary["output"] = output
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+
+
+def _process_chunk(tasks, output_folder, params):
+    return [_process_task(path, q_factor, output_folder, params) for path, q_factor in tasks]
+
+
+def execute_batch(input_path, output_folder, manning=0.03, min_slope=0.00001, epsilon=0.1, q_factors=(1.,),
+                  smoothing_params=None, workers=None, chunksize=1, metrics_sink=None, cache_folder=None,
+                  cache_size=1e9, output_format="csv", combined_output=None):
+    # Process all the reaches of input_path (folder or manifest), for every discharge factor of q_factors (the
+    # discharge Q of the reach is multiplied by the factor). One bed profile is written per reach and discharge in
+    # output_folder, along with a summary table (summary.csv), which is also returned as a pandas dataframe.
+    # workers is the number of processes (default: number of CPUs), chunksize the number of tasks sent at once to a
+    # process.
+    # If metrics_sink (path of a json lines file) is provided, the metrics of every task are appended to it.
+    # If cache_folder is provided, the stage results are cached in it, up to cache_size bytes.
+    # The bed profiles are written as output_format files: csv, parquet, arrow or npy (column bundle). If combined_output
+    # (name of a csv or Parquet file) is provided, they are instead all written in this file, as the reaches are
+    # completed, with a 'reach' column (reach file name and discharge factor).
+    os.makedirs(output_folder, exist_ok=True)
+    cache = StageCache(cache_folder, cache_size) if cache_folder is not None else None
+    params = {"manning": manning, "min_slope": min_slope, "epsilon": epsilon, "smoothing_params": smoothing_params,
+              "cache": cache, "output_format": output_format, "combined_output": combined_output is not None}
+    tasks = [(path, q_factor) for path in list_reaches(input_path) for q_factor in q_factors]
+    chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+    summaries = []
+    writer = None
+    if combined_output is not None:
+        writer = ReachWriter(os.path.join(output_folder, combined_output), OUTPUT_FIELDS)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_process_chunk, chunk, output_folder, params): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # The worker process itself failed (e.g. killed): every task of the chunk is recorded as failed
+                for path, q_factor in futures[future]:
+                    summaries.append({"reach": path, "q_factor": q_factor, "status": "failed",
+                                      "error": "".join(traceback.format_exception_only(type(e), e)).strip()})
+                continue
+            for summary in results:
+                if "columns" in summary:
+                    writer.write(summary.pop("columns"), _output_name(summary["reach"], summary["q_factor"], "npy"))
+                    summary["output"] = writer.path
+                summaries.append(summary)
+
+    if writer is not None:
+        writer.close()
+
+    if metrics_sink is not None:
+        with open(metrics_sink, "a") as file:
+            for summary in summaries:
+                if "metrics" in summary:
+                    file.write(json.dumps(summary["metrics"]) + "\n")
+    for summary in summaries:
+        summary.pop("metrics", None)
+    df_summary = pd.DataFrame(summaries).sort_values(by=["reach", "q_factor"], ignore_index=True)
+    df_summary.to_csv(os.path.join(output_folder, "summary.csv"), index=False)
+    return df_summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Bathymetry assessment of a batch of reaches")
+    parser.add_argument("input", help="folder of reaches (csv, parquet, arrow files or npy column bundles), or "
+                                      "manifest file with a 'path' column")
+    parser.add_argument("output", help="output folder")
+    parser.add_argument("--manning", type=float, default=0.03)
+    parser.add_argument("--min_slope", type=float, default=0.00001)
+    parser.add_argument("--epsilon", type=float, default=0.1, help="tolerance of the RDP reduction (m)")
+    parser.add_argument("--q_factors", type=float, nargs="+", default=[1.], help="discharge scenarios, as factors of Q")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=1)
+    parser.add_argument("--metrics", default=None, help="json lines file where the metrics of every task are appended")
+    parser.add_argument("--cache", default=None, help="folder where the stage results are cached")
+    parser.add_argument("--output_format", default="csv", choices=["csv", "parquet", "arrow", "npy"])
+    parser.add_argument("--combined_output", default=None, help="csv or parquet file (in the output folder) where "
+                                                                "all the bed profiles are written")
+    parser.add_argument("--cache_size", type=float, default=1e9, help="maximum size of the cache (bytes)")
+    args = parser.parse_args()
+
+    df_summary = execute_batch(args.input, args.output, args.manning, args.min_slope, args.epsilon, args.q_factors,
+                               workers=args.workers, chunksize=args.chunksize, metrics_sink=args.metrics,
+                               cache_folder=args.cache, cache_size=args.cache_size, output_format=args.output_format,
+                               combined_output=args.combined_output)
+    print(df_summary["status"].value_counts().to_string())
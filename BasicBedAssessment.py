@@ -7,26 +7,63 @@
 # guenole.chone@concordia.ca
 #####################################################
 
+import numpy as np
 import pandas as pd
 from BasicSolverDirect import *
-
-
-
-def execute_BedAssessment(datapoints, manning, min_slope):
+import BasicHydroKernel
+from BasicInstrumentation import count, timed_stage
+from BasicRiverDataStructure import Section, rdp_significance
+
+
+
+@timed_stage
+def execute_BedAssessment(datapoints, manning, min_slope, kernel=False, max_refinement_depth=20, min_spacing=0.1,
+                          restart_from=None, upstream_slope=None):
+
+    # With kernel=True, the calculations are done on arrays by BasicHydroKernel (compiled if numba is installed),
+    # instead of cross-section by cross-section on the Databrowser objects
+    # Cross-sections are added where the Froude number varies too much (see __refined_inverse1Dhydro), until they are
+    # min_spacing apart, or until an interval between two original cross-sections has been split max_refinement_depth
+    # times.
+    # If restart_from (distance of one of the cross-sections) is provided, the cross-sections from restart_from
+    # upstream, including the added ones, are considered already solved: the calculations restart from there (this is
+    # only available without kernel).
+    # The upstream boundary level is computed with Manning's equation, using the water surface slope of the two last
+    # cross-sections, or upstream_slope if provided (e.g. the energy slope at the outlet of the upstream reach).
+    # The fields R, v, ycrit, h and Fr are not stored: they are derived from the flow depth y when read (see
+    # HYDRAULIC_FIELDS). Values stored by a previous computation, that would hide the derived ones, are deleted, but
+    # input fields with the same names are kept.
+    nb_added_points = datapoints.get_nb_added_points()
+    datapoints.remove_computed(HYDRAULIC_FIELDS)
+    if kernel and restart_from is not None:
+        raise ValueError("restart_from is not available with kernel=True")
+    if kernel:
+        __kernel_inverse1Dhydro(datapoints, manning, min_slope, max_refinement_depth, min_spacing, upstream_slope)
+        count("refinement_added_points", datapoints.get_nb_added_points() - nb_added_points)
+        return
 
     # Compute upstream boundary slope
     prev_cs = None
     lastpoint = datapoints.get_last_point()
     for cs in datapoints.browse_down_to_up():
-        if cs == lastpoint:
-            localdist = (cs.dist - prev_cs.dist)
-            cs.s = max(min_slope, (cs.z_smoothed-prev_cs.z_smoothed)/localdist)
+        if cs == lastpoint and restart_from is None:
+            if upstream_slope is not None:
+                cs.s = max(min_slope, upstream_slope)
+            else:
+                localdist = (cs.dist - prev_cs.dist)
+                cs.s = max(min_slope, (cs.z_smoothed-prev_cs.z_smoothed)/localdist)
         prev_cs = cs
 
     # 1D hydraulic calculations
+    # The added cross-sections are stored in the datapoints only at the end
+    newsections = []
     prev_cs = None
     for cs in datapoints.browse_up_to_down():
 
+        if restart_from is not None and cs.dist >= restart_from:
+            if cs.dist == restart_from and cs.type != 3:
+                prev_cs = cs # already solved, the calculations restart from this cross-section
+            continue
         cs.n = manning
         if prev_cs is None: # Compute upstream boundary level using Manning's equation only
             manning_inversesolver(cs)
@@ -35,46 +72,111 @@ def execute_BedAssessment(datapoints, manning, min_slope):
         else: # For any other point, use the regular inverse hydraulic solver
             cs.solver = "regular"
             cs.type = 1
-            __recursive_inverse1Dhydro(datapoints, cs, prev_cs, min_slope)
+            __refined_inverse1Dhydro(cs, prev_cs, min_slope, max_refinement_depth, min_spacing, newsections)
         prev_cs = cs
+    datapoints.insert_sections(newsections)
 
+    count("refinement_added_points", datapoints.get_nb_added_points() - nb_added_points)
     return
 
-def __recursive_inverse1Dhydro(datapoints, cs, prev_cs, min_slope):
+def __refined_inverse1Dhydro(cs, prev_cs, min_slope, max_depth, min_spacing, newsections):
     # This function apply the inverse hydraulic solver to computer bed elevation at the current cross-section (cs),
     # knowing the condition at the upstream cross-section (prev_cs)
-    # This is done recursively: if, after computing the flow at the cross-section, the Froude number appears to vary too
-    # much, the computed bed elevation is discarded and an additional cross-section is added in-between.
-
-    cs_inversesolver(prev_cs, cs, min_slope) # Solve the inverse 1D hydraulic problem
-
-    localdist = (prev_cs.dist - cs.dist)
-
-    # Adding a cross-section if the Froude number varies too much (increase by more than 50%)
-    if (cs.Fr - prev_cs.Fr) / prev_cs.Fr > 0.5 and localdist > 0.1: # Minimum 10cm between cs
-
-        newcs = datapoints.add_point((cs.dist + prev_cs.dist) / 2.) # Adding a point in the dataset at the right distance
-        newlocaldist = localdist / 2.
-        # Linear interpolation of width, discharge and water surface for the new point.
-        # Although more accurate spatialization could be done, this is deemed accurate enough
-        a = (cs.width - prev_cs.width) / (0-localdist)
-        newcs.width = a * newlocaldist + cs.width
-        a = (cs.Q - prev_cs.Q) / (0-localdist)
-        newcs.Q = a * newlocaldist + cs.Q
-        a = (cs.z_smoothed - prev_cs.z_smoothed) / (0-localdist)
-        newcs.z_smoothed = a* newlocaldist + cs.z_smoothed
-        newcs.n = cs.n
-        newcs.solver = "regular"
-        __recursive_inverse1Dhydro(datapoints, newcs, prev_cs, min_slope) # Compute the bed elevation at the new added cross-section
-        newcs.type = 3
-        __recursive_inverse1Dhydro(datapoints, cs, newcs, min_slope) # Compute the bed elevation at the downstream cross-section cs
+    # If, after computing the flow at the cross-section, the Froude number appears to vary too much, the computed bed
+    # elevation is discarded and an additional cross-section is added in-between. The cross-sections still to be solved
+    # are kept in a stack (the top one is solved from the last solved cross-section upstream), instead of recursive
+    # calls. The depth of a cross-section is the number of splits that created it.
+    # The added cross-sections are not stored in the datapoints, but appended to newsections.
+
+    stack = [(cs, 0)]
+    up_cs, up_depth = prev_cs, 0
+    while stack:
+        cs, depth = stack[-1]
+        cs_inversesolver(up_cs, cs, min_slope) # Solve the inverse 1D hydraulic problem
+
+        localdist = (up_cs.dist - cs.dist)
+
+        # Adding a cross-section if the Froude number varies too much (increase by more than 50%)
+        if (cs.Fr - up_cs.Fr) / up_cs.Fr > 0.5 and localdist > min_spacing and max(depth, up_depth) < max_depth:
+
+            newcs = Section()
+            newcs.dist = (cs.dist + up_cs.dist) / 2. # Adding a point at the right distance
+            newlocaldist = localdist / 2.
+            # Linear interpolation of width, discharge and water surface for the new point.
+            # Although more accurate spatialization could be done, this is deemed accurate enough
+            a = (cs.width - up_cs.width) / (0-localdist)
+            newcs.width = a * newlocaldist + cs.width
+            a = (cs.Q - up_cs.Q) / (0-localdist)
+            newcs.Q = a * newlocaldist + cs.Q
+            a = (cs.z_smoothed - up_cs.z_smoothed) / (0-localdist)
+            newcs.z_smoothed = a* newlocaldist + cs.z_smoothed
+            newcs.n = cs.n
+            newcs.solver = "regular"
+            newcs.type = 3
+            newsections.append(newcs)
+            stack.append((newcs, max(depth, up_depth) + 1)) # the new cross-section is solved first, then cs from it
+        else:
+            stack.pop()
+            up_cs, up_depth = cs, depth
 
     return
 
+def __kernel_inverse1Dhydro(datapoints, manning, min_slope, max_depth, min_spacing, upstream_slope):
+    # Apply the array version of the inverse 1D hydraulic calculations and store the results in the datapoints,
+    # including the added cross-sections
+    results = BasicHydroKernel.inverse1Dhydro_march(datapoints.get_column('dist'), datapoints.get_column('z_smoothed'),
+                                                    datapoints.get_column('width'), datapoints.get_column('Q'),
+                                                    manning, min_slope, max_depth=max_depth, min_spacing=min_spacing,
+                                                    upstream_slope=upstream_slope)
+    added = results['type'] == 3
+    datapoints.add_points(results['dist'][added])
+    for field, values in results.items():
+        if field in HYDRAULIC_FIELDS:
+            continue # derived from y
+        if field == 'solver':
+            values = BasicHydroKernel.SOLVER_FLAGS[values.astype(int)]
+        datapoints.set_column(field, values)
+    count("manning_solver_calls")
+    solved = ~np.isnan(results['nfev'])
+    count("cs_inversesolver_calls", int(np.sum(solved)))
+    count("cs_inversesolver_evals", int(np.sum(results['nfev'][solved])))
+    count("cs_inversesolver_not_converged", int(np.sum(results['converged'][solved] == 0)))
+    return
 
 
+
+@timed_stage
+def execute_BedAssessmentEnsemble(datapoints, scenarios, min_spacing=0.1):
+
+    # Bathymetry assessment for many scenarios on the same smoothed water surface (e.g. for sensitivity studies), without
+    # modifying the datapoints. scenarios is a list of (Q factor, Manning's coefficient, minimum slope) tuples, or a
+    # pandas dataframe with the columns q_scale, manning and min_slope.
+    # All the scenarios are solved together (see BasicHydroKernel.inverse1Dhydro_ensemble). No cross-section is added:
+    # the 'refine' results flag where execute_BedAssessment would add some.
+    # Return a dictionary with the distances ('dist'), the scenarios ('scenarios', as a dataframe) and, for every field
+    # of BasicHydroKernel.ENSEMBLE_FIELDS, an array shaped (number of points, number of scenarios). The 'solver' codes
+    # are the indexes of the flags in BasicHydroKernel.SOLVER_FLAGS.
+    if not isinstance(scenarios, pd.DataFrame):
+        scenarios = pd.DataFrame(list(scenarios), columns=['q_scale', 'manning', 'min_slope'])
+    results = BasicHydroKernel.inverse1Dhydro_ensemble(datapoints.get_column('dist'),
+                                                       datapoints.get_column('z_smoothed'),
+                                                       datapoints.get_column('width'), datapoints.get_column('Q'),
+                                                       scenarios['q_scale'].to_numpy(), scenarios['manning'].to_numpy(),
+                                                       scenarios['min_slope'].to_numpy(), min_spacing=min_spacing)
+    count("ensemble_scenarios", len(scenarios))
+    count("cs_inversesolver_evals", int(np.nansum(results['nfev'])))
+    count("ensemble_refine_flags", int(np.sum(results['refine'] == 1)))
+    results['dist'] = np.array(datapoints.get_column('dist'))
+    results['scenarios'] = scenarios.reset_index(drop=True)
+    return results
+
+
+@timed_stage
 def execute_SimpleHydro(datapoints, manning, down_slope):
 
+    # The fields R_validation, v_validation, ycrit_validation, h_validation and Fr_validation are derived from the flow
+    # depth y_validation when read (see VALIDATION_FIELDS)
+    datapoints.remove_computed(VALIDATION_FIELDS)
 
     # Set downstream boundary slope
     firstpoint = datapoints.get_first_point()
@@ -99,5 +201,44 @@ def execute_SimpleHydro(datapoints, manning, down_slope):
     return
 
 
-
-
+@timed_stage
+def execute_SimpleHydroSweep(datapoints, manning, down_slope, epsilons, xtol=1e-6):
+
+    # Reduction of the bed profile (Ramer-Douglas-Peucker) and validation (as execute_SimpleHydro) for several
+    # tolerances at once, to choose the tolerance, without modifying the datapoints. The attribute 'z' is required.
+    # The reduced profiles of all the tolerances come from a single pass of the RDP algorithm (see rdp_significance),
+    # and their validation water surfaces are computed together (see BasicHydroKernel.normal1Dhydro_batch).
+    # The validation water surface of each reduced profile is interpolated at the points with a measured water surface
+    # (z_ws) and compared with it. Return a pandas dataframe with one row per tolerance: the number of points of the
+    # reduced profile, the number of points where the solver did not converge, and the errors (ws_validation - z_ws):
+    # mean (bias), mean absolute, root mean square and maximum absolute error.
+    epsilons = np.atleast_1d(np.asarray(epsilons, dtype=float))
+    dist = datapoints.get_column('dist')
+    z_ws = datapoints.get_column('z_ws')
+    significance = rdp_significance(dist, datapoints.get_column('z'), min_epsilon=epsilons.min())
+    selections = [np.flatnonzero(significance > epsilon) for epsilon in epsilons]
+
+    # Profiles padded with NaN, one column per tolerance
+    npts = max(len(selection) for selection in selections)
+    columns = {}
+    for field in ('dist', 'z', 'width', 'Q'):
+        values = datapoints.get_column(field)
+        columns[field] = np.full((npts, len(epsilons)), np.nan)
+        for j, selection in enumerate(selections):
+            columns[field][:len(selection), j] = values[selection]
+    results = BasicHydroKernel.normal1Dhydro_batch(columns['dist'], columns['z'], columns['width'], columns['Q'],
+                                                   manning, down_slope, xtol=xtol)
+    count("validation_profiles", len(epsilons))
+    count("cs_normalsolver_evals", int(np.nansum(results['nfev'])))
+
+    measured = ~np.isnan(z_ws)
+    metrics = []
+    for j, selection in enumerate(selections):
+        nb_points = len(selection)
+        ws_validation = np.interp(dist[measured], columns['dist'][:nb_points, j], results['ws'][:nb_points, j])
+        errors = ws_validation - z_ws[measured]
+        metrics.append({"epsilon": epsilons[j], "nb_points": nb_points,
+                        "nb_not_converged": int(np.sum(results['converged'][:nb_points, j] == 0)),
+                        "bias": np.mean(errors), "mae": np.mean(np.abs(errors)), "rmse": np.sqrt(np.mean(errors ** 2)),
+                        "max_error": np.max(np.abs(errors))})
+    return pd.DataFrame(metrics)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of the processing stages on synthetic river profiles
+# Every stage of Basic_bathy_main.py (quantile carving, water surface smoothing, bathymetry assessment, RDP reduction
+# and validation) is timed, and its peak memory is measured, for profiles of increasing size. The results are written
+# in a json file, so that they can be compared between commits.
+# The precision report compares the results of the compact storage mode (single precision and categorical columns, see
+# COMPACT_DTYPES) with the double precision reference.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from BasicQuantileRegression import QuantileCarving
+from BasicWSSmoothing import *
+from BasicBedAssessment import *
+from BasicRiverDataStructure import *
+
+
+def synthetic_profile(npts, spacing=10., slope=0.0005, noise=0.02, knickpoints=((0.45, 1.),), width=10.,
+                      width_variation=0.3, Q=1., Q_steps=(), seed=0):
+    # Create a synthetic river profile of npts points with the fields dist, z_ws, width and Q
+    # - spacing: average distance between the points (m), the actual distances being randomly jittered
+    # - slope: average water surface slope
+    # - noise: standard deviation of the noise added to the water surface elevation (m), as in LiDAR data
+    # - knickpoints: list of (relative position along the profile, height of the step in m), such as the step at
+    #   dist=110 of the test case of Basic_bathy_main.py
+    # - width: average river width (m), width_variation: relative amplitude of its variation along the profile
+    # - Q: discharge at the upstream end (m3/s), Q_steps: list of (relative position, discharge added downstream of
+    #   the position), e.g. for tributaries
+    rng = np.random.default_rng(seed)
+    dist = np.cumsum(spacing * rng.uniform(0.5, 1.5, npts))
+    dist -= dist[0]
+    length = max(dist[-1], spacing)
+    relative = dist / length
+    z_ws = 8.9 + slope * dist + rng.normal(0., noise, npts)
+    for position, height in knickpoints:
+        z_ws += height * (relative > position)
+    variation = np.sin(2 * np.pi * relative * max(1., length / 2000.)) + rng.normal(0., 0.3, npts)
+    widths = width * (1 + width_variation * np.clip(variation, -1., 1.))
+    discharges = np.full(npts, float(Q))
+    for position, added in Q_steps:
+        discharges += added * (relative <= position)
+    return pd.DataFrame({'dist': dist, 'z_ws': z_ws, 'width': widths, 'Q': discharges})
+
+
+STAGES = ["QuantileCarving", "execute_WSsmoothing", "execute_BedAssessment", "reduce_bedpoints_RDP",
+          "execute_SimpleHydro"]
+
+
+def _stage_functions(manning, min_slope, epsilon, kernel):
+    # Return the functions running each stage. Each function takes the state of the pipeline (a dictionary with the
+    # data browsers) and updates it.
+    def carving(state):
+        state['data'] = Databrowser(state['df'])
+        QuantileCarving(state['data'], 0.2)
+
+    def smoothing(state):
+        execute_WSsmoothing(state['data'])
+
+    def bedassessment(state):
+        execute_BedAssessment(state['data'], manning, min_slope, kernel=kernel)
+
+    def reduction(state):
+        state['reduced'] = state['data'].reduce_bedpoints_RDP(epsilon)
+
+    def validation(state):
+        execute_SimpleHydro(state['reduced'], manning, state['reduced'].get_first_point().s)
+
+    return dict(zip(STAGES, [carving, smoothing, bedassessment, reduction, validation]))
+
+
+def _run_pipeline(df, functions, stages, trace_memory):
+    # Run the stages in order and return, for each stage, its runtime (s) and peak memory (bytes, if traced)
+    # Note that execute_WSsmoothing includes its own quantile carving.
+    state = {'df': df}
+    measures = {}
+    for stage in stages:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        functions[stage](state)
+        runtime = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        measures[stage] = (runtime, peak)
+    return measures
+
+
+def _commit():
+    # Current git commit, if available
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def execute_benchmark(sizes=(100, 1000, 10000, 100000, 1000000), output="benchmark.json", repeat=1, memory=True,
+                      time_budget=600., manning=0.03, min_slope=0.00001, epsilon=0.1, kernel=False,
+                      profile_params=None):
+    # Benchmark the stages for every profile size and write the results in the output json file
+    # A stage taking more than time_budget seconds is not run for the larger sizes (nor are the following stages,
+    # which depend on it); these are recorded with the status "skipped".
+    # The runtime is the minimum over the repeats. The peak memory is measured in an additional run with tracemalloc
+    # (which slows down the computation), so that it does not affect the runtimes.
+    functions = _stage_functions(manning, min_slope, epsilon, kernel)
+    results = []
+    stages = list(STAGES)
+    for size in sizes:
+        df = synthetic_profile(size, **(profile_params or {}))
+        runtimes = {stage: [] for stage in stages}
+        for _ in range(repeat):
+            for stage, (runtime, _) in _run_pipeline(df, functions, stages, False).items():
+                runtimes[stage].append(runtime)
+        peaks = _run_pipeline(df, functions, stages, True) if memory else {}
+        for stage in STAGES:
+            record = {"size": size, "stage": stage, "status": "skipped", "runtime": None, "peak_memory": None}
+            if stage in stages:
+                record.update(status="ok", runtime=min(runtimes[stage]),
+                              peak_memory=peaks[stage][1] if memory else None)
+            results.append(record)
+            print("{size:>8} {stage:<22} {status:<8} {runtime}".format(**record))
+        too_slow = [i for i, stage in enumerate(stages) if min(runtimes[stage]) > time_budget]
+        if too_slow:
+            stages = stages[:too_slow[0]]
+
+    report = {
+        "commit": _commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "parameters": {"repeat": repeat, "manning": manning, "min_slope": min_slope, "epsilon": epsilon,
+                       "kernel": kernel, "profile": profile_params or {}},
+        "results": results,
+    }
+    with open(output, "w") as file:
+        json.dump(report, file, indent=1)
+    return pd.DataFrame(results)
+
+
+PRECISION_FIELDS = ["ztosmooth", "z_smoothed", "z", "Fr", "ws_validation"]
+
+
+def precision_report(sizes=(1000, 10000), dtypes=COMPACT_DTYPES, manning=0.03, min_slope=0.00001, epsilon=0.1,
+                     kernel=False, profile_params=None):
+    # Run the pipeline of Basic_bathy_main.py on synthetic profiles with the float64 reference storage and with the
+    # storage types dtypes, and compare the results
+    # The fields of PRECISION_FIELDS are compared on the original points (the added cross-sections and the points kept
+    # by the RDP reduction can differ between the two runs). Return a pandas dataframe with, for every size and field,
+    # the maximum and root mean square absolute differences, along with the memory used by the columns and the order
+    # of the rows of the full profile (bytes per point, see Databrowser.get_nbytes) and the numbers of added and
+    # reduced points of both runs.
+    records = []
+    for size in sizes:
+        df = synthetic_profile(size, **(profile_params or {}))
+        runs = {}
+        for mode, mode_dtypes in (("reference", None), ("compact", dtypes)):
+            data = Databrowser(df, dtypes=mode_dtypes)
+            execute_WSsmoothing(data)
+            execute_BedAssessment(data, manning, min_slope, kernel=kernel)
+            reduced = data.reduce_bedpoints_RDP(epsilon)
+            execute_SimpleHydro(reduced, manning, reduced.get_first_point().s)
+            original = np.array([value != 3 for value in data.get_column('type')])
+            values = {field: np.asarray(data.get_column(field)[original], dtype=float) for field in PRECISION_FIELDS
+                      if field != 'ws_validation'}
+            # The validation water surface is interpolated on the original points
+            values['ws_validation'] = np.interp(data.get_column('dist')[original], reduced.get_column('dist'),
+                                                np.asarray(reduced.get_column('ws_validation'), dtype=float))
+            runs[mode] = {"values": values, "nbytes": sum(data.get_nbytes().values()) / len(data),
+                          "added": data.get_nb_added_points(), "reduced": len(reduced)}
+        reference, compact = runs["reference"], runs["compact"]
+        for field in PRECISION_FIELDS:
+            differences = compact["values"][field] - reference["values"][field]
+            records.append({"size": size, "field": field, "max_abs_diff": np.nanmax(np.abs(differences)),
+                            "rms_diff": np.sqrt(np.nanmean(differences ** 2)),
+                            "bytes_per_point_reference": reference["nbytes"], "bytes_per_point_compact": compact["nbytes"],
+                            "added_points_reference": reference["added"], "added_points_compact": compact["added"],
+                            "reduced_points_reference": reference["reduced"], "reduced_points_compact": compact["reduced"]})
+    return pd.DataFrame(records)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the processing stages on synthetic profiles")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000, 1000000])
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--no_memory", action="store_true", help="do not measure the peak memory")
+    parser.add_argument("--time_budget", type=float, default=600., help="maximum runtime of a stage (s) before "
+                                                                         "skipping it for larger sizes")
+    parser.add_argument("--kernel", action="store_true", help="use the array kernel for the bathymetry assessment")
+    parser.add_argument("--noise", type=float, default=0.02)
+    parser.add_argument("--precision", action="store_true", help="compare the compact storage mode with the double "
+                                                                  "precision reference instead of timing the stages")
+    args = parser.parse_args()
+
+    if args.precision:
+        print(precision_report(args.sizes, kernel=args.kernel, profile_params={"noise": args.noise}).to_string())
+        raise SystemExit
+
+    execute_benchmark(args.sizes, args.output, args.repeat, not args.no_memory, args.time_budget,
+                      kernel=args.kernel, profile_params={"noise": args.noise})
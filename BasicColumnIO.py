@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Reading and writing of river profiles as columns
+# Supported formats (chosen from the path):
+# - csv files (.csv)
+# - Parquet files (.parquet) and Arrow IPC / Feather files (.arrow, .feather), which require pyarrow
+# - column bundles: a folder with one .npy file per field (e.g. dist.npy, z_ws.npy...). The files are memory-mapped
+#   in copy-on-write mode: the data is only read from the disk when used, and never written back.
+# Only the required fields are read (by default the four input fields of Basic_bathy_main.py). The columns are returned
+# as a dictionary of arrays, to be loaded with Databrowser.from_columns.
+#
+#     data = Databrowser.from_columns(read_columns("reach.parquet"))
+#     ...
+#     with ReachWriter("beds.parquet", ["dist", "z"]) as writer:
+#         writer.write(data, reach="reach")
+
+import numbers
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+INPUT_FIELDS = ['dist', 'z_ws', 'width', 'Q']
+
+
+def _require_pyarrow(path):
+    if pa is None:
+        raise ImportError("pyarrow is required to read or write " + path)
+
+
+def _format(path):
+    if os.path.isdir(path) or not os.path.splitext(path)[1]:
+        return 'npy'
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.csv', '.parquet', '.arrow', '.feather'):
+        return extension[1:].replace('feather', 'arrow')
+    raise ValueError("Unknown file format: " + path)
+
+
+def is_reach_path(path):
+    # True if the path is a reach in one of the supported formats
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, 'dist.npy'))
+    return os.path.splitext(path)[1].lower() in ('.csv', '.parquet', '.arrow', '.feather')
+
+
+def read_columns(path, fields=INPUT_FIELDS):
+    # Read the fields of a reach and return them as a dictionary of arrays
+    # Columns of a column bundle are returned as memory-mapped arrays.
+    fileformat = _format(path)
+    fields = list(fields)
+    if fileformat == 'npy':
+        return {field: np.load(os.path.join(path, field + '.npy'), mmap_mode='c') for field in fields}
+    if fileformat == 'csv':
+        df = pd.read_csv(path, usecols=fields)
+        return {field: df[field].to_numpy() for field in fields}
+    _require_pyarrow(path)
+    if fileformat == 'parquet':
+        table = pq.read_table(path, columns=fields)
+    else:
+        table = feather.read_table(path, columns=fields, memory_map=True)
+    return {field: table.column(field).to_numpy() for field in fields}
+
+
+def write_columns(path, columns, fields=None):
+    # Write a dictionary of arrays or a Databrowser (all the fields, or only the ones listed in fields) in one of the
+    # supported formats
+    columns = _as_columns(columns, fields)
+    fileformat = _format(path)
+    if fileformat == 'npy':
+        os.makedirs(path, exist_ok=True)
+        for field, values in columns.items():
+            np.save(os.path.join(path, field + '.npy'), _to_storable(values))
+    elif fileformat == 'csv':
+        pd.DataFrame(columns, copy=False).to_csv(path, index=False)
+    else:
+        _require_pyarrow(path)
+        table = pa.table({field: _to_storable(values) for field, values in columns.items()})
+        if fileformat == 'parquet':
+            pq.write_table(table, path)
+        else:
+            feather.write_feather(table, path)
+
+
+def _as_columns(columns, fields=None):
+    # Dictionary of arrays from a Databrowser or from a dictionary of arrays
+    if hasattr(columns, 'get_column'):
+        if fields is None:
+            fields = columns.get_fields(derived=True)
+        return {field: columns.get_column(field) if columns.has_field(field) else np.full(len(columns), np.nan)
+                for field in fields}
+    if fields is None:
+        return dict(columns)
+    return {field: columns[field] for field in fields}
+
+
+def _to_storable(values):
+    # Columns of objects (e.g. the solver flags) are stored as strings, and columns of numbers stored as objects (e.g.
+    # categorical fields, see Databrowser) as floats
+    values = np.asarray(values)
+    if values.dtype == object and _numbers_as_objects(values):
+        return _objects_to_float(values)
+    if values.dtype == object:
+        return np.array(["" if value is None else str(value) for value in values], dtype=str)
+    return values
+
+
+class ReachWriter():
+    # Output of the results of many reaches in a single csv or Parquet file, written reach by reach (the results of all
+    # the reaches are never held in memory at once). A 'reach' column identifies the reaches.
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = list(fields)
+        self._format = _format(path)
+        if self._format not in ('csv', 'parquet'):
+            raise ValueError("ReachWriter only writes csv or Parquet files: " + path)
+        if self._format == 'parquet':
+            _require_pyarrow(path)
+        self._writer = None
+        self._started = False
+
+    def write(self, data, reach):
+        # Append the fields of a reach (Databrowser or dictionary of arrays)
+        columns = _as_columns(data, self.fields)
+        npts = len(columns[self.fields[0]])
+        columns = dict({'reach': np.full(npts, str(reach))}, **{field: _to_storable(values)
+                                                                 for field, values in columns.items()})
+        if self._format == 'csv':
+            pd.DataFrame(columns, copy=False).to_csv(self.path, mode='a' if self._started else 'w',
+                                                     header=not self._started, index=False)
+        else:
+            table = pa.table(columns)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        self._started = True
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _numbers_as_objects(values):
+    # True if a column of objects only contains numbers (and missing values)
+    # Also used by BasicStageCache, to store such columns as floats (see _objects_to_float)
+    numbers_found = False
+    for value in values:
+        if value is not None:
+            if not isinstance(value, numbers.Number):
+                return False
+            numbers_found = True
+    return numbers_found
+
+
+def _objects_to_float(values):
+    # Column of numbers stored as objects as floats, the missing values being NaN
+    return np.array([np.nan if value is None else value for value in values], dtype=float)
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+# Array version of the inverse 1D hydraulic solver of BasicBedAssessment.py
+# The whole upstream to downstream march (including the addition of cross-sections when the Froude number varies too
+# much) is done on NumPy arrays, without any Databrowser object. If numba is installed, the march is compiled.
+# The object based version (execute_BedAssessment with kernel=False) remains the reference implementation: this version
+# reproduces the same operations, in the same order, with the same root finding algorithm (Brent's method as
+# implemented in scipy's brentq).
+# inverse1Dhydro_ensemble solves many scenarios (discharge, Manning's coefficient, minimum slope) at once, on arrays
+# shaped (number of points, number of scenarios).
+# normal1Dhydro_batch is the array version of the direct solver (execute_SimpleHydro), for many profiles at once.
+
+import math
+import numpy as np
+from BasicSolverDirect import manning_normaldepth
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        # numba is not available: the functions are run as regular python functions
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+g = 9.81
+
+# Columns of the array of cross-sections used by the march
+DIST, WIDTH, Q, Z_SMOOTHED, N, Y, Z, V, S, H, FR, YCRIT, R, SOLVER, TYPE, NFEV, CONVERGED, DEPTH = range(18)
+NB_FIELDS = 18
+FIELDS = ["dist", "width", "Q", "z_smoothed", "n", "y", "z", "v", "s", "h", "Fr", "ycrit", "R", "solver", "type",
+          "nfev", "converged"]
+SOLVER_FLAGS = np.array(["manning up", "regular", "min_slope"], dtype=object) # cs.solver values, coded 0, 1, 2
+ENSEMBLE_FIELDS = ["Q", "y", "z", "v", "s", "h", "Fr", "ycrit", "R", "solver", "nfev", "converged", "refine"]
+BATCH_FIELDS = ["y", "ws", "v", "s", "h", "Fr", "ycrit", "R", "nfev", "converged"]
+
+
+def inverse1Dhydro_march(dist, z_smoothed, width, discharge, n, min_slope, xtol=1e-6, max_depth=20, min_spacing=0.1,
+                         upstream_slope=None):
+    # Inverse 1D hydraulic calculations on arrays sorted by distance (from downstream to upstream), n being the
+    # Manning's coefficient (one value or one value per point).
+    # Cross-sections are added while the Froude number varies too much, until they are min_spacing apart or until
+    # max_depth splits of an interval between two original cross-sections.
+    # The upstream boundary slope is the water surface slope of the two last points, or upstream_slope if provided.
+    # Return a dictionary of arrays (one per field of FIELDS), sorted by distance, including the added cross-sections.
+    # The solver flags are coded as integers (see SOLVER_FLAGS).
+    npts = len(dist)
+    points = np.full((npts, NB_FIELDS), np.nan)
+    points[:, DIST] = dist
+    points[:, WIDTH] = width
+    points[:, Q] = discharge
+    points[:, Z_SMOOTHED] = z_smoothed
+    points[:, N] = n
+    points[:, DEPTH] = 0
+    upstream_slope = np.nan if upstream_slope is None else upstream_slope
+    points, count = _march(points, min_slope, xtol, max_depth, min_spacing, upstream_slope)
+    points = points[:count]
+    order = np.argsort(points[:, DIST], kind='stable') # added points are after the original ones at the same distance
+    return {field: points[order, i] for i, field in enumerate(FIELDS)} # the depth is only used by the march
+
+
+@njit(cache=True)
+def _march(points, min_slope, xtol, max_depth, min_spacing, upstream_slope):
+    # March from upstream to downstream on the array of cross-sections. Added cross-sections are appended at the end
+    # of the array. Return the array (possibly reallocated) and the number of cross-sections.
+    npts = points.shape[0]
+    count = npts
+
+    # Compute upstream boundary slope
+    last = npts - 1
+    if math.isnan(upstream_slope):
+        localdist = points[last, DIST] - points[last - 1, DIST]
+        points[last, S] = max(min_slope, (points[last, Z_SMOOTHED] - points[last - 1, Z_SMOOTHED]) / localdist)
+    else:
+        points[last, S] = max(min_slope, upstream_slope)
+
+    # Compute upstream boundary level using Manning's equation only
+    _manning_inverse(points, last)
+    points[last, SOLVER] = 0
+    points[last, TYPE] = 0
+
+    # The recursion of the object based version is replaced by a stack of the cross-sections to solve: the top of the
+    # stack is solved from the upstream cross-section; if the Froude number varies too much, a cross-section is added
+    # in-between and pushed on the stack.
+    stack = np.empty(16, dtype=np.int64)
+    up = last
+    for i in range(npts - 2, -1, -1):
+        points[i, SOLVER] = 1
+        points[i, TYPE] = 1
+        top = 0
+        stack[0] = i
+        while top >= 0:
+            cs = stack[top]
+            _cs_inverse(points, up, cs, min_slope, xtol)
+            localdist = points[up, DIST] - points[cs, DIST]
+            depth = max(points[cs, DEPTH], points[up, DEPTH])
+            if (points[cs, FR] - points[up, FR]) / points[up, FR] > 0.5 and localdist > min_spacing and depth < max_depth:
+                if count == points.shape[0]:
+                    points = _grow(points)
+                new = count
+                count += 1
+                newlocaldist = localdist / 2.
+                points[new, DIST] = (points[cs, DIST] + points[up, DIST]) / 2.
+                a = (points[cs, WIDTH] - points[up, WIDTH]) / (0 - localdist)
+                points[new, WIDTH] = a * newlocaldist + points[cs, WIDTH]
+                a = (points[cs, Q] - points[up, Q]) / (0 - localdist)
+                points[new, Q] = a * newlocaldist + points[cs, Q]
+                a = (points[cs, Z_SMOOTHED] - points[up, Z_SMOOTHED]) / (0 - localdist)
+                points[new, Z_SMOOTHED] = a * newlocaldist + points[cs, Z_SMOOTHED]
+                points[new, N] = points[cs, N]
+                points[new, SOLVER] = 1
+                points[new, TYPE] = 3
+                points[new, DEPTH] = depth + 1
+                top += 1
+                if top == stack.shape[0]:
+                    newstack = np.empty(2 * top, dtype=np.int64)
+                    newstack[:top] = stack
+                    stack = newstack
+                stack[top] = new
+            else:
+                top -= 1
+                up = cs
+    return points, count
+
+
+@njit(cache=True)
+def _grow(points):
+    newpoints = np.full((2 * points.shape[0], NB_FIELDS), np.nan)
+    newpoints[:points.shape[0]] = points
+    return newpoints
+
+
+@njit(cache=True)
+def _manning_inverse(points, i):
+    # Same as manning_inversesolver, for the cross-section i
+    width = points[i, WIDTH]
+    Qi = points[i, Q]
+    n = points[i, N]
+    s = points[i, S]
+    # Newton's method of manning_normaldepth
+    y = (Qi * n / (width * s ** 0.5)) ** (3. / 5.)
+    for _ in range(50):
+        P = width + 2 * y
+        logQ_y = 0.5 * math.log(s) - math.log(n) + 5. / 3. * math.log(width * y) - 2. / 3. * math.log(P)
+        step = (logQ_y - math.log(Qi)) / (5. / (3. * y) - 4. / (3. * P))
+        y = y - step
+        if not abs(step) > 1e-10 * y:
+            break
+    points[i, Y] = y
+    points[i, R] = (width * y) / (width + 2 * y)
+    points[i, YCRIT] = (Qi / (width * g ** 0.5)) ** (2. / 3.)
+    points[i, V] = Qi / (width * y)
+    points[i, Z] = points[i, Z_SMOOTHED] - y
+    points[i, H] = points[i, Z_SMOOTHED] + points[i, V] ** 2 / (2 * g) # add kinetic energy
+    points[i, FR] = points[i, V] / (g * y) ** 0.5
+
+
+@njit(cache=True)
+def _cs_inverse(points, up, down, min_slope, xtol):
+    # Same as cs_inversesolver, for the cross-sections up and down
+    localdist = points[up, DIST] - points[down, DIST]
+    if (points[up, Z_SMOOTHED] - points[down, Z_SMOOTHED]) / localdist <= min_slope:
+        points[down, SOLVER] = 2
+        h_ref = points[up, H] + localdist * (min_slope - (points[up, Z_SMOOTHED] - points[down, Z_SMOOTHED]) / localdist)
+    else:
+        h_ref = points[up, H]
+    width = points[down, WIDTH]
+    Qd = points[down, Q]
+    n = points[down, N]
+    z_smoothed = points[down, Z_SMOOTHED]
+    ycrit = (Qd / (width * g ** 0.5)) ** (2. / 3.)
+    points[down, YCRIT] = ycrit
+
+    y, nfev, converged = _solve_subcritical(ycrit, xtol, width, Qd, n, z_smoothed, localdist, h_ref, False)
+
+    points[down, Y] = y
+    points[down, NFEV] = nfev
+    points[down, CONVERGED] = converged
+    points[down, R] = (width * y) / (width + 2 * y)
+    points[down, V] = Qd / (width * y)
+    points[down, Z] = z_smoothed - y
+    points[down, S] = (n ** 2 * points[down, V] ** 2) / (points[down, R] ** (4. / 3.))
+    points[down, H] = z_smoothed + points[down, V] ** 2 / (2 * g) # add kinetic energy
+    points[down, FR] = points[down, V] / (g * y) ** 0.5
+
+
+@njit(cache=True)
+def _solve_subcritical(ycrit, xtol, width, Q, n, z, localdist, h_ref, normal):
+    # Same as _solve_subcritical of BasicSolverDirect, on _inverse_residual (or on _normal_residual if normal is True, z
+    # being then the bed elevation): the root is bracketed from the critical depth upwards, doubling the upper bound,
+    # then found with Brent's method. Return the depth, the number of evaluations and the convergence flag.
+    y_low = ycrit
+    dif_low = _residual(y_low, width, Q, n, z, localdist, h_ref, normal)
+    nfev = 1
+    if dif_low <= 0:
+        return y_low, nfev, dif_low == 0
+    y_high = max(2 * ycrit, 1e-3)
+    for _ in range(60):
+        dif_high = _residual(y_high, width, Q, n, z, localdist, h_ref, normal)
+        nfev += 1
+        if dif_high <= 0:
+            y, brent_nfev, converged = _brentq(y_low, y_high, xtol, width, Q, n, z, localdist, h_ref, normal)
+            return y, nfev + brent_nfev, converged
+        y_low = y_high
+        y_high = 2 * y_high
+    return y_high, nfev, False
+
+
+@njit(cache=True)
+def _inverse_residual(y, width, Q, n, z_smoothed, localdist, h_ref):
+    # Same as the equations function of cs_inversesolver
+    R = (width * y) / (width + 2 * y)
+    v = Q / (width * y)
+    s = (n ** 2 * v ** 2) / (R ** (4. / 3.))
+    h = z_smoothed
+    h = h + v ** 2 / (2 * g) # add kinetic energy
+    friction_h = localdist * s
+    dif_energy = friction_h + h - h_ref
+    return dif_energy
+
+
+@njit(cache=True)
+def _normal_residual(y, width, Q, n, z, localdist, h_ref):
+    # Same as the equations function of cs_normalsolver
+    R = (width * y) / (width + 2 * y)
+    v = Q / (width * y)
+    s = (n ** 2 * v ** 2) / (R ** (4. / 3.))
+    h = z + y
+    h = h + v ** 2 / (2 * g) # add kinetic energy
+    friction_h = localdist * s
+    dif_energy = friction_h + h_ref - h
+    return dif_energy
+
+
+@njit(cache=True)
+def _residual(y, width, Q, n, z, localdist, h_ref, normal):
+    if normal:
+        return _normal_residual(y, width, Q, n, z, localdist, h_ref)
+    return _inverse_residual(y, width, Q, n, z, localdist, h_ref)
+
+
+@njit(cache=True)
+def _brentq(xa, xb, xtol, width, Q, n, z_smoothed, localdist, h_ref, normal=False):
+    # Brent's method, following scipy's brentq implementation (same steps, same default relative tolerance and maximum
+    # number of iterations), on _inverse_residual (or on _normal_residual if normal is True, z_smoothed being then the
+    # bed elevation). Return the root, the number of evaluations and the convergence flag.
+    rtol = 4 * np.finfo(np.float64).eps
+    xpre = xa
+    xcur = xb
+    xblk = 0.
+    fblk = 0.
+    spre = 0.
+    scur = 0.
+    fpre = _residual(xpre, width, Q, n, z_smoothed, localdist, h_ref, normal)
+    fcur = _residual(xcur, width, Q, n, z_smoothed, localdist, h_ref, normal)
+    nfev = 2
+    if fpre == 0:
+        return xpre, nfev, True
+    if fcur == 0:
+        return xcur, nfev, True
+    for _ in range(100):
+        if fpre != 0 and fcur != 0 and (fpre < 0) != (fcur < 0):
+            xblk = xpre
+            fblk = fpre
+            spre = xcur - xpre
+            scur = spre
+        if abs(fblk) < abs(fcur):
+            xpre = xcur
+            xcur = xblk
+            xblk = xpre
+            fpre = fcur
+            fcur = fblk
+            fblk = fpre
+        delta = (xtol + rtol * abs(xcur)) / 2
+        sbis = (xblk - xcur) / 2
+        if fcur == 0 or abs(sbis) < delta:
+            return xcur, nfev, True
+        if abs(spre) > delta and abs(fcur) < abs(fpre):
+            if xpre == xblk:
+                # interpolate
+                stry = -fcur * (xcur - xpre) / (fcur - fpre)
+            else:
+                # extrapolate
+                dpre = (fpre - fcur) / (xpre - xcur)
+                dblk = (fblk - fcur) / (xblk - xcur)
+                stry = -fcur * (fblk * dblk - fpre * dpre) / (dblk * dpre * (fblk - fpre))
+            if 2 * abs(stry) < min(abs(spre), 3 * abs(sbis) - delta):
+                # good short step
+                spre = scur
+                scur = stry
+            else:
+                # bisect
+                spre = sbis
+                scur = sbis
+        else:
+            # bisect
+            spre = sbis
+            scur = sbis
+        xpre = xcur
+        fpre = fcur
+        if abs(scur) > delta:
+            xcur += scur
+        else:
+            xcur += delta if sbis > 0 else -delta
+        fcur = _residual(xcur, width, Q, n, z_smoothed, localdist, h_ref, normal)
+        nfev += 1
+    return xcur, nfev, False
+
+
+def inverse1Dhydro_ensemble(dist, z_smoothed, width, discharge, q_scale, n, min_slope, xtol=1e-6, min_spacing=0.1,
+                            maxiter=100):
+    # Inverse 1D hydraulic calculations for many scenarios at once, on the same smoothed water surface. Every scenario
+    # has its own discharge factor (q_scale, applied to discharge), Manning's coefficient and minimum slope (one value
+    # each, or arrays of one value per scenario).
+    # The march from upstream to downstream is done once, every step solving all the scenarios together with NumPy.
+    # Unlike inverse1Dhydro_march, no cross-section is added, as every scenario would need a different set of points:
+    # the 'refine' result flags the cross-sections where the Froude number varies too much (i.e. where the single
+    # scenario calculation would add cross-sections upstream). The root finding is done with the Illinois variant of
+    # the regula falsi, which is easier to vectorize than Brent's method: the depths match the single scenario
+    # calculation within xtol.
+    # Return a dictionary of arrays shaped (number of points, number of scenarios), one per field of ENSEMBLE_FIELDS.
+    # The solver flags are coded as integers (see SOLVER_FLAGS).
+    dist = np.asarray(dist, dtype=float)
+    z_smoothed = np.asarray(z_smoothed, dtype=float)
+    width = np.asarray(width, dtype=float)
+    q_scale, n, min_slope = np.broadcast_arrays(*[np.atleast_1d(np.asarray(value, dtype=float))
+                                                  for value in (q_scale, n, min_slope)])
+    npts = len(dist)
+    results = {field: np.full((npts, len(q_scale)), np.nan) for field in ENSEMBLE_FIELDS}
+    results['Q'][:] = np.asarray(discharge, dtype=float)[:, None] * q_scale[None, :]
+
+    # Upstream boundary: Manning's equation only
+    last = npts - 1
+    s = np.maximum(min_slope, (z_smoothed[last] - z_smoothed[last - 1]) / (dist[last] - dist[last - 1]))
+    Qi = results['Q'][last]
+    y = manning_normaldepth(Qi, width[last], n, s)[0]
+    v = Qi / (width[last] * y)
+    results['ycrit'][last] = (Qi / (width[last] * g ** 0.5)) ** (2. / 3.)
+    _store_ensemble(results, last, y, v, width[last], z_smoothed[last], s)
+    results['solver'][last] = 0
+    results['refine'][last] = 0
+
+    for i in range(npts - 2, -1, -1):
+        up = i + 1
+        localdist = dist[up] - dist[i]
+        ws_slope = (z_smoothed[up] - z_smoothed[i]) / localdist
+        flat = ws_slope <= min_slope
+        h_ref = np.where(flat, results['h'][up] + localdist * (min_slope - ws_slope), results['h'][up])
+        Qi = results['Q'][i]
+        ycrit = (Qi / (width[i] * g ** 0.5)) ** (2. / 3.)
+        y, nfev, converged = _illinois(ycrit, width[i], Qi, n, z_smoothed[i], localdist, h_ref, xtol, maxiter)
+        R = (width[i] * y) / (width[i] + 2 * y)
+        v = Qi / (width[i] * y)
+        results['ycrit'][i] = ycrit
+        _store_ensemble(results, i, y, v, width[i], z_smoothed[i], (n ** 2 * v ** 2) / (R ** (4. / 3.)))
+        results['solver'][i] = np.where(flat, 2, 1)
+        results['nfev'][i] = nfev
+        results['converged'][i] = converged
+        results['refine'][i] = ((results['Fr'][i] - results['Fr'][up]) / results['Fr'][up] > 0.5) & \
+                               (localdist > min_spacing)
+    return results
+
+
+def _store_ensemble(results, i, y, v, width, z_smoothed, s):
+    results['y'][i] = y
+    results['R'][i] = (width * y) / (width + 2 * y)
+    results['v'][i] = v
+    results['z'][i] = z_smoothed - y
+    results['s'][i] = s
+    results['h'][i] = z_smoothed + v ** 2 / (2 * g) # add kinetic energy
+    results['Fr'][i] = v / (g * y) ** 0.5
+
+
+def _illinois(ycrit, width, Q, n, z_smoothed, localdist, h_ref, xtol, maxiter):
+    # Vectorized version of _solve_subcritical: subcritical depths (y >= ycrit) so that the energy residual is 0, for
+    # arrays of scenarios. The bracket is searched as in _solve_subcritical, then reduced with the Illinois method until
+    # it is narrower than xtol.
+    residual = lambda y: _inverse_residual(y, width, Q, n, z_smoothed, localdist, h_ref)
+    y_low = ycrit.copy()
+    f_low = residual(y_low)
+    nfev = np.ones(len(ycrit), dtype=int)
+    y = y_low.copy() # critical flow when the residual is already negative at ycrit
+    converged = f_low == 0
+    solving = f_low > 0
+
+    # Search for an upper bound
+    y_high = np.maximum(2 * ycrit, 1e-3)
+    f_high = np.full(len(ycrit), np.nan)
+    expanding = solving.copy()
+    for _ in range(60):
+        if not np.any(expanding):
+            break
+        f_high = np.where(expanding, residual(y_high), f_high)
+        nfev += expanding
+        expanding &= f_high > 0
+        y_low = np.where(expanding, y_high, y_low)
+        f_low = np.where(expanding, f_high, f_low)
+        y_high = np.where(expanding, 2 * y_high, y_high)
+    y = np.where(expanding, y_high, y) # no upper bound found
+    solving &= ~expanding
+    y = np.where(solving, y_high, y)
+
+    # Illinois method
+    side = np.zeros(len(ycrit), dtype=int) # side of the bracket replaced at the last iteration (-1 low, 1 high)
+    for _ in range(maxiter):
+        narrow = solving & (y_high - y_low <= xtol)
+        converged |= narrow
+        solving &= ~narrow
+        if not np.any(solving):
+            break
+        y_new = y_high - f_high * (y_high - y_low) / (f_high - f_low)
+        y_new = np.where((y_new > y_low) & (y_new < y_high), y_new, (y_low + y_high) / 2.)
+        f_new = residual(y_new)
+        nfev += solving
+        y = np.where(solving, y_new, y)
+        exact = solving & (f_new == 0)
+        converged |= exact
+        solving &= ~exact
+        to_low = solving & (f_new > 0)
+        to_high = solving & (f_new < 0)
+        # The value at the bound kept twice in a row is halved, so that both bounds converge
+        f_high = np.where(to_low & (side == -1), f_high / 2., f_high)
+        f_low = np.where(to_high & (side == 1), f_low / 2., f_low)
+        y_low = np.where(to_low, y_new, y_low)
+        f_low = np.where(to_low, f_new, f_low)
+        y_high = np.where(to_high, y_new, y_high)
+        f_high = np.where(to_high, f_new, f_high)
+        side = np.where(to_low, -1, np.where(to_high, 1, side))
+    return y, nfev, converged
+
+
+def normal1Dhydro_batch(dist, z, width, discharge, n, down_slope, xtol=1e-6):
+    # Direct 1D hydraulic calculations (as execute_SimpleHydro: given the bed, find the water surface) for many profiles
+    # at once, e.g. the bed profiles reduced with several RDP tolerances. The arrays are shaped (number of points,
+    # number of profiles), every column being a profile sorted by distance (from downstream to upstream). Shorter
+    # profiles are padded with NaN at the end. n is the Manning's coefficient and down_slope the downstream boundary
+    # slope (one value, or one value per profile).
+    # The downstream boundaries of all the profiles are solved together, then the marches are done in a single call
+    # of the (compiled) march, with the same root finding as execute_SimpleHydro.
+    # Return a dictionary of arrays shaped as dist, one per field of BATCH_FIELDS (NaN on the padding).
+    dist, z, width, discharge = [np.asarray(values, dtype=float) for values in (dist, z, width, discharge)]
+    npts, nprofiles = dist.shape
+    n = np.array(np.broadcast_to(np.asarray(n, dtype=float), (nprofiles,)))
+    down_slope = np.broadcast_to(np.asarray(down_slope, dtype=float), (nprofiles,))
+    nb_points = np.sum(~np.isnan(dist), axis=0)
+    results = np.full((len(BATCH_FIELDS), npts, nprofiles), np.nan)
+
+    # Downstream boundary: Manning's equation only
+    y = manning_normaldepth(discharge[0], width[0], n, down_slope)[0]
+    v = discharge[0] / (width[0] * y)
+    results[B_Y, 0] = y
+    results[B_R, 0] = (width[0] * y) / (width[0] + 2 * y)
+    results[B_YCRIT, 0] = (discharge[0] / (width[0] * g ** 0.5)) ** (2. / 3.)
+    results[B_V, 0] = v
+    results[B_WS, 0] = z[0] + y
+    results[B_H, 0] = results[B_WS, 0] + v ** 2 / (2 * g) # add kinetic energy
+    results[B_FR, 0] = v / (g * y) ** 0.5
+    results[B_S, 0] = down_slope
+
+    _normal_march(dist, z, width, discharge, n, nb_points, xtol, results)
+    return {field: results[i] for i, field in enumerate(BATCH_FIELDS)}
+
+
+# Index of the fields of BATCH_FIELDS in the array of results of _normal_march
+B_Y, B_WS, B_V, B_S, B_H, B_FR, B_YCRIT, B_R, B_NFEV, B_CONVERGED = range(10)
+
+
+@njit(cache=True)
+def _normal_march(dist, z, width, discharge, n, nb_points, xtol, results):
+    # March from downstream to upstream on every profile, the downstream boundary being already solved
+    for j in range(dist.shape[1]):
+        for k in range(1, nb_points[j]):
+            localdist = dist[k, j] - dist[k - 1, j]
+            h_ref = results[B_H, k - 1, j]
+            w = width[k, j]
+            Qk = discharge[k, j]
+            zk = z[k, j]
+            ycrit = (Qk / (w * g ** 0.5)) ** (2. / 3.)
+            results[B_YCRIT, k, j] = ycrit
+
+            y, nfev, converged = _solve_subcritical(ycrit, xtol, w, Qk, n[j], zk, localdist, h_ref, True)
+
+            # Same as the end of cs_normalsolver
+            results[B_Y, k, j] = y
+            results[B_NFEV, k, j] = nfev
+            results[B_CONVERGED, k, j] = converged
+            R = (w * y) / (w + 2 * y)
+            v = Qk / (w * y)
+            results[B_R, k, j] = R
+            results[B_V, k, j] = v
+            results[B_WS, k, j] = zk + y
+            results[B_S, k, j] = (n[j] ** 2 * v ** 2) / (R ** (4. / 3.))
+            results[B_H, k, j] = (zk + y) + v ** 2 / (2 * g) # add kinetic energy
+            results[B_FR, k, j] = v / (g * y) ** 0.5
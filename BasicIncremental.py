@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Incremental processing of a reach
+# When a reach is processed again after a change of part of its input (e.g. a LiDAR tile reprocessed, or a corrected
+# discharge value), only the results that can be affected by the change are recomputed:
+# - the quantile carving is a single optimization over the whole reach: it is recomputed if the water surface changed
+# - the smoothing of a point only depends on the points within a few standard deviations of the Gaussian curves (plus
+#   the chain of restrictions of the curves from downstream to upstream): see smooth_profile
+# - the bathymetry assessment goes from upstream to downstream: it is recomputed from the most upstream change
+# The results are identical (bit for bit) to a full computation. With verify=True, this is checked at every run by
+# doing the full computation as well.
+
+import numpy as np
+import pandas as pd
+
+from BasicQuantileRegression import QuantileCarving
+from BasicWSSmoothing import smooth_profile, split_smoothing_params, DIAGNOSTIC_FIELDS
+from BasicBedAssessment import execute_BedAssessment
+from BasicRiverDataStructure import Databrowser
+from BasicInstrumentation import count
+
+INPUT_FIELDS = ['dist', 'z_ws', 'width', 'Q']
+
+
+class IncrementalRun():
+    # Water surface smoothing and bathymetry assessment of one reach, keeping the inputs and the results of the last run
+    # so that the next run only recomputes what changed
+
+    def __init__(self, manning, min_slope, quantile=0.2, smoothing_params=None, verify=False):
+        self.manning = manning
+        self.min_slope = min_slope
+        self.quantile = quantile
+        self.smoothing_params = smoothing_params or {}
+        # smoothing_params are parameters of execute_WSsmoothing. The intermediate results of smooth_profile are always
+        # kept (they are the previous results of the next run): diagnostics only chooses whether they are added to the
+        # datapoints. With cache_weights, the Gaussian weights are kept with the run.
+        carving, self._profile_params, others = split_smoothing_params(self.smoothing_params)
+        self._carving_params = (carving.get('carving_window_size'), carving.get('carving_window_overlap', 200))
+        self._diagnostics = others.get('diagnostics', False)
+        self._weights = {} if others.get('cache_weights', False) else None
+        self.verify = verify
+        self._cache = None
+        self.last_stats = None # description of what was recomputed in the last run
+
+    def run(self, df_data):
+        # Process the reach and return its Databrowser (same results as execute_WSsmoothing followed by
+        # execute_BedAssessment)
+        data = Databrowser(df_data[INPUT_FIELDS])
+        inputs = {field: data.get_column(field).copy() for field in INPUT_FIELDS}
+        cache = self._cache
+        if cache is None or len(inputs['dist']) != len(cache['inputs']['dist']) or \
+                not np.array_equal(inputs['dist'], cache['inputs']['dist']):
+            # First run, or different points: full computation
+            self.last_stats = {'mode': 'full'}
+            smoothing = self._smoothing(data, None)
+            ztosmooth = data.get_column('ztosmooth').copy()
+            execute_BedAssessment(data, self.manning, self.min_slope)
+        else:
+            self.last_stats = {'mode': 'incremental'}
+            smoothing = self._smoothing(data, cache)
+            ztosmooth = data.get_column('ztosmooth').copy()
+            self._bedassessment(data, cache, inputs)
+        count("incremental_runs" if self.last_stats['mode'] == 'incremental' else "full_runs")
+
+        self._cache = {'inputs': inputs, 'ztosmooth': ztosmooth, 'smoothing': smoothing,
+                       'bed': data.topandasdf(data.get_fields())}
+        if self.verify:
+            self._verify(df_data, data)
+        return data
+
+    def _smoothing(self, data, cache):
+        # Quantile carving and smoothing, recomputed only where needed
+        inputs_changed = cache is None or not np.array_equal(data.get_column('z_ws'), cache['inputs']['z_ws'])
+        self.last_stats['carving'] = inputs_changed
+        if inputs_changed:
+            QuantileCarving(data, self.quantile, *self._carving_params)
+        else:
+            data.set_column('ztosmooth', cache['ztosmooth'])
+        if not inputs_changed:
+            smoothing = cache['smoothing']
+        else:
+            smoothing = smooth_profile(data.get_column('dist'), data.get_column('ztosmooth'), data.get_column('z_ws'),
+                                       previous=None if cache is None else cache['smoothing'], weights=self._weights,
+                                       diagnostics=True, **self._profile_params)
+        data.set_column('z_smoothed', smoothing['z_smoothed'])
+        if self._diagnostics:
+            for field, result in DIAGNOSTIC_FIELDS.items():
+                data.set_column(field, smoothing[result])
+        return smoothing
+
+    def _bedassessment(self, data, cache, inputs):
+        # Bathymetry assessment, recomputed downstream of the most upstream change
+        bed = cache['bed']
+        original = (bed['type'] != 3).to_numpy()
+        bed_original = bed[original]
+        changed = (data.get_column('z_smoothed') != bed_original['z_smoothed'].to_numpy()) | \
+                  (inputs['width'] != cache['inputs']['width']) | (inputs['Q'] != cache['inputs']['Q'])
+        changes = np.flatnonzero(changed)
+        npts = len(data)
+        if len(changes) > 0 and changes[-1] >= npts - 2:
+            # The upstream boundary changed: full computation
+            self.last_stats['bed_restart'] = None
+            self.last_stats['bed_recomputed'] = npts
+            execute_BedAssessment(data, self.manning, self.min_slope)
+            return
+        upstream = changes[-1] + 1 if len(changes) > 0 else 0 # first unchanged cross-section upstream of the changes
+        restart_dist = inputs['dist'][upstream]
+        self.last_stats['bed_restart'] = float(restart_dist) if len(changes) > 0 else None
+        self.last_stats['bed_recomputed'] = int(upstream)
+
+        # Results of the unchanged cross-sections, including the added ones
+        kept = np.arange(npts) >= upstream
+        for field in bed.columns:
+            if field in INPUT_FIELDS or field in ('ztosmooth', 'z_smoothed') or field in DIAGNOSTIC_FIELDS:
+                continue
+            values = bed_original[field].to_numpy()
+            if values.dtype == object:
+                values = np.where(kept, values, None)
+            else:
+                values = np.where(kept, values, np.nan)
+            data.set_column(field, values)
+        bed_added = bed[~original & (bed['dist'] > restart_dist).to_numpy()]
+        for newobj, (_, row) in zip(data.add_points(bed_added['dist'].tolist()), bed_added.iterrows()):
+            for field in bed.columns:
+                if field != 'dist' and field not in DIAGNOSTIC_FIELDS:
+                    setattr(newobj, field, row[field])
+
+        if len(changes) > 0:
+            execute_BedAssessment(data, self.manning, self.min_slope, restart_from=restart_dist)
+
+    def _verify(self, df_data, data):
+        # Check that the results are identical to the results of a full computation
+        full = IncrementalRun(self.manning, self.min_slope, self.quantile, self.smoothing_params).run(df_data)
+        fields = full.get_fields()
+        df_full = full.topandasdf(fields)
+        df_incremental = data.topandasdf(fields)
+        for field in fields:
+            a = df_full[field].to_numpy()
+            b = df_incremental[field].to_numpy()
+            if a.dtype == object or b.dtype == object:
+                same = len(a) == len(b) and all(x == y or (pd.isna(x) and pd.isna(y)) for x, y in zip(a, b))
+            else:
+                same = np.array_equal(a, b, equal_nan=True)
+            if not same:
+                raise RuntimeError("The incremental results differ from the full computation for " + field)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Opt-in instrumentation of the processing stages
+# Metrics are only collected inside an instrumented_run block. Outside of it, the instrumentation functions do nothing.
+#
+#     with instrumented_run("my reach", sink="metrics.jsonl") as report:
+#         execute_WSsmoothing(data)
+#         execute_BedAssessment(data, 0.03, 0.00001)
+#     print(report.to_dict())
+#
+# The report contains:
+# - the runtime of every stage (functions decorated with timed_stage). Stages can be nested (e.g. QuantileCarving is
+#   run by execute_WSsmoothing), in which case the runtime of the inner stage is included in the outer one.
+# - counters incremented by the stages (solver calls, objective evaluations, added cross-sections, restricted points...)
+
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+_active_report = None
+
+
+class RunReport():
+    # Metrics collected during one run
+
+    def __init__(self, name=None):
+        self.name = name
+        self.start = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.stages = {}
+        self.stage_calls = {}
+        self.counters = {}
+
+    def add_time(self, stage, runtime):
+        self.stages[stage] = self.stages.get(stage, 0.) + runtime
+        self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self):
+        return {"name": self.name, "start": self.start, "stages": dict(self.stages),
+                "stage_calls": dict(self.stage_calls), "counters": dict(self.counters)}
+
+    def write_jsonl(self, path):
+        # Append the report as one line of a json lines file
+        with open(path, "a") as file:
+            file.write(json.dumps(self.to_dict()) + "\n")
+
+
+@contextmanager
+def instrumented_run(name=None, sink=None):
+    # Collect the metrics of the stages run in the block, in a RunReport. If sink (path of a json lines file) is
+    # provided, the report is appended to it at the end of the block.
+    global _active_report
+    previous = _active_report
+    report = RunReport(name)
+    _active_report = report
+    try:
+        yield report
+    finally:
+        _active_report = previous
+        if sink is not None:
+            report.write_jsonl(sink)
+
+
+def count(counter, value=1):
+    # Increment a counter of the active report, if any
+    if _active_report is not None:
+        _active_report.count(counter, value)
+
+
+def is_active():
+    return _active_report is not None
+
+
+def timed_stage(function):
+    # Decorator recording the runtime of the function, as a stage of the active report, if any
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        report = _active_report
+        if report is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            report.add_time(function.__name__, time.perf_counter() - start)
+    return wrapper
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+# Local job service: reaches are submitted at any time and processed in the background, without launching a script for
+# every reach
+# The jobs wait in a bounded queue (submit waits while the queue is full) and are taken by as many runners as there
+# are worker processes, so that the host is kept busy. The stages of a job (smoothing, bathymetry assessment, reduction
+# and validation) are dispatched to a pool of processes one after the other, and the status of the job (queued, running
+# with its current stage, done or failed) can be polled at any time. Only the columns needed by a stage are sent to
+# its process, and only the columns needed by the next stages are sent back. A reach submitted again with the same
+# parameters while it is still queued or running is not processed twice: the job already in progress is returned.
+# The service runs headless: the plots are optional (plot=True), and are saved as png files next to the bed profiles.
+#
+#     async with JobService("output_folder") as service:
+#         job_id = await service.submit("reach.csv", q_factor=1.5)
+#         print(service.status(job_id))
+#         summary = await service.wait(job_id)
+#
+# The service can also be run as a local server (see serve), receiving commands as json lines over TCP:
+#     python BasicJobService.py output_folder --port 8765
+#     {"command": "submit", "path": "reach.csv", "q_factor": 1.5}  ->  {"job_id": "..."}
+#     {"command": "status", "job_id": "..."}                       ->  status of the job
+#     {"command": "jobs"}                                          ->  status of all the jobs
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from BasicWSSmoothing import *
+from BasicBedAssessment import *
+from BasicRiverDataStructure import *
+from BasicColumnIO import INPUT_FIELDS, read_columns, write_columns
+from BasicStageCache import BED_INPUT_FIELDS, StageCache, cached_WSsmoothing, cached_BedAssessment
+from BasicBatchProcessing import OUTPUT_FIELDS, _output_name
+
+STAGES = ["smoothing", "bed assessment", "validation"]
+
+# Fields returned by the bathymetry assessment stage: the ones needed by the validation and the output (the fields
+# derived from y, such as Fr, are computed again from them)
+BED_OUTPUT_FIELDS = ['dist', 'z_smoothed', 'width', 'Q', 'z', 'y', 's', 'type']
+# Fields of the original points carried to the refined profile (missing on the added cross-sections)
+CARRIED_FIELDS = ['z_ws', 'ztosmooth']
+
+
+def _get_columns(data, fields):
+    return {field: data.get_column(field) for field in fields}
+
+
+def _stage_smoothing(path, q_factor, smoothing_params, cache):
+    # Read the reach, apply the discharge factor and process the water surface
+    columns = read_columns(path, INPUT_FIELDS)
+    columns['Q'] = columns['Q'] * q_factor
+    data = Databrowser.from_columns(columns)
+    cached_WSsmoothing(data, cache, **(smoothing_params or {}))
+    return _get_columns(data, data.get_fields())
+
+
+def _stage_bedassessment(columns, manning, min_slope, cache):
+    data = Databrowser.from_columns(columns)
+    cached_BedAssessment(data, manning, min_slope, cache)
+    return _get_columns(data, BED_OUTPUT_FIELDS)
+
+
+def _stage_validation(columns, manning, epsilon, output, plot):
+    # Reduction of the bed profile, validation and output (the plot is drawn without display, in a png file)
+    data = Databrowser.from_columns(columns)
+    data_reduced = data.reduce_bedpoints_RDP(epsilon)
+    execute_SimpleHydro(data_reduced, manning, data_reduced.get_first_point().s)
+    write_columns(output, data_reduced, OUTPUT_FIELDS)
+    if plot:
+        import matplotlib
+        matplotlib.use("Agg")
+        from Basic_bathy_main import plot_bed_profiles
+        df_beddata = data.topandasdf(OUTPUT_FIELDS)
+        plot_bed_profiles(df_beddata, data_reduced.topandasdf(OUTPUT_FIELDS),
+                          df_beddata[data.get_column('type') != 3], os.path.splitext(output)[0] + ".png")
+    nb_added_points = int(np.sum(data.get_column('type') == 3))
+    return {"nb_points": len(data) - nb_added_points, "nb_added_points": nb_added_points,
+            "nb_reduced_points": len(data_reduced)}
+
+
+class JobService():
+    # Queue of reaches to process on a pool of processes
+
+    def __init__(self, output_folder, manning=0.03, min_slope=0.00001, epsilon=0.1, smoothing_params=None,
+                 workers=None, queue_size=100, cache_folder=None, cache_size=1e9, output_format="csv", plot=False):
+        # The parameters are the default ones of the jobs (see submit). workers is the number of processes (default:
+        # number of CPUs), queue_size the maximum number of queued jobs.
+        self.output_folder = output_folder
+        self.defaults = {"manning": manning, "min_slope": min_slope, "epsilon": epsilon,
+                         "smoothing_params": smoothing_params, "output_format": output_format, "plot": plot}
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.cache = StageCache(cache_folder, cache_size) if cache_folder is not None else None
+        self._jobs = {} # job id: status of the job (dictionary)
+        self._done = {} # job id: asyncio event set when the job is finished
+        self._in_progress = {} # key of the submission: id of the queued or running job
+        self._queue = None
+        self._executor = None
+        self._runners = []
+        self._nb_jobs = 0
+
+    async def start(self):
+        os.makedirs(self.output_folder, exist_ok=True)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._runners = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self, wait=True):
+        # Stop the service, after the queued jobs are processed if wait is True (otherwise, the queued jobs are
+        # cancelled and only the running stages are completed)
+        if wait:
+            await self._queue.join()
+        for runner in self._runners:
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        self._runners = []
+        for job in self._jobs.values():
+            if job["status"] in ("queued", "running"):
+                self._finish(job, "cancelled")
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def submit(self, path, q_factor=1., **params):
+        # Queue the processing of a reach under a discharge factor, and return the id of the job
+        # params overrides the default parameters of the service (manning, min_slope, epsilon, smoothing_params,
+        # output_format, plot). Waits while the queue is full.
+        unknown = set(params) - set(self.defaults)
+        if unknown:
+            raise TypeError("Unknown job parameters: {}".format(", ".join(sorted(unknown))))
+        params = dict(self.defaults, **params)
+        path = os.path.abspath(path)
+        key = self._key(path, q_factor, params)
+        if key in self._in_progress:
+            return self._in_progress[key]
+        self._nb_jobs += 1
+        job_id = "{}-{}".format(self._nb_jobs, key[:12])
+        self._jobs[job_id] = {"job_id": job_id, "reach": path, "q_factor": q_factor, "status": "queued", "stage": None,
+                              "progress": 0., "submitted": time.time(), "started": None, "finished": None,
+                              "nb_points": None, "nb_added_points": None, "nb_reduced_points": None, "output": None,
+                              "error": None}
+        self._done[job_id] = asyncio.Event()
+        self._in_progress[key] = job_id
+        try:
+            await self._queue.put((job_id, key, params))
+        except asyncio.CancelledError:
+            # The submission was cancelled while waiting for room in the queue: the job is not queued
+            del self._in_progress[key]
+            self._finish(self._jobs[job_id], "cancelled")
+            raise
+        return job_id
+
+    def status(self, job_id):
+        # Return a copy of the status of a job: status (queued, running, done, failed or cancelled), current stage,
+        # progress (fraction of the stages completed), times, output file and error message
+        return dict(self._jobs[job_id])
+
+    def jobs(self):
+        return [dict(job) for job in self._jobs.values()]
+
+    async def wait(self, job_id):
+        # Wait for the end of a job and return its status
+        await self._done[job_id].wait()
+        return self.status(job_id)
+
+    def _key(self, path, q_factor, params):
+        # Identical submissions: same reach file (same size and modification time), discharge factor and parameters
+        try:
+            stat = os.stat(path)
+            version = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            version = None
+        text = json.dumps([path, version, q_factor, params], sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    async def _run(self):
+        # Runner: process the queued jobs one after the other
+        while True:
+            job_id, key, params = await self._queue.get()
+            try:
+                await self._process(self._jobs[job_id], params)
+            finally:
+                del self._in_progress[key]
+                self._queue.task_done()
+
+    async def _process(self, job, params):
+        loop = asyncio.get_running_loop()
+        job["status"] = "running"
+        job["started"] = time.time()
+        output = os.path.join(self.output_folder, _output_name(job["reach"], job["q_factor"], params["output_format"]))
+
+        async def run_stage(i, stage, *args):
+            job["stage"] = STAGES[i]
+            result = await loop.run_in_executor(self._executor, stage, *args)
+            job["progress"] = (i + 1) / len(STAGES)
+            return result
+
+        try:
+            columns = await run_stage(0, _stage_smoothing, job["reach"], job["q_factor"], params["smoothing_params"],
+                                      self.cache)
+            bed_columns = await run_stage(1, _stage_bedassessment,
+                                          {field: columns[field] for field in BED_INPUT_FIELDS},
+                                          params["manning"], params["min_slope"], self.cache)
+            columns = _carry_fields(bed_columns, {field: columns[field] for field in CARRIED_FIELDS})
+            job.update(await run_stage(2, _stage_validation, columns, params["manning"], params["epsilon"], output,
+                                       params["plot"]))
+            job["output"] = output
+            self._finish(job, "done")
+        except Exception as e:
+            job["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+            self._finish(job, "failed")
+
+    def _finish(self, job, status):
+        job["status"] = status
+        job["stage"] = None
+        job["finished"] = time.time()
+        self._done[job["job_id"]].set()
+
+
+def _carry_fields(columns, carried):
+    # Add to the columns of the refined profile (see _stage_bedassessment) the fields of the original points, missing on
+    # the added cross-sections
+    original = columns['type'] != 3
+    columns = dict(columns)
+    for field, values in carried.items():
+        columns[field] = np.full(len(original), np.nan)
+        columns[field][original] = values
+    return columns
+
+
+async def serve(service, host="127.0.0.1", port=8765):
+    # Receive commands (one json object per line) over TCP and answer with one json object per line
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                command = request.pop("command")
+                if command == "submit":
+                    answer = {"job_id": await service.submit(request.pop("path"), **request)}
+                elif command == "status":
+                    answer = service.status(request["job_id"])
+                elif command == "jobs":
+                    answer = service.jobs()
+                else:
+                    answer = {"error": "Unknown command: {}".format(command)}
+            except Exception as e:
+                answer = {"error": "".join(traceback.format_exception_only(type(e), e)).strip()}
+            writer.write((json.dumps(answer) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def _main(args):
+    async with JobService(args.output, args.manning, args.min_slope, args.epsilon, workers=args.workers,
+                          queue_size=args.queue_size, cache_folder=args.cache, output_format=args.output_format,
+                          plot=args.plot) as service:
+        await serve(service, args.host, args.port)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local job service for the bathymetry assessment of reaches")
+    parser.add_argument("output", help="output folder")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--manning", type=float, default=0.03)
+    parser.add_argument("--min_slope", type=float, default=0.00001)
+    parser.add_argument("--epsilon", type=float, default=0.1, help="tolerance of the RDP reduction (m)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--queue_size", type=int, default=100, help="maximum number of queued jobs")
+    parser.add_argument("--cache", default=None, help="folder where the stage results are cached")
+    parser.add_argument("--output_format", default="csv", choices=["csv", "parquet", "arrow", "npy"])
+    parser.add_argument("--plot", action="store_true", help="save a plot of every bed profile (png)")
+    args = parser.parse_args()
+
+    asyncio.run(_main(args))
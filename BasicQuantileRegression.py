@@ -4,8 +4,15 @@ import numpy as np
 import scipy.sparse
 import scipy.optimize
 import math
+from BasicInstrumentation import count, timed_stage
 
-def QuantileCarving(datapoints, tau=0.5):
+try:
+    import highspy # direct access to the HiGHS solver, to reuse the same model for several quantiles
+except ImportError:
+    highspy = None
+
+@timed_stage
+def QuantileCarving(datapoints, tau=0.5, window_size=None, window_overlap=200):
     # This quantile carving process comes from :
     #    Schwanghart, W., Scherler, D., 2017. Bumps in river profiles:
     #    uncertainty assessment and smoothing using quantile regression
@@ -13,51 +20,186 @@ def QuantileCarving(datapoints, tau=0.5):
     #    [DOI: 10.5194/esurf-5-821-2017]
     # Code was adapted from their Matlab code:
     # https://github.com/wschwanghart/topotoolbox/@FLOWobj/quantcarve.m
+    #
+    # For very long profiles, a window_size (in number of points) can be provided. The profile is then carved window
+    # by window, from downstream to upstream, each window being extended by window_overlap points on both sides to
+    # limit the edge effects. Only the central part of each window is kept, and its first point is constrained to be
+    # at least as high as the last point kept from the previous window, so that the stitched profile is still
+    # monotonic. Memory and solving time then depend on the window size instead of the profile length.
 
-    x = []
-    z = []
-
-    for cs in datapoints.browse_down_to_up():
-        x.append(cs.dist)
-        z.append(cs.z_ws)
-
-    x = np.array(x)
-    z = np.array(z)
+    x = np.asarray(datapoints.get_column('dist'), dtype=float) # double precision, even for single precision columns
+    z = np.asarray(datapoints.get_column('z_ws'), dtype=float)
 
     n = len(datapoints)
 
+    if window_size is None or n <= window_size:
+        newz = _carve(x, z, tau)
+    else:
+        newz = _carve_by_windows(x, z, window_size, window_overlap,
+                                 lambda x, z, index_min, zmin: _carve(x, z, tau, index_min, zmin))
+
+    datapoints.set_column('ztosmooth', newz)
+
+
+def _carve_by_windows(x, z, window_size, window_overlap, carve):
+    # Carving of the profile (x, z) window by window, from downstream to upstream (see QuantileCarving)
+    # carve(x, z, index_min, zmin) carves one extended window, the carved elevation at index_min being constrained to be
+    # higher or equal to zmin (the last carved elevation of the previous window, None for the first window). It returns
+    # the carved profile, or an array of profiles (e.g. one per quantile) with the points on the last axis.
+    n = len(x)
+    newz = None
+    for seam in range(0, n, window_size):
+        end = min(seam + window_size, n)
+        first = max(seam - window_overlap, 0)
+        last = min(end + window_overlap, n)
+        zmin = newz[..., seam - 1] if seam > 0 else None
+        windowz = carve(x[first:last], z[first:last], seam - first, zmin)
+        if newz is None:
+            newz = np.empty(windowz.shape[:-1] + (n,))
+        newz[..., seam:end] = windowz[..., seam - first:end - first]
+    return newz
+
+
+def _carving_matrices(x):
+    # Constraint matrices of the quantile carving linear problem on the distances x
+    # The unknowns are [u, v, c]: z = u - v + c, with u, v >= 0 the positive and negative residuals and c the carved
+    # profile. Aeq is the equality constraint, A the monotonicity constraint (A [u, v, c] <= 0).
+
+    n = len(x)
+
     ix = range(1, n)
     ixc = range(0, n-1)
 
+    Aeq = scipy.sparse.hstack([scipy.sparse.identity(n), -scipy.sparse.identity(n), scipy.sparse.identity(n)])
+
+    d = 1./(x[ix]-x[ixc])
+
+    Atmp = scipy.sparse.csr_matrix((n, n * 2)) # empty sparse matrix, no dense intermediate
+    Atmp2 = scipy.sparse.coo_matrix((d, (ix, ixc)), shape=(n, n)) - scipy.sparse.coo_matrix((d, (ix, ix)), shape=(n, n))
+    A = scipy.sparse.hstack([Atmp, Atmp2])
+
+    return Aeq, A
+
+
+def _carve(x, z, tau, index_min=0, zmin=None, matrices=None):
+    # Solve the quantile carving linear problem on the profile (x, z)
+    # If zmin is provided, the carved elevation at index_min is constrained to be higher or equal to zmin
+    # The constraint matrices (see _carving_matrices) can be provided, if already built for x
+
+    n = len(x)
+
     f = [tau*np.ones((n, 1)),(1-tau)*np.ones((n, 1)),np.zeros((n, 1))]
     f = np.vstack(f)
 
-    Aeq = scipy.sparse.hstack([scipy.sparse.identity(n), -scipy.sparse.identity(n), scipy.sparse.identity(n)])
+    Aeq, A = matrices if matrices is not None else _carving_matrices(x)
     beq = z
 
     lb = [0.]*(2*n)
     lb.extend([-math.inf]*n)
+    if zmin is not None:
+        lb[2*n + index_min] = zmin
     bounds = [(lower, None) for lower in lb]
 
-    d = 1./(x[ix]-x[ixc])
-
-    Atmp = scipy.sparse.csr_matrix(np.zeros((n, n * 2)))
-    Atmp2 = scipy.sparse.coo_matrix((d, (ix, ixc)), shape=(n, n)) - scipy.sparse.coo_matrix((d, (ix, ix)), shape=(n, n))
-    A = scipy.sparse.hstack([Atmp, Atmp2])
-
     b = np.zeros((n,1))
 
     output = scipy.optimize.linprog(f, A, b, Aeq, beq, bounds=bounds,
                            method='highs', callback=None)
-    newz = output.x[-n:]
-
-    i = 0
-    for cs in datapoints.browse_down_to_up():
-        cs.ztosmooth = newz[i]
-        i+=1
-
-
-
+    count("carving_lp_solves")
+    count("carving_lp_iterations", output.nit)
+    return output.x[-n:]
+
+
+class CarvingSolver():
+    # Quantile carving of profiles on the same distances for several quantiles (tau), e.g. to calibrate the quantile
+    # of a region. The constraint matrices are built once. The quantiles only change the costs of the linear problem:
+    # with highspy, a single HiGHS model is kept and every solve starts from the optimal basis of the previous one
+    # (warm start), which needs a few simplex iterations instead of a full solve. Without highspy, every quantile is
+    # solved with scipy's linprog, still with the matrices built once.
+    # The carved profiles are optimal solutions of the same problem as QuantileCarving, but where the quantile is not
+    # unique (flat parts of the objective), HiGHS can stop on another optimal profile than the one of a cold solve.
+    #
+    #     solver = CarvingSolver(data.get_column('dist'))
+    #     profiles = solver.solve(data.get_column('z_ws'), [0.1, 0.2, 0.3]) # one carved profile per row
+
+    def __init__(self, x, index_min=0, use_highspy=True):
+        # x: distances of the profiles; index_min: index of the point constrained by zmin in solve (if any)
+        self.x = np.asarray(x, dtype=float)
+        self.index_min = index_min
+        self._matrices = _carving_matrices(self.x)
+        self._highs = None
+        if use_highspy and highspy is not None:
+            self._highs = self._build_model()
+
+    def __len__(self):
+        return len(self.x)
+
+    def _build_model(self):
+        n = len(self.x)
+        Aeq, A = self._matrices
+        matrix = scipy.sparse.vstack([Aeq, A]).tocsc()
+        lp = highspy.HighsLp()
+        lp.num_col_ = 3 * n
+        lp.num_row_ = 2 * n
+        lp.col_cost_ = np.zeros(3 * n)
+        lp.col_lower_ = np.concatenate([np.zeros(2 * n), np.full(n, -highspy.kHighsInf)])
+        lp.col_upper_ = np.full(3 * n, highspy.kHighsInf)
+        lp.row_lower_ = np.concatenate([np.zeros(n), np.full(n, -highspy.kHighsInf)])
+        lp.row_upper_ = np.zeros(2 * n)
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = matrix.indptr
+        lp.a_matrix_.index_ = matrix.indices
+        lp.a_matrix_.value_ = matrix.data
+        highs = highspy.Highs()
+        highs.setOptionValue('output_flag', False)
+        highs.passModel(lp)
+        return highs
+
+    def solve(self, z, taus, zmin=None):
+        # Carve the profile z for every quantile of taus, and return the carved profiles as an array (one row per
+        # quantile, in the order of taus)
+        # zmin is the lower bound of the carved elevation at index_min: a single value, one value per quantile, or None
+        z = np.asarray(z, dtype=float)
+        n = len(self.x)
+        if len(z) != n:
+            raise ValueError("The profile does not have the same number of points as the distances")
+        zmins = np.broadcast_to(np.nan if zmin is None else np.asarray(zmin, dtype=float), (len(taus),))
+        profiles = np.empty((len(taus), n))
+        if self._highs is None:
+            for i, tau in enumerate(taus):
+                profiles[i] = _carve(self.x, z, tau, self.index_min, None if np.isnan(zmins[i]) else zmins[i],
+                                     self._matrices)
+            return profiles
+
+        highs = self._highs
+        rows = np.arange(n, dtype=np.int32)
+        highs.changeRowsBounds(n, rows, z, z)
+        residuals = np.arange(2 * n, dtype=np.int32)
+        for i, tau in enumerate(taus):
+            highs.changeColsCost(2 * n, residuals, np.repeat([tau, 1 - tau], n))
+            lower = -highspy.kHighsInf if np.isnan(zmins[i]) else zmins[i]
+            highs.changeColBounds(2 * n + self.index_min, lower, highspy.kHighsInf)
+            highs.run()
+            if highs.getModelStatus() != highspy.HighsModelStatus.kOptimal:
+                raise RuntimeError("Quantile carving failed for tau={}: {}".format(
+                    tau, highs.modelStatusToString(highs.getModelStatus())))
+            count("carving_lp_solves")
+            count("carving_lp_iterations", highs.getInfo().simplex_iteration_count)
+            profiles[i] = np.asarray(highs.getSolution().col_value)[-n:]
+        return profiles
+
+
+@timed_stage
+def QuantileCarvingSweep(datapoints, taus, window_size=None, window_overlap=200):
+    # Same as QuantileCarving for a list of quantiles, with a CarvingSolver (per window when window_size is provided)
+    # Return the carved profiles as an array with one row per quantile; the Databrowser is not modified.
+
+    x = np.asarray(datapoints.get_column('dist'), dtype=float) # double precision, even for single precision columns
+    z = np.asarray(datapoints.get_column('z_ws'), dtype=float)
 
+    n = len(datapoints)
 
+    if window_size is None or n <= window_size:
+        return CarvingSolver(x).solve(z, taus)
 
+    return _carve_by_windows(x, z, window_size, window_overlap,
+                             lambda x, z, index_min, zmin: CarvingSolver(x, index_min).solve(z, taus, zmin))
@@ -2,91 +2,539 @@
 
 # Class to provide a simple interface to manage a list of objects created from a pandas dataframe
 
+import numbers
+import numpy as np
 import pandas as pd
-from rdp import rdp
+from BasicInstrumentation import timed_stage
+
+# Compact storage of the fields (see Databrowser dtypes): the results that are only output, or only used within a
+# cross-section, are stored in single precision, and the flags as categories. The fields carried from one cross-section
+# to the next one by the solvers (distance, smoothed water surface, energy head and slope) remain in double precision.
+COMPACT_DTYPES = {
+    'z_ws': np.float32, 'width': np.float32, 'Q': np.float32, 'ztosmooth': np.float32, 'n': np.float32,
+    'y': np.float32, 'z': np.float32, 'v': np.float32, 'Fr': np.float32, 'ycrit': np.float32, 'R': np.float32,
+    'nfev': np.float32, 'converged': np.float32, 'solver': 'category', 'type': 'category',
+    'y_validation': np.float32, 'ws_validation': np.float32, 'v_validation': np.float32, 'Fr_validation': np.float32,
+    'ycrit_validation': np.float32, 'R_validation': np.float32, 'nfev_validation': np.float32,
+    'converged_validation': np.float32, 'solver_validation': 'category', 'type_validation': 'category',
+}
+
+# Derived fields: fields that are not stored, but computed from other fields when read (see register_derived)
+DERIVED_FIELDS = {} # field: (function, list of the input fields)
+
+
+def register_derived(field, function, inputs):
+    # Register a derived field, computed by function from the fields inputs (e.g. the flow velocity from the depth, the
+    # width and the discharge). function is applied to the values of one point when the field is read on a point
+    # (Dataobj or Section), and to whole columns when the column is read (get_column), so it must work on both.
+    # A derived field is available on the points where its input fields are. A value explicitly set on the field, or
+    # loaded with the data, is stored, and is then used instead of the computed one (see Databrowser.remove_computed).
+    DERIVED_FIELDS[field] = (function, list(inputs))
+
 
 class Databrowser():
-    # This class create a private list of objects from a pandas dataframe (one row = one instance in the list)
-
-    def __init__(self, pandadf):
-        # Create the list and load it with the data from the dataframe
-        self._listobj = []
-        pandadf = pandadf.sort_values(by='dist') # 'dist' is a required column in the dataframe
-        for index, row in pandadf.iterrows():
-            newobj = Dataobj()
-            for field in list(pandadf):
-                setattr(newobj, field, row[field]) # every column of the dataframe is transformed into an attribute
-            self._listobj.append(newobj)
+    # This class stores the data of a pandas dataframe as columns (one NumPy array per field). Rows are accessed through
+    # lightweight views (Dataobj), so that code such as cs.z_smoothed keeps working, while vectorized code can directly
+    # work on the columns (see get_column and set_column).
+    # Every row has a permanent slot in the column arrays, so that a row view stays valid when points are added to the
+    # dataset. As long as the rows are the slots in order, the order of the rows (sorted by distance) is not stored.
+    # Once a point is inserted before the last one, the slots of the rows and their distances are kept in sorted
+    # arrays, where the new points are inserted after a binary search. When a distance is modified, the rows are sorted
+    # again.
+    # A Databrowser can also be a selection of the rows of another one (see select). Both then share the same column
+    # arrays, until one of them modifies a column, which is then copied (copy-on-write).
+    # Numerical fields are stored as float64, unless another floating point type is given for the field in dtypes (e.g.
+    # np.float32, see COMPACT_DTYPES): the values are then rounded when stored, while the computations are still done
+    # in double precision. Fields with the dtype 'category' (e.g. the solver flags) are stored as small integer codes,
+    # the values being decoded when read.
+    # The derived fields (see register_derived) are computed from the stored columns when read, without being stored.
+
+    def __init__(self, pandadf, dtypes=None):
+        # Create the columns and load them with the data from the dataframe
+        # The data is copied, so that the dataframe is not modified through the Databrowser
+        self._load({field: pandadf[field].to_numpy() for field in list(pandadf)}, copy=True, dtypes=dtypes)
+
+    @classmethod
+    def from_columns(cls, columns, dtypes=None):
+        # Create a Databrowser from a dictionary of arrays (e.g. read with BasicColumnIO), without going through a
+        # pandas dataframe. Writable arrays already sorted by distance and of the right type (such as .npy files
+        # memory-mapped in copy-on-write mode) are used as they are, without copy.
+        browser = cls.__new__(cls)
+        browser._load(columns, copy=False, dtypes=dtypes)
+        return browser
+
+    def _load(self, columns, copy, dtypes=None):
+        self._dtypes = dict(dtypes or {})
+        for field, dtype in self._dtypes.items():
+            if dtype != 'category' and np.dtype(dtype).kind != 'f':
+                raise ValueError("Unsupported dtype for {}: {} (floating point types or 'category')".format(field, dtype))
+        self._categories = {} # field: list of the values of the categorical field, by code
+        dist = np.asarray(columns['dist']) # 'dist' is a required column
+        order = None
+        if np.any(dist[1:] < dist[:-1]):
+            order = np.argsort(dist, kind='stable') # points at the same distance keep their order
+        self._nb_slots = len(dist) # number of used slots in the column arrays
+        self._columns = {}
+        for field, values in columns.items():
+            values = np.asarray(values)
+            if self._is_categorical(field):
+                self._categories[field] = []
+                values = self._encode(field, values)
+            elif values.dtype.kind in 'biuf':
+                # every numerical column is stored as float
+                values = values.astype(self._dtypes.get(field, np.float64), copy=False)
+            if order is not None:
+                values = values[order]
+            elif copy:
+                values = values.copy()
+            # Read-only arrays (e.g. memory-mapped in read mode) are copied
+            self._columns[field] = np.require(values, requirements=['W'])
+        self._nb_rows = self._nb_slots
+        self._order = None # slots of the rows sorted by distance (None as long as the rows are the slots in order)
+        self._sorted_dist = None # distances of the rows, in the same order as _order
+        self._unsorted = False # True when a distance was modified since the rows were sorted
+        self._shared = set() # columns shared with other Databrowsers
+        self._input_fields = set(self._columns) # fields loaded with the data (see remove_computed)
+        self._nb_added_points = 0
+        self._caches = {}
 
     def browse_down_to_up(self):
         # Browsing the list from down to up
-        for obj in self._listobj:
-            yield(obj)
+        # The order is copied first, so that points added while browsing are not visited
+        for slot in self._slots():
+            yield Dataobj(self, slot)
 
     def browse_up_to_down(self):
         # Browsing the list from up to down
-        templist = self._listobj.copy()
-        templist.reverse()
-        for obj in templist:
-            yield(obj)
+        for slot in self._slots()[::-1]:
+            yield Dataobj(self, slot)
 
     def get_last_point(self):
         # Return the last point of the list
-        return self._listobj[len(self._listobj)-1]
+        return Dataobj(self, self._slots()[-1])
 
     def get_first_point(self):
         # Return the first point of the list
-        return self._listobj[0]
+        return Dataobj(self, self._slots()[0])
 
     def __len__(self):
-        return len(self._listobj)
+        return self._nb_rows
+
+    def get_nb_added_points(self):
+        # Return the number of points added with add_point (i.e. how much refinement was done on the dataset)
+        return self._nb_added_points
+
+    def get_fields(self, derived=False):
+        # Return the stored fields, followed by the available derived fields if derived is True
+        fields = list(self._columns)
+        if derived:
+            fields.extend(field for field in DERIVED_FIELDS if field not in self._columns and self.has_field(field))
+        return fields
+
+    def get_nbytes(self):
+        # Return the memory used by the column arrays (bytes), by field, and by the order of the rows (key '_order',
+        # only when it is stored, i.e. once points were inserted before the last one)
+        nbytes = {field: column.nbytes for field, column in self._columns.items()}
+        if self._order is not None:
+            nbytes['_order'] = self._order.nbytes + self._sorted_dist.nbytes
+        return nbytes
+
+    def get_codes(self, field):
+        # Return the codes of a categorical field (sorted by distance, -1 for missing values) and the list of its values
+        # by code
+        return self._columns[field][self._rows()], list(self._categories[field])
+
+    def has_field(self, field):
+        # True if the field is stored, or if it is a derived field whose inputs are available
+        if field in self._columns:
+            return True
+        if field in DERIVED_FIELDS:
+            return all(self.has_field(input) for input in DERIVED_FIELDS[field][1])
+        return False
+
+    def remove_field(self, field):
+        # Delete a stored field (if any), e.g. so that a derived field is computed again from its inputs
+        self._columns.pop(field, None)
+        self._shared.discard(field)
+        self._categories.pop(field, None)
+
+    def remove_computed(self, fields):
+        # Delete the stored values of the fields that were set after the data was loaded (e.g. by a previous
+        # computation), so that the derived fields are computed again from their inputs. The fields loaded with the data
+        # are kept.
+        for field in fields:
+            if field not in self._input_fields:
+                self.remove_field(field)
+
+    def get_cache(self, name):
+        # Return a dictionary where data derived from the distances (e.g. Gaussian weight matrices) can be kept with the
+        # Databrowser. The caches are cleared when points are added or when the distances are modified.
+        return self._caches.setdefault(name, {})
+
+    def get_column(self, field):
+        # Return the values of a field, sorted by distance
+        # The returned array is read-only, as it can be a view on the column (when no point was added)
+        if field not in self._columns and field in DERIVED_FIELDS:
+            function, inputs = DERIVED_FIELDS[field]
+            # computed in double precision, even from single precision columns
+            return function(*[np.asarray(self.get_column(input), dtype=float) for input in inputs])
+        rows = self._rows()
+        if field in self._categories:
+            return self._decode(field, self._columns[field][rows])
+        column = self._columns[field][rows]
+        if self._order is None:
+            column.flags.writeable = False # view on the column, no copy needed
+        return column
+
+    def set_column(self, field, values):
+        # Set the values of a field, from an array sorted by distance
+        values = np.asarray(values)
+        column = self._get_writable_column(field, values.dtype.kind in 'biuf')
+        if field in self._categories:
+            values = self._encode(field, values)
+        column[self._rows()] = values
+        if field == 'dist':
+            self._caches.clear()
+            self._sort_rows()
+
+    def reserve(self, nb_points):
+        # Pre-allocate the columns for nb_points additional points
+        needed = self._nb_slots + nb_points
+        if needed > len(self._columns['dist']):
+            self._grow(max(needed, 2 * len(self._columns['dist'])))
+
+    def add_points(self, distances):
+        # Add new points in the list, allocating the space for all of them at once, and return them
+        # The points are inserted in the order of the rows all together, so that the cost of adding many points is
+        # proportional to the number of rows once (and not for every point).
+        distances = np.asarray(distances, dtype=float)
+        self.reserve(len(distances))
+        slots = np.arange(self._nb_slots, self._nb_slots + len(distances))
+        self._nb_slots += len(distances)
+        for field in list(self._columns):
+            column = self._get_writable_column(field, True)
+            column[slots] = self._missing_value(field, column)
+        self._columns['dist'][slots] = distances
+        self._insert_rows(slots, distances)
+        self._nb_added_points += len(distances)
+        self._caches.clear()
+        return [Dataobj(self, slot) for slot in slots]
+
+    def insert_sections(self, sections):
+        # Add in the list the cross-sections (Section objects) computed outside of the Databrowser, with all their
+        # attributes
+        for newobj, section in zip(self.add_points([section.dist for section in sections]), sections):
+            for field, value in vars(section).items():
+                setattr(newobj, field, value)
 
     def add_point(self, distance):
         # Add a new point in the list and return it
-        newobj = Dataobj()
-        newobj.dist = distance
-        self._listobj.append(newobj)
-        self._listobj.sort(key=lambda obj: obj.dist) # the list is sorted again by distance
-        return newobj
+        return self.add_points([distance])[0]
 
-    def topandasdf(self, list_fields):
+    def topandasdf(self, list_fields, copy=True):
         # Export the list into a pandas dataframe
-        list = []
-        for obj in self._listobj:
-            dict = {}
-            for field in list_fields:
-                try:
-                    dict[field] = getattr(obj, field)
-                except AttributeError as e:
-                    dict[field] = None
-            list.append(dict)
-        return pd.DataFrame(list)
+        # The data is copied, so that the dataframe can be modified and is not affected by later changes of the
+        # Databrowser. With copy=False, the dataframe is built on the columns without copying them when the rows are
+        # the slots in order: it is then read-only, and follows the later changes of the columns.
+        data = {}
+        for field in list_fields:
+            if self.has_field(field):
+                data[field] = self.get_column(field)
+            else:
+                data[field] = [None] * len(self)
+        return pd.DataFrame(data, columns=list_fields, copy=copy)
+
+    def select(self, selection):
+        # Return a new Databrowser with only the selected rows (boolean mask or array of row indexes, rows being sorted
+        # by distance). The column arrays are not copied: they are shared until modified.
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            selection = np.flatnonzero(selection)
+        selected = Databrowser.__new__(Databrowser)
+        selected._nb_slots = self._nb_slots
+        selected._columns = dict(self._columns)
+        selected._nb_rows = len(selection)
+        if self._order is None and np.array_equal(selection, np.arange(self._nb_slots)):
+            selected._order = selected._sorted_dist = None
+        else:
+            rows = self._rows()
+            selected._order = (np.arange(self._nb_rows) if self._order is None else rows)[selection]
+            selected._sorted_dist = self._columns['dist'][selected._order]
+        selected._unsorted = False
+        selected._shared = set(self._columns)
+        selected._input_fields = self._input_fields
+        selected._nb_added_points = 0
+        selected._caches = {}
+        selected._dtypes = self._dtypes
+        selected._categories = {field: list(categories) for field, categories in self._categories.items()}
+        self._shared.update(self._columns)
+        return selected
 
+    @timed_stage
     def reduce_bedpoints_RDP(self, epsilon):
         # Reduce the number of points in the list using the Ramer-Douglas-Peucker algorithm
         # Only the points with attribute 'z' are considered
         # The attribute 'z' is required for this function to work
-        list_points = []
-        for obj in self._listobj:
-            list_points.append([obj.dist, obj.z])
-        reduced_points = rdp(list_points, epsilon=epsilon)
-        # Create a new list with only the reduced points
-        newlistobj = []
-        for point in reduced_points:
-            for obj in self._listobj:
-                if obj.dist == point[0] and obj.z == point[1]:
-                    newlistobj.append(obj)
-                    break
-        # Create a new Databrowser instance from the reduced list
-        # Convert newlistobj to a DataFrame
-        if len(newlistobj) == 0:
-            return Databrowser(pd.DataFrame(columns=[field for field in self._listobj[0].__dict__.keys()]))
-        data = []
-        for obj in newlistobj:
-            data.append(obj.__dict__)
-        reduced_df = pd.DataFrame(data)
-        return Databrowser(reduced_df)
+        # Return a new Databrowser sharing the columns of this one (see select)
+        return self.select(rdp_mask(self.get_column('dist'), self.get_column('z'), epsilon))
+
+    def _rows(self):
+        # Slots of the rows sorted by distance, to index the columns: a slice as long as the rows are the slots in order
+        if self._unsorted:
+            self._sort_rows()
+        if self._order is None:
+            return slice(0, self._nb_rows)
+        return self._order[:self._nb_rows]
+
+    def _slots(self):
+        # Slots of the rows sorted by distance, to be iterated (copied, so that it is not modified by added points)
+        rows = self._rows()
+        return range(self._nb_rows) if self._order is None else rows.tolist()
+
+    def _sort_rows(self):
+        # Sort the rows by distance again, after distances were modified. Points at the same distance keep their order.
+        self._unsorted = False
+        if self._order is None:
+            dist = self._columns['dist'][:self._nb_rows]
+            if not np.any(dist[1:] < dist[:-1]):
+                return
+            self._order = np.arange(len(self._columns['dist']))
+            self._sorted_dist = np.empty(len(self._order))
+        rows = self._order[:self._nb_rows]
+        dist = self._columns['dist'][rows]
+        permutation = np.argsort(dist, kind='stable')
+        rows[:] = rows[permutation]
+        self._sorted_dist[:self._nb_rows] = dist[permutation]
+
+    def _insert_rows(self, slots, distances):
+        # Insert the rows of new points (slots) at their positions in the order of the rows, found with a binary search
+        # on the sorted distances. Points at the same distance are kept in insertion order.
+        if len(slots) == 0:
+            return
+        if self._unsorted:
+            self._sort_rows()
+        nb_rows = self._nb_rows
+        self._nb_rows += len(slots)
+        if self._order is None:
+            dist = self._columns['dist']
+            if not np.any(distances[1:] < distances[:-1]) and (nb_rows == 0 or distances[0] >= dist[nb_rows - 1]):
+                return # the rows are still the slots in order
+            self._order = np.arange(nb_rows)
+            self._sorted_dist = dist[:nb_rows].astype(float)
+        if len(slots) == 1 and nb_rows < len(self._order):
+            # One point: the following rows are shifted by one, in the spare room of the arrays
+            position = np.searchsorted(self._sorted_dist[:nb_rows], distances[0], side='right')
+            self._order[position + 1:nb_rows + 1] = self._order[position:nb_rows]
+            self._sorted_dist[position + 1:nb_rows + 1] = self._sorted_dist[position:nb_rows]
+            self._order[position] = slots[0]
+            self._sorted_dist[position] = distances[0]
+            return
+        permutation = np.argsort(distances, kind='stable')
+        positions = np.searchsorted(self._sorted_dist[:nb_rows], distances[permutation], side='right')
+        # Some spare room is kept at the end of the arrays for the points added one by one
+        spare = max(16, self._nb_rows // 8)
+        self._order = np.concatenate([np.insert(self._order[:nb_rows], positions, slots[permutation]),
+                                      np.full(spare, -1)])
+        self._sorted_dist = np.concatenate([np.insert(self._sorted_dist[:nb_rows], positions, distances[permutation]),
+                                            np.full(spare, np.nan)])
+
+    def _get_writable_column(self, field, numeric):
+        # Return the storage array of a field, ready to be modified: the column is created (filled with missing values)
+        # if needed, copied if it is shared with another Databrowser, and converted to object if a non numerical
+        # value is to be stored
+        column = self._get_or_create_column(field, numeric)
+        if field in self._shared:
+            column = self._columns[field] = column.copy()
+            self._shared.discard(field)
+        if not numeric and column.dtype != object and field not in self._categories:
+            column = self._columns[field] = column.astype(object)
+        return column
+
+    def _get_or_create_column(self, field, numeric):
+        # Return the storage array of a field, creating it (filled with missing values) if needed
+        if field not in self._columns:
+            capacity = len(self._columns['dist'])
+            if self._is_categorical(field):
+                self._categories[field] = []
+                self._columns[field] = np.full(capacity, -1, dtype=np.int8)
+            elif numeric:
+                self._columns[field] = np.full(capacity, np.nan, dtype=self._dtypes.get(field, np.float64))
+            else:
+                self._columns[field] = np.full(capacity, None, dtype=object)
+        return self._columns[field]
+
+    def _grow(self, capacity=None):
+        # Increase the capacity of every column (doubled by default)
+        if capacity is None:
+            capacity = max(1, 2 * len(self._columns['dist']))
+        for field, column in self._columns.items():
+            newcolumn = np.full(capacity, self._missing_value(field, column), dtype=column.dtype)
+            newcolumn[:len(column)] = column
+            self._columns[field] = newcolumn
+        self._shared.clear()
+
+    def _get_value(self, field, slot):
+        try:
+            column = self._columns[field]
+        except KeyError:
+            if field in DERIVED_FIELDS:
+                function, inputs = DERIVED_FIELDS[field]
+                return function(*[self._get_value(input, slot) for input in inputs])
+            raise AttributeError(field)
+        if column.dtype == object:
+            return column[slot]
+        if field in self._categories:
+            code = column[slot]
+            return self._categories[field][code] if code >= 0 else None
+        return column.item(slot) # Python float, faster than a NumPy scalar in the scalar solvers
+
+    def _set_value(self, field, slot, value):
+        column = self._get_writable_column(field, isinstance(value, numbers.Number))
+        if field == 'dist' and value != column[slot]:
+            # the rows are sorted again when the order is needed
+            self._unsorted = True
+            self._caches.clear()
+        if field in self._categories:
+            value = self._code(field, value)
+        column[slot] = value
+
+    def _is_categorical(self, field):
+        return self._dtypes.get(field) == 'category'
+
+    def _missing_value(self, field, column):
+        if field in self._categories:
+            return -1
+        return np.nan if column.dtype != object else None
+
+    def _code(self, field, value):
+        # Code of a value of a categorical field, the value being added to the categories if new
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return -1
+        categories = self._categories[field]
+        try:
+            return categories.index(value)
+        except ValueError:
+            if len(categories) == np.iinfo(np.int8).max:
+                raise ValueError("Too many categories for the field " + field)
+            categories.append(value)
+            return len(categories) - 1
+
+    def _encode(self, field, values):
+        # Codes of an array of values of a categorical field
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=True)
+        mapping = np.array([self._code(field, value) for value in uniques] + [-1], dtype=np.int8)
+        return mapping[codes] # the code of the missing values (-1) selects the last element of mapping
+
+    def _decode(self, field, codes):
+        # Values of a categorical field from their codes, as an array of objects
+        values = np.empty(len(self._categories[field]) + 1, dtype=object) # the last element is for the missing values
+        values[:-1] = self._categories[field]
+        return values[codes]
+
 
 class Dataobj():
-    # Empty class that is used by the Databrowser to populate its list
-    pass
+    # View on one row of a Databrowser. Every attribute read or written on the view is read from or written to the
+    # corresponding column of the Databrowser.
+    __slots__ = ('_browser', '_slot')
+
+    def __init__(self, browser, slot):
+        object.__setattr__(self, '_browser', browser)
+        object.__setattr__(self, '_slot', int(slot))
+
+    def __getattr__(self, field):
+        # Only called for the fields, as _browser and _slot are found as regular attributes
+        if field.startswith('__'):
+            raise AttributeError(field)
+        return self._browser._get_value(field, self._slot)
+
+    def __setattr__(self, field, value):
+        self._browser._set_value(field, self._slot, value)
+
+    def __eq__(self, other):
+        return isinstance(other, Dataobj) and self._browser is other._browser and self._slot == other._slot
+
+    def __hash__(self):
+        return hash((id(self._browser), self._slot))
+
+
+class Section():
+    # Empty class for cross-sections that are not (yet) stored in a Databrowser
+    # The derived fields (see register_derived) are computed from the attributes of the section when read.
+
+    def __getattr__(self, field):
+        # Only called for the attributes that are not set
+        if field in DERIVED_FIELDS:
+            function, inputs = DERIVED_FIELDS[field]
+            return function(*[getattr(self, input) for input in inputs])
+        raise AttributeError(field)
+
+
+def rdp_mask(x, y, epsilon):
+    # Ramer-Douglas-Peucker algorithm on the polyline (x, y): return a boolean mask of the points to keep
+    # The recursion of the algorithm is replaced by a stack of the segments still to be processed. For every segment,
+    # the distances of the intermediate points to the segment are computed at once (see _segment_distances).
+    x = np.asarray(x, dtype=float) # computed in double precision, even for single precision columns
+    y = np.asarray(y, dtype=float)
+    npts = len(x)
+    mask = np.zeros(npts, dtype=bool)
+    if npts == 0:
+        return mask
+    mask[0] = mask[-1] = True
+    stack = [(0, npts - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        distances = _segment_distances(x, y, start, end)
+        farthest = np.argmax(distances)
+        if distances[farthest] > epsilon:
+            index = start + 1 + farthest
+            mask[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return mask
+
+
+def _segment_distances(x, y, start, end):
+    # Distances of the intermediate points of the segment (start, end) of the polyline (x, y) to the segment, computed
+    # at once with NumPy (distances to the start point if the segment has a length of 0)
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    px = x[start + 1:end] - x[start]
+    py = y[start + 1:end] - y[start]
+    seglength = np.hypot(dx, dy)
+    if seglength == 0:
+        return np.hypot(px, py)
+    return np.abs(dx * py - dy * px) / seglength
+
+
+def rdp_significance(x, y, min_epsilon=0.):
+    # Significance of every point of the polyline (x, y) in the Ramer-Douglas-Peucker algorithm: the point is kept by
+    # rdp_mask(x, y, epsilon) if and only if its significance is higher than epsilon (the end points have an infinite
+    # significance). All the tolerances are thus given by a single pass.
+    # The segments are split as in rdp_mask, but down to the last point: the significance of the farthest point of a
+    # segment is its distance to the segment, limited to the significance of the point that created the segment.
+    # Segments whose farthest point is not farther than min_epsilon are not split further: the significance of their
+    # intermediate points is then only known to be lower or equal to min_epsilon.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    npts = len(x)
+    significance = np.zeros(npts)
+    if npts == 0:
+        return significance
+    significance[0] = significance[-1] = np.inf
+    stack = [(0, npts - 1, np.inf)]
+    while stack:
+        start, end, parent = stack.pop()
+        if end - start < 2:
+            continue
+        distances = _segment_distances(x, y, start, end)
+        farthest = np.argmax(distances)
+        if distances[farthest] <= min_epsilon:
+            significance[start + 1:end] = np.minimum(distances[farthest], parent)
+            continue
+        index = start + 1 + farthest
+        significance[index] = min(distances[farthest], parent)
+        stack.append((start, index, significance[index]))
+        stack.append((index, end, significance[index]))
+    return significance
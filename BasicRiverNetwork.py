@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# River network made of reaches connected at confluences
+# Every reach is a Databrowser (sorted from downstream to upstream, as usual) and flows into at most one downstream
+# reach: the downstream end of the reach is connected to the upstream end of the downstream reach. Several reaches
+# flowing into the same downstream reach form a confluence.
+# The reaches are processed in topological order (upstream reaches first). Reaches that do not depend on each other
+# (e.g. the tributaries of a confluence) are processed concurrently on a pool of processes.
+#
+#     network = RiverNetwork()
+#     network.add_reach("tributary 1", df_trib1, downstream="main")
+#     network.add_reach("tributary 2", df_trib2, downstream="main")
+#     network.add_reach("main", df_main)
+#     results = execute_network(network, 0.03, 0.00001)
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from BasicWSSmoothing import execute_WSsmoothing
+from BasicBedAssessment import execute_BedAssessment
+from BasicRiverDataStructure import Databrowser
+
+
+class RiverNetwork():
+    # Graph of the reaches: the reaches are the edges, the confluences (and sources and outlets) are the nodes
+
+    def __init__(self):
+        self._reaches = {} # name: Databrowser
+        self._downstream = {} # name: name of the downstream reach (or None for an outlet)
+        self._inflow = {} # name: discharge added to the reach by accumulate_discharge
+
+    def add_reach(self, name, data, downstream=None):
+        # Add a reach (Databrowser or pandas dataframe) flowing into the downstream reach (name)
+        if name in self._reaches:
+            raise ValueError("Reach already in the network: {}".format(name))
+        if isinstance(data, pd.DataFrame):
+            data = Databrowser(data)
+        self._reaches[name] = data
+        self._downstream[name] = downstream
+
+    def get_reach(self, name):
+        return self._reaches[name]
+
+    def set_reach(self, name, data):
+        # Replace the Databrowser of a reach (e.g. by the one processed in another process)
+        # The discharge added by accumulate_discharge is considered to be included in the new Databrowser.
+        self._reaches[name] = data
+
+    def get_downstream(self, name):
+        return self._downstream[name]
+
+    def get_upstream(self, name):
+        # Names of the reaches flowing into the reach
+        return [upstream for upstream, downstream in self._downstream.items() if downstream == name]
+
+    def __len__(self):
+        return len(self._reaches)
+
+    def topological_order(self):
+        # Names of the reaches, every reach being after all the reaches upstream of it
+        for name, downstream in self._downstream.items():
+            if downstream is not None and downstream not in self._reaches:
+                raise ValueError("Unknown downstream reach of {}: {}".format(name, downstream))
+        nb_upstream = {name: len(self.get_upstream(name)) for name in self._reaches}
+        ready = [name for name, nb in nb_upstream.items() if nb == 0]
+        order = []
+        while ready:
+            name = ready.pop()
+            order.append(name)
+            downstream = self._downstream[name]
+            if downstream is not None:
+                nb_upstream[downstream] -= 1
+                if nb_upstream[downstream] == 0:
+                    ready.append(downstream)
+        if len(order) < len(self._reaches):
+            raise ValueError("The river network contains a loop")
+        return order
+
+    def accumulate_discharge(self):
+        # Add to the discharge of every reach the discharge at the downstream end of the reaches upstream of it, so
+        # that the discharge of each reach only has to account for its own drainage area
+        # The discharge added to every reach is recorded and replaced on the next call, so that the discharges are not
+        # accumulated twice when the function is called again (e.g. by execute_network after a manual call).
+        for name in self.topological_order():
+            inflow = sum(self._reaches[upstream].get_first_point().Q for upstream in self.get_upstream(name))
+            previous = self._inflow.get(name, 0.)
+            if inflow != previous:
+                data = self._reaches[name]
+                data.set_column('Q', data.get_column('Q') - previous + inflow)
+                self._inflow[name] = inflow
+
+
+def _process_reach(name, data, manning, min_slope, smoothing_params, upstream_slope, kernel):
+    # Water surface smoothing (if not done yet) and bathymetry assessment of one reach
+    if not data.has_field('z_smoothed'):
+        execute_WSsmoothing(data, **(smoothing_params or {}))
+    execute_BedAssessment(data, manning, min_slope, kernel=kernel, upstream_slope=upstream_slope)
+    return name, data
+
+
+def execute_network(network, manning, min_slope, smoothing_params=None, accumulate_Q=False, workers=None,
+                    kernel=False):
+    # Water surface smoothing and bathymetry assessment of all the reaches of the network
+    # The upstream boundary condition of a reach downstream of a confluence is the energy slope at the downstream end
+    # of its main upstream reach (the one with the largest discharge), instead of the water surface slope at its
+    # upstream end. Reaches without upstream reach keep the usual boundary condition.
+    # If accumulate_Q is True, the discharge of every reach is first increased by the discharge of the reaches upstream
+    # of it (see RiverNetwork.accumulate_discharge).
+    # workers is the number of processes (default: number of CPUs); with workers=1, the reaches are processed one after
+    # the other in the current process.
+    # Return a dictionary of the processed Databrowsers, by reach name (the Databrowsers of the network are replaced by
+    # the processed ones).
+    order = network.topological_order()
+    if accumulate_Q:
+        network.accumulate_discharge()
+
+    def upstream_slope(name):
+        upstreams = network.get_upstream(name)
+        if not upstreams:
+            return None
+        main = max(upstreams, key=lambda upstream: network.get_reach(upstream).get_first_point().Q)
+        return network.get_reach(main).get_first_point().s
+
+    def store(name, data):
+        network.set_reach(name, data)
+        done.add(name)
+
+    done = set()
+    if workers == 1:
+        for name in order:
+            store(*_process_reach(name, network.get_reach(name), manning, min_slope, smoothing_params,
+                                  upstream_slope(name), kernel))
+        return {name: network.get_reach(name) for name in order}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        submitted = set()
+        while len(done) < len(order):
+            # Submit every reach whose upstream reaches are all processed
+            for name in order:
+                if name not in submitted and all(upstream in done for upstream in network.get_upstream(name)):
+                    pending.add(executor.submit(_process_reach, name, network.get_reach(name), manning, min_slope,
+                                                smoothing_params, upstream_slope(name), kernel))
+                    submitted.add(name)
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                store(*future.result())
+    return {name: network.get_reach(name) for name in order}
@@ -6,31 +6,84 @@ g = 9.81
 import warnings
 warnings.simplefilter("ignore", RuntimeWarning)
 
+import numpy as np
 from scipy.optimize import fsolve
 from scipy.optimize import minimize
 from scipy.optimize import minimize_scalar
-
-def manning_inversesolver(cs):
-    # This function solves Manning's equation
-    # Inverse problem version (i.e. given ws, find z)
+from scipy.optimize import brentq
+from scipy.optimize import OptimizeResult
+from BasicInstrumentation import count
+from BasicRiverDataStructure import register_derived
+
+# Hydraulic fields derived from the flow depth, the width, the discharge and the elevations. They are not stored by the
+# solvers, but computed when read (see register_derived), with the same operations as the solvers.
+register_derived('R', lambda y, width: (width * y) / (width + 2 * y), ['y', 'width'])
+register_derived('v', lambda y, width, Q: Q / (width * y), ['y', 'width', 'Q'])
+register_derived('ycrit', lambda width, Q: (Q / (width * g ** 0.5)) ** (2. / 3.), ['width', 'Q'])
+register_derived('h', lambda z_smoothed, y, width, Q: z_smoothed + (Q / (width * y)) ** 2 / (2 * g), # add kinetic energy
+                 ['z_smoothed', 'y', 'width', 'Q'])
+register_derived('Fr', lambda y, width, Q: (Q / (width * y)) / (g * y) ** 0.5, ['y', 'width', 'Q'])
+HYDRAULIC_FIELDS = ['R', 'v', 'ycrit', 'h', 'Fr']
+# Same fields for the validation (direct problem), where the water surface is computed from the bed elevation z
+register_derived('R_validation', lambda y, width: (width * y) / (width + 2 * y), ['y_validation', 'width'])
+register_derived('v_validation', lambda y, width, Q: Q / (width * y), ['y_validation', 'width', 'Q'])
+register_derived('ycrit_validation', lambda width, Q: (Q / (width * g ** 0.5)) ** (2. / 3.), ['width', 'Q'])
+register_derived('h_validation', lambda z, y, width, Q: (z + y) + (Q / (width * y)) ** 2 / (2 * g),
+                 ['z', 'y_validation', 'width', 'Q'])
+register_derived('Fr_validation', lambda y, width, Q: (Q / (width * y)) / (g * y) ** 0.5,
+                 ['y_validation', 'width', 'Q'])
+VALIDATION_FIELDS = ['R_validation', 'v_validation', 'ycrit_validation', 'h_validation', 'Fr_validation']
+
+def manning_normaldepth(Q, width, n, s, tol=1e-10, maxiter=50):
+    # Normal depth in a rectangular channel, i.e. the flow depth y so that Manning's equation gives the discharge Q
+    # All the parameters can be arrays (e.g. the boundary conditions of many reaches), so that all the depths are
+    # computed at once.
+    # Newton's method is applied to log(Q(y)) - log(Q), using the analytic derivative:
+    #     Q(y) = sqrt(s)/n * A^(5/3) / P^(2/3), with A = width*y and P = width + 2y
+    #     dlog(Q(y))/dy = 5/(3y) - 4/(3P)
+    # log(Q(y)) is concave, so starting from the wide channel depth (R = y), which is lower than the solution, the
+    # iterations increase monotonically towards the solution.
+    # Return the depths and the number of iterations done for each depth (as arrays, even for a single depth).
+    Q, width, n, s = np.broadcast_arrays(*[np.atleast_1d(np.asarray(value, dtype=float)) for value in (Q, width, n, s)])
+    y = (Q * n / (width * s ** 0.5)) ** (3. / 5.) # wide channel approximation
+    iterations = np.zeros(y.shape, dtype=int)
+    active = np.ones(y.shape, dtype=bool)
+    for _ in range(maxiter):
+        P = width + 2 * y
+        logQ_y = 0.5 * np.log(s) - np.log(n) + 5. / 3. * np.log(width * y) - 2. / 3. * np.log(P)
+        step = (logQ_y - np.log(Q)) / (5. / (3. * y) - 4. / (3. * P))
+        step[~active] = 0.
+        y = y - step
+        iterations[active] += 1
+        active &= np.abs(step) > tol * y
+        if not np.any(active):
+            break
+    return y, iterations
+
+
+def manning_normaldepth_fsolve(Q, width, n, s):
+    # Reference version of manning_normaldepth for a single depth, using fsolve from a fixed start of 1 m
 
     def equations(y): # the equation to solve, as a python function
         # For a given flow depth y, the difference between the resultant discharge and the known discharge is computed
         # This function is used by fsolve, that tries to find y so that difQ = 0
-        R = (cs.width * y) / (cs.width + 2 * y)
-        difQ = (y * cs.width * R ** (2. / 3.) * cs.s ** 0.5) / cs.n - cs.Q
+        R = (width * y) / (width + 2 * y)
+        difQ = (y * width * R ** (2. / 3.) * s ** 0.5) / n - Q
         return difQ
 
-    cs.y = fsolve(equations, 1)[0] # Solve the manning equation (find y so that difQ = 0)
-    cs.R = (cs.width * cs.y) / (cs.width + 2 * cs.y)
-    cs.ycrit = (cs.Q / (cs.width * g ** 0.5)) ** (2. / 3.)
+    return fsolve(equations, 1)[0] # Solve the manning equation (find y so that difQ = 0)
 
-    cs.v = cs.Q / (cs.width * cs.y)
-    cs.z = cs.z_smoothed - cs.y
-    cs.h = cs.z_smoothed
 
-    cs.h = cs.h + cs.v ** 2 / (2 * g) # add kinetic energy
-    cs.Fr = cs.v / (g * cs.y) ** 0.5
+def manning_inversesolver(cs):
+    # This function solves Manning's equation
+    # Inverse problem version (i.e. given ws, find z)
+
+    y, iterations = manning_normaldepth(cs.Q, cs.width, cs.n, cs.s)
+    cs.y = y.item()
+    count("manning_solver_calls")
+    count("manning_solver_iterations", iterations.item())
+    cs.z = cs.z_smoothed - cs.y
+    # R, ycrit, v, h and Fr are derived from y (see HYDRAULIC_FIELDS)
 
 
 def cs_inversesolver(cs_up, cs_down, min_slope):
@@ -46,46 +99,51 @@ def cs_inversesolver(cs_up, cs_down, min_slope):
     else:
         h_ref = cs_up.h
 
+    # The values used by equations are copied, so that the function does not keep a reference to the cross-section
+    # (scipy's brentq creates a reference cycle on the function, which would keep the whole Databrowser in memory until
+    # the next garbage collection)
+    width, Q, n, z_smoothed = cs_down.width, cs_down.Q, cs_down.n, cs_down.z_smoothed
+
     # the solver starts at y = y_crit
-    cs_down.ycrit = (cs_down.Q / (cs_down.width * g ** 0.5)) ** (2. / 3.)
+    ycrit = (Q / (width * g ** 0.5)) ** (2. / 3.)
 
     def equations(y): # the equation to solve, as a python function
         # For a given flow depth y, the difference between the resultant energy (potential energy, i.e. water surface
         # elevation, plus kinetic energy, plus energy loss by friction) and the energy computed upstream is computed.
-        # This function is used by fsolve, that tries to find y so that dif_energy = 0
-
-        if y < cs_down.ycrit:
-            # constraint computation, so that the flow is never supercritical
-            return float('inf')
-        R = (cs_down.width * y) / (cs_down.width + 2 * y)
-        v = cs_down.Q / (cs_down.width * y)
-        s = (cs_down.n ** 2 * v ** 2) / (R ** (4. / 3.))
-        h = cs_down.z_smoothed
+        # This function is used by _solve_subcritical, that tries to find y >= ycrit so that dif_energy = 0
+        # dif_energy decreases when y increases (the water surface elevation is known, so both the kinetic energy and
+        # the friction decrease)
+        R = (width * y) / (width + 2 * y)
+        v = Q / (width * y)
+        s = (n ** 2 * v ** 2) / (R ** (4. / 3.))
+        h = z_smoothed
         h = h + v ** 2 / (2 * g) # add kinetic energy
         # slope calculation:
         #friction_h = localdist * (s+cs_up.s)/2. # Friction can't be based on the average of slope, it leads to impossible to resolve cases
         friction_h = localdist * s # Replaced by a friction based and the downstream computed slope
         dif_energy = friction_h + h - h_ref
-        dif_energy = abs(dif_energy)
         return dif_energy
 
 
     #res, dict, ier, msg = fsolve(equations, cs_down.ycrit, full_output=True)
     #res = minimize(equations, cs_down.ycrit, method='Nelder-Mead', options={'xatol': 1e-3})
-    res = minimize_scalar(equations, method='brent', tol=1e-3)
+    #res = minimize_scalar(equations, method='brent', tol=1e-3)
+    res = _solve_subcritical(equations, ycrit)
 
     #cs_down.y = res.x[0]
     cs_down.y = res.x
-    cs_down.R = (cs_down.width * cs_down.y) / (cs_down.width + 2 * cs_down.y)
-    cs_down.v = cs_down.Q / (cs_down.width * cs_down.y)
-    cs_down.z = cs_down.z_smoothed - cs_down.y
-    cs_down.s = (cs_down.n ** 2 * cs_down.v ** 2) / (cs_down.R ** (4. / 3.))
-
-    cs_down.h = cs_down.z_smoothed
-
-    cs_down.h = cs_down.h + cs_down.v ** 2 / (2 * g) # add kinetic energy
-
-    cs_down.Fr = cs_down.v / (g * cs_down.y) ** 0.5
+    cs_down.nfev = res.nfev
+    cs_down.converged = res.success
+    count("cs_inversesolver_calls")
+    count("cs_inversesolver_evals", res.nfev)
+    if not res.success:
+        count("cs_inversesolver_not_converged")
+    y = cs_down.y
+    R = (width * y) / (width + 2 * y)
+    v = Q / (width * y)
+    cs_down.z = z_smoothed - y
+    cs_down.s = (n ** 2 * v ** 2) / (R ** (4. / 3.))
+    # R, ycrit, v, h and Fr are derived from y (see HYDRAULIC_FIELDS)
 
     return res
 
@@ -95,23 +153,12 @@ def manning_normalsolver(cs):
     # This function solves Manning's equation
     # Normal problem version (i.e. given z, find ws)
 
-    def equations(y): # the equation to solve, as a python function
-        # For a given flow depth y, the difference between the resultant discharge and the known discharge is computed
-        # This function is used by fsolve, that tries to find y so that difQ = 0
-        R = (cs.width * y) / (cs.width + 2 * y)
-        difQ = (y * cs.width * R ** (2. / 3.) * cs.s_validation ** 0.5) / cs.n - cs.Q
-        return difQ
-
-    cs.y_validation = fsolve(equations, 1)[0] # Solve the manning equation (find y so that difQ = 0)
-    cs.R_validation = (cs.width * cs.y_validation) / (cs.width + 2 * cs.y_validation)
-    cs.ycrit_validation = (cs.Q / (cs.width * g ** 0.5)) ** (2. / 3.)
-
-    cs.v_validation = cs.Q / (cs.width * cs.y_validation)
+    y, iterations = manning_normaldepth(cs.Q, cs.width, cs.n, cs.s_validation)
+    cs.y_validation = y.item()
+    count("manning_solver_calls")
+    count("manning_solver_iterations", iterations.item())
     cs.ws_validation = cs.z + cs.y_validation
-    cs.h_validation = cs.ws_validation
-
-    cs.h_validation = cs.h_validation + cs.v_validation ** 2 / (2 * g) # add kinetic energy
-    cs.Fr_validation = cs.v_validation / (g * cs.y_validation) ** 0.5
+    # R, ycrit, v, h and Fr are derived from y_validation (see VALIDATION_FIELDS)
 
 
 def cs_normalsolver(cs_up, cs_down):
@@ -123,45 +170,71 @@ def cs_normalsolver(cs_up, cs_down):
 
     h_ref = cs_down.h_validation
 
+    # Copied values, as in cs_inversesolver
+    width, Q, n, z = cs_up.width, cs_up.Q, cs_up.n, cs_up.z
+
     # the solver starts at y = y_crit
-    cs_up.ycrit_validation = (cs_up.Q / (cs_up.width * g ** 0.5)) ** (2. / 3.)
+    ycrit = (Q / (width * g ** 0.5)) ** (2. / 3.)
 
     def equations(y): # the equation to solve, as a python function
         # For a given flow depth y, the difference between the resultant energy (potential energy, i.e. water surface
         # elevation, plus kinetic energy, plus energy loss by friction) and the energy computed upstream is computed.
-        # This function is used by fsolve, that tries to find y so that dif_energy = 0
-
-        if y < cs_up.ycrit_validation:
-            # constraint computation, so that the flow is never supercritical
-            return float("inf")
-        R = (cs_up.width * y) / (cs_up.width + 2 * y)
-        v = cs_up.Q / (cs_up.width * y)
-        s = (cs_up.n ** 2 * v ** 2) / (R ** (4. / 3.))
-        h = cs_up.z + y
+        # This function is used by _solve_subcritical, that tries to find y >= ycrit so that dif_energy = 0
+        # dif_energy decreases when y increases (above the critical depth, the specific energy increases with y, and
+        # the friction decreases)
+        R = (width * y) / (width + 2 * y)
+        v = Q / (width * y)
+        s = (n ** 2 * v ** 2) / (R ** (4. / 3.))
+        h = z + y
         h = h + v ** 2 / (2 * g) # add kinetic energy
         # slope calculation:
         #friction_h = localdist * (s+cs_up.s)/2. # Friction can't be based on the average of slope, it leads to impossible to resolve cases
         friction_h = localdist * s # Replaced by a friction based and the downstream computed slope
         dif_energy = friction_h + h_ref - h
-        dif_energy = abs(dif_energy)
         return dif_energy
 
     #res = minimize(equations, cs_down.ycrit, method='Nelder-Mead', options={'xatol': 1e-3})
-    res = minimize_scalar(equations, method='brent', tol=1e-3)
+    #res = minimize_scalar(equations, method='brent', tol=1e-3)
+    res = _solve_subcritical(equations, ycrit)
 
     #cs_up.y_validation = res.x[0]
     cs_up.y_validation = res.x
-    cs_up.R_validation = (cs_up.width * cs_up.y_validation) / (cs_up.width + 2 * cs_up.y_validation)
-    cs_up.v_validation = cs_up.Q / (cs_up.width * cs_up.y_validation)
-    cs_up.ws_validation = cs_up.z + cs_up.y_validation
-    cs_up.s_validation = (cs_up.n ** 2 * cs_up.v_validation ** 2) / (cs_up.R_validation ** (4. / 3.))
-
-    cs_up.h_validation = cs_up.ws_validation
-
-    cs_up.h_validation = cs_up.h_validation + cs_up.v_validation ** 2 / (2 * g) # add kinetic energy
-
-    cs_up.Fr_validation = cs_up.v_validation / (g * cs_up.y_validation) ** 0.5
+    cs_up.nfev_validation = res.nfev
+    cs_up.converged_validation = res.success
+    count("cs_normalsolver_calls")
+    count("cs_normalsolver_evals", res.nfev)
+    if not res.success:
+        count("cs_normalsolver_not_converged")
+    y = cs_up.y_validation
+    R = (width * y) / (width + 2 * y)
+    v = Q / (width * y)
+    cs_up.ws_validation = z + y
+    cs_up.s_validation = (n ** 2 * v ** 2) / (R ** (4. / 3.))
+    # R, ycrit, v, h and Fr are derived from y_validation (see VALIDATION_FIELDS)
 
     return res
 
 
+def _solve_subcritical(equations, ycrit, xtol=1e-6, max_expansions=60):
+    # Find the subcritical flow depth y >= ycrit so that equations(y) = 0, equations being a decreasing function of y.
+    # The root is first bracketed between ycrit and an upper bound (doubled until equations changes sign), then found
+    # with Brent's method.
+    # If equations(ycrit) < 0, there is no subcritical solution: the critical depth is returned and the solution is
+    # flagged as not converged (success = False). nfev is the number of evaluations of equations.
+    y_low = ycrit
+    dif_low = equations(y_low)
+    nfev = 1
+    if dif_low <= 0:
+        return OptimizeResult(x=y_low, nfev=nfev, success=dif_low == 0)
+    y_high = max(2 * ycrit, 1e-3)
+    for _ in range(max_expansions):
+        dif_high = equations(y_high)
+        nfev += 1
+        if dif_high <= 0:
+            break
+        y_low = y_high
+        y_high = 2 * y_high
+    else:
+        return OptimizeResult(x=y_high, nfev=nfev, success=False)
+    y, root_results = brentq(equations, y_low, y_high, xtol=xtol, full_output=True, disp=False)
+    return OptimizeResult(x=y, nfev=nfev + root_results.function_calls, success=root_results.converged)
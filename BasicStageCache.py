@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the results of the processing stages
+# The results of a stage are stored in a .npz file named after a hash of the input arrays of the stage and of its
+# parameters, so that a reach run again with the same inputs and parameters (e.g. with only another RDP epsilon) reuses
+# the carved and smoothed profiles and the bed profile instead of recomputing them.
+# The total size of the cache is bounded: the least recently used files are deleted when it is exceeded.
+#
+#     cache = StageCache("cache_folder", max_size=1e9)
+#     cached_WSsmoothing(data, cache)
+#     cached_BedAssessment(data, 0.03, 0.00001, cache)
+#
+# Several processes can share the same cache folder: files are written to a temporary file first, then renamed.
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from BasicWSSmoothing import execute_WSsmoothing, DIAGNOSTIC_FIELDS
+from BasicBedAssessment import execute_BedAssessment
+from BasicSolverDirect import HYDRAULIC_FIELDS
+from BasicColumnIO import _numbers_as_objects, _objects_to_float
+from BasicInstrumentation import count
+
+CACHE_VERSION = 3 # to be increased when the results of a stage change, so that the previous results are not reused
+
+
+class StageCache():
+    # Cache of stage results in a folder, with a maximum total size (bytes)
+
+    def __init__(self, folder, max_size=1e9):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, stage, arrays, params):
+        # Hash of the stage name, of the input arrays (dictionary of arrays) and of the parameters (dictionary)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([CACHE_VERSION, stage, params], sort_keys=True, default=repr).encode())
+        for name in sorted(arrays):
+            values = np.ascontiguousarray(arrays[name])
+            digest.update("{}:{}:{}".format(name, values.dtype.str, values.shape).encode())
+            digest.update(values.tobytes())
+        return stage + "_" + digest.hexdigest()
+
+    def get(self, key):
+        # Return the arrays stored for key (dictionary), or None if they are not in the cache
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as file:
+                arrays = {name: file[name] for name in file.files}
+            os.utime(path) # the modification time is used as the time of last use
+        except (OSError, ValueError, EOFError):
+            # Not in the cache, or deleted (or being written) by another process
+            count("cache_misses")
+            return None
+        count("cache_hits")
+        return _decode(arrays)
+
+    def put(self, key, arrays):
+        # Store the arrays (dictionary) for key, then delete the least recently used files if the cache is too large
+        handle, temppath = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez(file, **_encode(arrays))
+            os.replace(temppath, self._path(key))
+        except BaseException:
+            os.remove(temppath)
+            raise
+        self.evict()
+
+    def evict(self):
+        # Delete the least recently used files until the total size is below max_size
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                count("cache_evictions")
+            except OSError:
+                pass
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".npz")
+
+
+def _encode(arrays):
+    # Columns of objects (e.g. the solver flags) are stored as strings, along with a mask of the missing values, so that
+    # the files can be read without pickle
+    encoded = {}
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        if values.dtype == object and _numbers_as_objects(values):
+            # Numbers stored as objects (e.g. categorical fields, see Databrowser) are stored as floats
+            encoded[name] = _objects_to_float(values)
+        elif values.dtype == object:
+            missing = np.array([value is None for value in values], dtype=bool)
+            encoded["obj:" + name] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+            encoded["none:" + name] = missing
+        else:
+            encoded[name] = values
+    return encoded
+
+
+def _decode(arrays):
+    decoded = {}
+    for name, values in arrays.items():
+        if name.startswith("obj:"):
+            name = name[4:]
+            values = values.astype(object)
+            values[arrays["none:" + name]] = None
+        elif name.startswith("none:"):
+            continue
+        decoded[name] = values
+    return decoded
+
+
+WS_OUTPUT_FIELDS = ('ztosmooth', 'z_smoothed') + tuple(DIAGNOSTIC_FIELDS)
+
+
+def cached_WSsmoothing(datapoints, cache, **params):
+    # Same as execute_WSsmoothing (quantile carving and smoothing), the results being read from the cache if available
+    if cache is None:
+        return execute_WSsmoothing(datapoints, **params)
+    key = cache.key("WSsmoothing", {field: datapoints.get_column(field) for field in ('dist', 'z_ws')}, params)
+    results = cache.get(key)
+    if results is None:
+        previous_fields = set(datapoints.get_fields()) - set(WS_OUTPUT_FIELDS)
+        execute_WSsmoothing(datapoints, **params)
+        # All the fields added by the smoothing are stored, including the diagnostics
+        cache.put(key, {field: datapoints.get_column(field) for field in datapoints.get_fields()
+                        if field not in previous_fields})
+    else:
+        for field, values in results.items():
+            datapoints.set_column(field, values)
+
+
+BED_INPUT_FIELDS = ('dist', 'z_smoothed', 'width', 'Q')
+
+
+def cached_BedAssessment(datapoints, manning, min_slope, cache, **params):
+    # Same as execute_BedAssessment, the results (including the added cross-sections) being read from the cache if
+    # available
+    if cache is None:
+        return execute_BedAssessment(datapoints, manning, min_slope, **params)
+    key = cache.key("BedAssessment", {field: datapoints.get_column(field) for field in BED_INPUT_FIELDS},
+                    dict(params, manning=manning, min_slope=min_slope))
+    results = cache.get(key)
+    if results is None:
+        previous_fields = set(datapoints.get_fields()) - set(BED_INPUT_FIELDS)
+        execute_BedAssessment(datapoints, manning, min_slope, **params)
+        # The fields not used by the bathymetry assessment (e.g. z_ws) are not stored: they are missing on the added
+        # cross-sections and unchanged on the other ones
+        cache.put(key, {field: datapoints.get_column(field) for field in datapoints.get_fields()
+                        if field not in previous_fields})
+    else:
+        # As in execute_BedAssessment, the values of the derived fields stored by a previous computation are deleted
+        datapoints.remove_computed(HYDRAULIC_FIELDS)
+        added = results['type'] == 3
+        datapoints.add_points(results['dist'][added].tolist())
+        for field, values in results.items():
+            datapoints.set_column(field, values)
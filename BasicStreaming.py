@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# Streaming version of the processing, for reaches too long to be held in memory
+# Every stage is a generator consuming and yielding blocks of points (dictionaries of arrays, each block being sorted
+# by distance, from downstream to upstream), and keeping only the points it still needs:
+# - stream_carving: quantile carving by windows (as QuantileCarving with window_size), keeping the overlap of the
+#   windows and the carved elevation at the last seam
+# - stream_smoothing: smoothing of the carved profile (as smooth_profile), keeping the points within the truncated
+#   Gaussian curves (distance halo), the standard deviation of the last smoothed point and the last smoothed elevation
+# - stream_bedassessment: bathymetry assessment, which goes from upstream to downstream: the blocks are first spilled to
+#   the disk (as .npy column bundles), then read back from upstream to downstream, the last solved cross-section of a
+#   block being the upstream condition of the next one (see the restart_from option of execute_BedAssessment)
+# The memory used then depends on the block size and on the halos, not on the length of the reach. The results are
+# identical to the ones of execute_WSsmoothing (with carving_window_size) and execute_BedAssessment.
+#
+#     blocks = iter_blocks(read_columns("reach"), 100000)
+#     for block in execute_streaming(blocks, 0.03, 0.00001):
+#         writer.write(block, reach="reach")
+#
+# The RDP reduction and the validation are not available in streaming mode.
+
+import logging
+import os
+import tempfile
+from itertools import chain
+
+import numpy as np
+
+from BasicQuantileRegression import _carve
+from BasicWSSmoothing import PDF_UNDERFLOW_SIGMAS, MIN_CORRECTION, split_smoothing_params, _local_sigma, \
+    _corrections, _slope_term, _uncertainty, _restrict_point, _weighted_values, _monotonic_value
+from BasicBedAssessment import execute_BedAssessment
+from BasicRiverDataStructure import Databrowser
+from BasicColumnIO import read_columns, write_columns
+from BasicInstrumentation import count
+
+logger = logging.getLogger(__name__)
+
+
+def iter_blocks(columns, block_size):
+    # Split a dictionary of arrays (e.g. memory-mapped by read_columns) in blocks of block_size points
+    npts = len(columns['dist'])
+    for start in range(0, npts, block_size):
+        yield {field: np.asarray(values[start:start + block_size]) for field, values in columns.items()}
+
+
+def rechunk(blocks, block_size):
+    # Regroup a stream of blocks of any size in blocks of block_size points (except the last one)
+    pending = []
+    nb_pending = 0
+    for block in blocks:
+        pending.append(block)
+        nb_pending += len(block['dist'])
+        while nb_pending >= block_size:
+            merged = _concatenate(pending)
+            yield _slice(merged, 0, block_size)
+            pending = [_slice(merged, block_size, nb_pending)]
+            nb_pending -= block_size
+    if nb_pending > 0:
+        yield _concatenate(pending)
+
+
+def _concatenate(blocks):
+    if len(blocks) == 1:
+        return blocks[0]
+    return {field: np.concatenate([block[field] for block in blocks]) for field in blocks[0]}
+
+
+def _slice(block, start, end):
+    return {field: values[start:end] for field, values in block.items()}
+
+
+def stream_carving(blocks, tau=0.2, window_size=10000, window_overlap=200):
+    # Quantile carving of a stream of blocks (see QuantileCarving): add the field 'ztosmooth'
+    buffer = None
+    base = 0 # index (in the whole reach) of the first point of the buffer
+    seam = 0 # index of the first point of the next window
+    zmin = None
+    ended = False
+    for block in chain(blocks, [None]):
+        if block is None:
+            ended = True
+        else:
+            buffer = block if buffer is None else _concatenate([buffer, block])
+        if buffer is None:
+            return
+        while True:
+            nb_available = base + len(buffer['dist'])
+            end = seam + window_size
+            if not ended and nb_available < end + window_overlap:
+                break
+            end = min(end, nb_available)
+            if seam >= end:
+                break
+            first = max(seam - window_overlap, 0)
+            last = min(end + window_overlap, nb_available)
+            windowz = _carve(buffer['dist'][first - base:last - base], buffer['z_ws'][first - base:last - base], tau,
+                             seam - first, zmin)
+            output = _slice(buffer, seam - base, end - base)
+            output['ztosmooth'] = windowz[seam - first:end - first]
+            zmin = output['ztosmooth'][-1]
+            yield output
+            seam = end
+            # Only the overlap of the next window is kept
+            keep = max(seam - window_overlap, 0)
+            buffer = _slice(buffer, keep - base, nb_available - base)
+            base = keep
+
+
+def stream_smoothing(blocks, smooth_level=600, uncertainty_sigma=300, uncertainty_factor=0.85, slope_sigma=300,
+                     slope_factor=2.0, gaussian_truncation=8., history=None):
+    # Smoothing of a stream of carved blocks (see smooth_profile): add the field 'z_smoothed'
+    # The restriction of a Gaussian curve depends on the points upstream of it, up to the distance where the densities
+    # underflow: history is the distance kept for it (default: enough for Gaussian curves up to 5 times smooth_level).
+    # A warning is logged if a curve needs more.
+    if history is None:
+        history = PDF_UNDERFLOW_SIGMAS * 5 * smooth_level
+    halo = gaussian_truncation * max(uncertainty_sigma, slope_sigma)
+    buffer = None
+    base = 0 # index (in the whole reach) of the first point of the buffer
+    p_uncertainty = p_sd2 = p_average = 0 # indexes (in the buffer) of the next points of every step
+    trimmed = False
+    first_dist = None
+    sd2 = None # standard deviation of the last smoothed point
+    last_smoothed = None
+    ended = False
+
+    def warn_history(needed_dist):
+        if trimmed and needed_dist < buffer['dist'][0]:
+            logger.warning("stream_smoothing: history too short (%g m missing)", buffer['dist'][0] - needed_dist)
+            count("stream_history_exceeded")
+
+    for block in chain(blocks, [None]):
+        if block is None:
+            ended = True
+        else:
+            block = dict(block)
+            for field in ('corrections', 'uncertainty', 'local_sigma', 'sd2', 'weighted_values'):
+                block[field] = np.full(len(block['dist']), np.nan)
+            buffer = block if buffer is None else _concatenate([buffer, block])
+            if first_dist is None:
+                first_dist = buffer['dist'][0]
+        if buffer is None:
+            return
+        dist = buffer['dist']
+        values = buffer['ztosmooth']
+        npts = len(dist)
+
+        # Uncertainty of the points whose Gaussian curves are entirely in the buffer
+        ready = npts if ended else np.searchsorted(dist, dist[-1] - halo, side='left')
+        if ready > p_uncertainty:
+            centers = np.arange(p_uncertainty, ready)
+            warn_history(dist[p_uncertainty] - halo)
+            abs_carving = np.abs(buffer['z_ws'] - values)
+            corrections = _corrections(dist, abs_carving, centers, uncertainty_sigma, uncertainty_factor,
+                                       gaussian_truncation)
+            smoothed = corrections >= MIN_CORRECTION
+            slope_term = _slope_term(dist, values, centers[smoothed], slope_sigma, gaussian_truncation)
+            uncertainty = np.zeros(len(centers))
+            uncertainty[smoothed] = _uncertainty(corrections[smoothed], slope_term, slope_factor)
+            buffer['corrections'][centers] = corrections
+            buffer['uncertainty'][centers] = uncertainty
+            buffer['local_sigma'][centers] = _local_sigma(dist[centers], first_dist, smooth_level)
+            p_uncertainty = ready
+
+        # Standard deviations, from downstream to upstream
+        for i in range(p_sd2, p_uncertainty):
+            if not buffer['corrections'][i] >= MIN_CORRECTION:
+                buffer['sd2'][i] = 0.
+                continue
+            if base + i > 0:
+                sd1 = sd2 # sd1 is the previous sd2
+                initial_sd2 = buffer['uncertainty'][i] * buffer['local_sigma'][i]
+                # Only the points where the Gaussian curve does not underflow can restrict it
+                warn_history(dist[i] - PDF_UNDERFLOW_SIGMAS * initial_sd2)
+                sd2, restricted, method = _restrict_point(dist, i, sd1, initial_sd2)
+                if method is not None:
+                    count("restricted_" + method)
+            else:
+                sd2 = buffer['uncertainty'][i] * buffer['local_sigma'][i]
+            buffer['sd2'][i] = sd2
+        p_sd2 = p_uncertainty
+
+        # Weighted averages of the points whose Gaussian curves are entirely in the buffer
+        sd2_vec = buffer['sd2'][p_average:p_sd2]
+        ready = np.ones(len(sd2_vec), dtype=bool) if ended else dist[p_average:p_sd2] + gaussian_truncation * sd2_vec < dist[-1]
+        nb_ready = len(ready) if np.all(ready) else np.argmin(ready)
+        if nb_ready > 0:
+            centers = np.arange(p_average, p_average + nb_ready)
+            smoothed_mask = buffer['corrections'][centers] >= MIN_CORRECTION
+            smoothed = centers[smoothed_mask]
+            if len(smoothed) > 0:
+                warn_history(np.min(dist[smoothed] - gaussian_truncation * buffer['sd2'][smoothed]))
+            weighted = values[centers].copy()
+            weighted[smoothed_mask] = _weighted_values(dist, values, smoothed, buffer['sd2'][smoothed],
+                                                       gaussian_truncation)
+            buffer['weighted_values'][centers] = weighted
+
+            # The smoothed values can not be lower than the previous ones
+            smoothed_values = np.empty(len(centers))
+            for k in range(len(centers)):
+                smoothed_values[k], corrected = _monotonic_value(weighted[k], smoothed_mask[k], last_smoothed)
+                if corrected:
+                    count("monotonic_corrections")
+                last_smoothed = smoothed_values[k]
+            output = {field: buffer[field][centers] for field in buffer
+                      if field not in ('corrections', 'uncertainty', 'local_sigma', 'sd2', 'weighted_values')}
+            output['z_smoothed'] = smoothed_values
+            yield output
+            p_average += nb_ready
+
+        # Points that are not needed anymore
+        keep = min(np.searchsorted(dist, dist[min(p_uncertainty, npts - 1)] - halo, side='left'),
+                   np.searchsorted(dist, dist[min(p_sd2, npts - 1)] - history, side='left'), p_average)
+        if p_average < p_sd2:
+            keep = min(keep, np.searchsorted(dist, np.min(dist[p_average:p_sd2] - gaussian_truncation *
+                                                          buffer['sd2'][p_average:p_sd2]), side='left'))
+        if keep > 0:
+            buffer = _slice(buffer, keep, npts)
+            base += keep
+            p_uncertainty -= keep
+            p_sd2 -= keep
+            p_average -= keep
+            trimmed = True
+
+
+def stream_bedassessment(blocks, manning, min_slope, max_refinement_depth=20, min_spacing=0.1, spill_folder=None,
+                         block_size=100000):
+    # Bathymetry assessment of a stream of smoothed blocks (see execute_BedAssessment)
+    # The blocks are spilled in spill_folder (default: a temporary folder, deleted at the end) by blocks of block_size
+    # points, then solved from upstream to downstream. The output blocks (with all the fields of execute_BedAssessment,
+    # including the added cross-sections) are therefore yielded from upstream to downstream, each block being sorted
+    # by distance.
+    with tempfile.TemporaryDirectory(dir=spill_folder) as folder:
+        paths = []
+        fields = None
+        for block in rechunk(blocks, block_size):
+            paths.append(os.path.join(folder, "block{:08d}".format(len(paths))))
+            write_columns(paths[-1], block)
+            fields = list(block)
+        if not paths:
+            return
+
+        carried = None # fields of the downstream cross-section of the previous block
+        index = len(paths) - 1
+        while index >= 0:
+            columns = read_columns(paths[index], fields)
+            index -= 1
+            if carried is None and len(columns['dist']) < 2 and index >= 0:
+                # The upstream boundary condition needs two points
+                columns = _concatenate([read_columns(paths[index], fields), columns])
+                index -= 1
+            data = Databrowser.from_columns(columns)
+            if carried is None:
+                execute_BedAssessment(data, manning, min_slope, max_refinement_depth=max_refinement_depth,
+                                      min_spacing=min_spacing)
+                output = np.ones(len(data), dtype=bool)
+            else:
+                upstream = data.add_points([carried['dist']])[0]
+                for field, value in carried.items():
+                    if field != 'dist':
+                        setattr(upstream, field, value)
+                execute_BedAssessment(data, manning, min_slope, max_refinement_depth=max_refinement_depth,
+                                      min_spacing=min_spacing, restart_from=carried['dist'])
+                output = data.get_column('dist') < carried['dist']
+            first = data.get_first_point()
+            carried = {field: getattr(first, field) for field in data.get_fields()}
+            yield {field: data.get_column(field)[output] for field in data.get_fields(derived=True)}
+
+
+def execute_streaming(blocks, manning, min_slope, quantile=0.2, carving_window_size=10000, carving_window_overlap=200,
+                      smoothing_params=None, max_refinement_depth=20, min_spacing=0.1, spill_folder=None,
+                      block_size=100000):
+    # Water surface smoothing and bathymetry assessment of a stream of blocks (e.g. from iter_blocks), with the same
+    # results as execute_WSsmoothing (with carving_window_size) followed by execute_BedAssessment
+    # Return a generator of the output blocks, from upstream to downstream (see stream_bedassessment).
+    # smoothing_params are parameters of execute_WSsmoothing. The Gaussian weights are never reused in streaming mode,
+    # so cache_weights is ignored, and the diagnostics are not available.
+    carving, profile, others = split_smoothing_params(smoothing_params or {})
+    if carving:
+        raise ValueError("The quantile carving parameters must be given as arguments of execute_streaming, not in "
+                         "smoothing_params: " + ", ".join(sorted(carving)))
+    if others.get('diagnostics', False):
+        raise ValueError("The smoothing diagnostics are not available in streaming mode")
+    carved = stream_carving(blocks, quantile, carving_window_size, carving_window_overlap)
+    smoothed = stream_smoothing(carved, **profile)
+    return stream_bedassessment(smoothed, manning, min_slope, max_refinement_depth, min_spacing, spill_folder,
+                                block_size)
@@ -1,14 +1,36 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import math
 import numpy as np
+import scipy.sparse
 from BasicQuantileRegression import QuantileCarving
 from scipy.stats import norm
 from scipy.optimize import minimize_scalar
+from scipy.special import lambertw
 import warnings
+from BasicInstrumentation import count, timed_stage
 
+logger = logging.getLogger(__name__)
 
-def execute_WSsmoothing(datapoints, quantile=0.2, smooth_level=600 , uncertainty_sigma = 300, uncertainty_factor=0.85, slope_sigma=300, slope_factor=2.0):
+LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
+LOG_ZERO_DENSITY = -1075 * math.log(2.) # below this value, a density computed by norm.pdf rounds to 0
+# Beyond this number of standard deviations, norm.pdf underflows to 0: such points can not restrict a Gaussian curve
+PDF_UNDERFLOW_SIGMAS = 45.
+MIN_CORRECTION = 1e-9 # points whose uncertainty correction is lower are not smoothed (no carving around them)
+# Fields added to the datapoints by execute_WSsmoothing with diagnostics=True, and the results of smooth_profile they
+# hold
+DIAGNOSTIC_FIELDS = {'ws_uncertainty': 'uncertainty', 'restricted': 'restricted', 'sd2': 'sd2',
+                     'local_sigma': 'local_sigma'}
+# Parameters of execute_WSsmoothing used by the quantile carving and by smooth_profile (see split_smoothing_params)
+CARVING_PARAMS = ('quantile', 'carving_window_size', 'carving_window_overlap')
+PROFILE_PARAMS = ('smooth_level', 'uncertainty_sigma', 'uncertainty_factor', 'slope_sigma', 'slope_factor',
+                  'gaussian_truncation')
+
+
+@timed_stage
+def execute_WSsmoothing(datapoints, quantile=0.2, smooth_level=600 , uncertainty_sigma = 300, uncertainty_factor=0.85, slope_sigma=300, slope_factor=2.0, gaussian_truncation=8.,
+                        carving_window_size=None, carving_window_overlap=200, cache_weights=False, diagnostics=False):
 
     # The smoothing process :
     # - Removes bumps in the water surface profile following the quantile carving process of
@@ -16,113 +38,449 @@ def execute_WSsmoothing(datapoints, quantile=0.2, smooth_level=600 , uncertainty
     #   Schwanghart and Scherler (2017) is not used but replaced my a homemade one.
     # - Smooths the river profile according to the estimated uncertainty. Uncertainty is assessed by the difference
     #   between the maximum elevation downstream and the minimum elevation upstream any point in the profile.
+    # The Gaussian curves are truncated at +/- gaussian_truncation standard deviations. With the default value (8), the
+    # neglected weights are below 1e-14 of the total, so the results match the untruncated computation within 1e-9 m.
+    # For very long profiles, the quantile carving can be done by windows (see QuantileCarving).
+    # With cache_weights=True, the Gaussian weights of the uncertainty and slope terms are stored as sparse matrices
+    # (GaussianWeights) with the datapoints, so that the next smoothings of the same points (e.g. when testing other
+    # parameters) reuse them. Their memory use is proportional to the number of points within the Gaussian curves.
+    # The intermediate results of the smoothing are only kept if diagnostics is True: they are then added to the
+    # datapoints as the fields 'ws_uncertainty', 'restricted', 'sd2' and 'local_sigma'.
 
     # Quantile carving
-    QuantileCarving(datapoints, quantile)
+    QuantileCarving(datapoints, quantile, carving_window_size, carving_window_overlap)
 
     # Smoothing
-    values = []
-    unbreached_values = []
-    distances = []
-    for cs in datapoints.browse_down_to_up():
-        distances.append(cs.dist)
-        values.append(cs.ztosmooth)
-        unbreached_values.append(cs.z_ws)
-    distances = np.array(distances)
-    values = np.array(values)
-    unbreached_values = np.array(unbreached_values)
+    results = smooth_profile(datapoints.get_column('dist'), datapoints.get_column('ztosmooth'),
+                             datapoints.get_column('z_ws'), smooth_level, uncertainty_sigma, uncertainty_factor,
+                             slope_sigma, slope_factor, gaussian_truncation,
+                             weights=datapoints.get_cache('gaussian_weights') if cache_weights else None,
+                             diagnostics=diagnostics)
+
+    # Assign the smoothed values to the cross-sections
+    datapoints.set_column('z_smoothed', results['z_smoothed'])
+    if diagnostics:
+        for field, result in DIAGNOSTIC_FIELDS.items():
+            datapoints.set_column(field, results[result])
+    return
+
+
+def split_smoothing_params(params):
+    # Split the parameters of execute_WSsmoothing (dictionary, e.g. the smoothing_params of the batch processing) in
+    # the parameters of the quantile carving, the parameters of smooth_profile and the other ones (cache_weights and
+    # diagnostics), which the callers of smooth_profile must translate
+    # Raise a TypeError for an unknown parameter, as execute_WSsmoothing does.
+    unknown = set(params) - set(CARVING_PARAMS) - set(PROFILE_PARAMS) - {'cache_weights', 'diagnostics'}
+    if unknown:
+        raise TypeError("Unknown smoothing parameters: " + ", ".join(sorted(unknown)))
+    carving = {key: value for key, value in params.items() if key in CARVING_PARAMS}
+    profile = {key: value for key, value in params.items() if key in PROFILE_PARAMS}
+    others = {key: value for key, value in params.items() if key in ('cache_weights', 'diagnostics')}
+    return carving, profile, others
 
+
+def smooth_profile(distances, values, unbreached_values, smooth_level=600 , uncertainty_sigma = 300, uncertainty_factor=0.85, slope_sigma=300, slope_factor=2.0, gaussian_truncation=8.,
+                   previous=None, weights=None, diagnostics=True):
+    # Smoothing of the carved profile (values) of execute_WSsmoothing, on arrays sorted by distance
+    # Return a dictionary with the smoothed profile ('z_smoothed') and the intermediate results of the computation.
+    # With diagnostics=False, only the smoothed profile is returned, and the arrays only needed as intermediate results
+    # are not allocated (the results can then not be used as previous).
+    # If the results of a previous computation on the same distances and with the same parameters are provided
+    # (previous), only the results that can be affected by the changes of values and unbreached_values are
+    # recomputed, the other ones being copied from previous. The results are then identical (bit for bit) to a full
+    # computation.
+    # weights is a dictionary where the GaussianWeights of the uncertainty and slope terms are cached (by standard
+    # deviation), if provided.
+
+    # The computations are done in double precision, even on single precision columns
+    distances = np.asarray(distances, dtype=float)
+    values = np.asarray(values, dtype=float)
+    unbreached_values = np.asarray(unbreached_values, dtype=float)
     carving = unbreached_values - values
-    smoothed_values = np.zeros_like(values)
-    uncertainty_vec = np.zeros_like(values)
-    restricted = np.zeros_like(values)
-    sd2_vec = np.zeros_like(values)
-    local_sigma_vec = np.zeros_like(values)
-    for i in range(len(values)):
-        # Gaussian curve size (sigma) is limited on the edges to avoid mismatch with downstream reaches
-        local_sigma = min(smooth_level, (distances[i] - distances[0])*5.)  # hardcoded: 5 times the distance to the first point
-        local_sigma = max(local_sigma, 10.)  # hardcoded: minimum standard deviation
-        local_sigma_vec[i] = local_sigma
-        # Compute Gaussian weights using norm.pdf
-        weights = norm.pdf(distances, loc=distances[i], scale=uncertainty_sigma)
-        weights /= weights.sum()  # Normalize weights
-        # Uncertainty is calculated from:
-        # - the absolute value of the carving (how much carving is done)
-        # - the difference between the elevation and surrounding elevations (how much slope there is).
-        # A exponential transformation is applyied to that 0 difference of elevation = 1. The slopfactor is added to put
-        # more or less weight on the slope.
-        # - The ratio between the carving and the differences between the elevations gives a measure of the uncertainty
-        # relative to the slope
-        # - Everything is multiplied by the weights from the Gaussian curve and summed to get the final uncertainty
-        corrections = sum(np.abs(carving) * weights)**uncertainty_factor
-        if corrections < 1e-9:
-            # If there is no carving, there are no smoothing to be made
-            smoothed_values[i] = values[i]
+    abs_carving = np.abs(carving)
+    npts = len(values)
+    all_points = np.arange(npts)
+    halo = lambda sigma: gaussian_truncation * sigma # half width of the truncated Gaussian curves
+
+    local_sigma_vec = _local_sigma(distances, distances[0], smooth_level)
+
+    if previous is None:
+        changed_values = np.ones(npts, dtype=bool)
+        changed_carving = np.ones(npts, dtype=bool)
+    else:
+        changed_values = values != previous['values']
+        changed_carving = abs_carving != np.abs(previous['unbreached_values'] - previous['values'])
+
+    # Uncertainty is calculated from:
+    # - the absolute value of the carving (how much carving is done)
+    # - the difference between the elevation and surrounding elevations (how much slope there is).
+    # A exponential transformation is applyied to that 0 difference of elevation = 1. The slopfactor is added to put
+    # more or less weight on the slope.
+    # - The ratio between the carving and the differences between the elevations gives a measure of the uncertainty
+    # relative to the slope
+    # - Everything is multiplied by the weights from the Gaussian curve and summed to get the final uncertainty
+    if previous is None:
+        corrections = np.zeros(npts)
+        centers = all_points
+    else:
+        corrections = previous['corrections'].copy()
+        centers = np.flatnonzero(_near_changes(distances, changed_carving, halo(uncertainty_sigma)))
+    corrections[centers] = _corrections(distances, abs_carving, centers, uncertainty_sigma, uncertainty_factor,
+                                        gaussian_truncation, weights)
+    # If there is no carving, there are no smoothing to be made
+    smoothed_mask = corrections >= MIN_CORRECTION
+    to_smooth = np.flatnonzero(smoothed_mask)
+    if previous is None:
+        # Without diagnostics, the slope term is only kept on the smoothed points
+        slope_term = np.full(npts, np.nan) if diagnostics else None
+        centers = to_smooth
+    else:
+        slope_term = previous['slope_term'].copy()
+        slope_term[~smoothed_mask] = np.nan
+        centers = np.flatnonzero(smoothed_mask & (np.isnan(slope_term) |
+                                                  _near_changes(distances, changed_values, halo(slope_sigma))))
+    slope_values = _slope_term(distances, values, centers, slope_sigma, gaussian_truncation, weights)
+    if slope_term is not None:
+        slope_term[centers] = slope_values
+        slope_values = slope_term[to_smooth]
+    uncertainty_vec = np.zeros(npts)
+    uncertainty_vec[to_smooth] = _uncertainty(corrections[to_smooth], slope_values, slope_factor)
+    del slope_values
+
+    # Standard deviation of the Gaussian curve of every point. Each value depends on the value of the previous smoothed
+    # point (sd1), so the values are recomputed from the first point whose uncertainty changed, until sd1 is the same as
+    # in the previous computation again.
+    sd1_vec = np.full(npts, np.nan) if diagnostics or previous is not None else None
+    if previous is None:
+        sd2_vec = np.zeros(npts)
+        restricted = np.zeros(npts, dtype=np.int8) # restriction flags (see _restrict_sd)
+        first_change = 0
+        last_change = npts - 1
+    else:
+        sd2_vec = previous['sd2'].copy()
+        sd1_vec[:] = previous['sd1']
+        restricted = previous['restricted_sd2'].copy()
+        sd2_vec[~smoothed_mask] = 0.
+        restricted[~smoothed_mask] = 0.
+        changes = np.flatnonzero((uncertainty_vec != previous['uncertainty']) |
+                                 (smoothed_mask != (previous['corrections'] >= MIN_CORRECTION)))
+        first_change = changes[0] if len(changes) > 0 else npts
+        last_change = changes[-1] if len(changes) > 0 else -1
+    sd2 = None
+    previous_smoothed = to_smooth[to_smooth < first_change]
+    if len(previous_smoothed) > 0:
+        sd2 = sd2_vec[previous_smoothed[-1]]
+
+    nb_closedform = 0
+    nb_optimized = 0
+    for i in to_smooth[to_smooth >= first_change]:
+        if previous is not None and i > last_change and sd2 == previous['sd1'][i]:
+            break # from there, the values are the same as the previous ones
+        uncertainty = uncertainty_vec[i]
+        local_sigma = local_sigma_vec[i]
+        restricted[i] = 0
+        if i > 0:
+            # The Gaussian curve must not be wider than the previous one (see _restrict_sd)
+            sd1 = sd2  # sd1 is the previous sd2
+            if sd1_vec is not None:
+                sd1_vec[i] = sd1
+            sd2, restricted[i], method = _restrict_point(distances, i, sd1, uncertainty * local_sigma)
+            nb_closedform += method == 'closedform'
+            nb_optimized += method == 'optimized'
         else:
-            weightsslope = norm.pdf(distances, loc=distances[i], scale=slope_sigma)
-            weightsslope /= weightsslope.sum()  # Normalize weights
-            deltaz = math.exp(sum(np.abs(values[i] - values) * weightsslope)) ** slope_factor
-            uncertainty = corrections / deltaz
-            uncertainty_vec[i] = uncertainty
-            if i > 0:
-                # In order to avoid the problem of the Gaussian curve being too wide, we need to make sure that the pdf of
-                # the gaussian curve is lower than the previous one (on the left side of the previous one). Otherwise the
-                # resulting elevation can be lower than the previous one, creating a non-hydraulically valid profile.
-                x_values = distances[0:i - 1]
-                mu1 = distances[i - 1]
-                sd1 = sd2  # sd1 is the previous sd2
-                sd2 = uncertainty * local_sigma
-                mu2 = distances[i]
-                F1 = norm.pdf(x_values, loc=mu1, scale=sd1)
-                F2 = norm.pdf(x_values, loc=mu2, scale=sd2)
-                validpdf = np.all(F1 >= F2)
-                if not validpdf:
-                    # The Gaussian curve is too wide, compared to the previous ones
-                    # We need to reduce the standard deviation of the Gaussian curve in that case.
-                    # We will use the optimization to find the maximum possible standard deviation
-                    restricted[i] = 1
-
-                    def objective(tested_sd2):
-                        """Objective function to minimize: we want the negative of sd2 for maximization"""
-                        F1 = norm.pdf(x_values, loc=mu1, scale=sd1)
-                        F2 = norm.pdf(x_values, loc=mu2, scale=tested_sd2)
-                        diff = F1 - F2
-                        if np.any(diff < 0):
-                            return np.inf  # violates the constraint
-                        return -tested_sd2  # maximize sd2
-
-                    with warnings.catch_warnings():
-                        warnings.filterwarnings("ignore", category=RuntimeWarning)
-                        result = minimize_scalar(objective, bounds=(0.001, sd2), method='bounded')
-                        if result.success:
-                            sd2 = result.x
-                        else:
-                            # If optimization fails, the best guess is to use the previous sd
-                            sd2 = sd1
-                            restricted[i] = 2
-            else:
-                # First point, no previous point to compare
-                sd2 = uncertainty * local_sigma
-            sd2_vec[i] = sd2
-            weights = norm.pdf(distances, loc=distances[i], scale=sd2)
-            weights /= weights.sum()  # Normalize weights
-            # Compute the weighted average
-            smoothed_values[i] = np.sum(weights * values)
-
-            # Final check: if the smoothed value is lower than the previous one, we set it to the previous one
-            # It seems to happen sometimes although it should not. I could not find the reason why. Probably a numerical approximation in the optimization.
-            if i > 0 and smoothed_values[i] < smoothed_values[i - 1]:
-                smoothed_values[i] = smoothed_values[i - 1]
-                restricted[i] = restricted[i]+10
+            # First point, no previous point to compare
+            sd2 = uncertainty * local_sigma
+        sd2_vec[i] = sd2
+    logger.info("sd2 restriction: %d points solved in closed form, %d points optimized", nb_closedform, nb_optimized)
+    count("smoothed_points", len(to_smooth))
+    count("restricted_closedform", nb_closedform)
+    count("restricted_optimized", nb_optimized)
+    count("restricted_failed", int(np.sum(restricted == 2)))
+
+    # Compute the weighted average
+    if previous is None:
+        weighted_values = values.copy()
+        centers = to_smooth
+    else:
+        weighted_values = previous['weighted_values'].copy()
+        weighted_values[~smoothed_mask] = values[~smoothed_mask]
+        newly_smoothed = smoothed_mask & ~(previous['corrections'] >= MIN_CORRECTION)
+        centers = np.flatnonzero(smoothed_mask & (newly_smoothed | (sd2_vec != previous['sd2']) |
+                                                  _near_changes(distances, changed_values, halo(sd2_vec))))
+    weighted_values[centers] = _weighted_values(distances, values, centers, sd2_vec[centers], gaussian_truncation)
+
+    # Final check: if the smoothed value is lower than the previous one, we set it to the previous one
+    # It seems to happen sometimes although it should not. I could not find the reason why. Probably a numerical approximation in the optimization.
+    # As for sd2, each value depends on the previous one, so the values are recomputed from the first change.
+    if previous is None:
+        # Without diagnostics, the weighted values are not returned and can be corrected in place
+        smoothed_values = weighted_values.copy() if diagnostics else weighted_values
+        corrected = np.zeros(npts, dtype=bool)
+        first_change = 0
+        last_change = npts - 1
+    else:
+        smoothed_values = previous['z_smoothed'].copy()
+        corrected = previous['corrected'].copy()
+        changes = np.flatnonzero((weighted_values != previous['weighted_values']) |
+                                 (smoothed_mask != (previous['corrections'] >= MIN_CORRECTION)))
+        first_change = changes[0] if len(changes) > 0 else npts
+        last_change = changes[-1] if len(changes) > 0 else -1
+    for i in range(first_change, npts):
+        if previous is not None and i > last_change and smoothed_values[i - 1] == previous['z_smoothed'][i - 1]:
+            break # from there, the values are the same as the previous ones
+        smoothed_values[i], corrected[i] = _monotonic_value(weighted_values[i], smoothed_mask[i],
+                                                            smoothed_values[i - 1] if i > 0 else None)
+    count("monotonic_corrections", int(np.sum(corrected)))
+
+    if not diagnostics:
+        return {'z_smoothed': smoothed_values}
+    return {'z_smoothed': smoothed_values, 'values': values, 'unbreached_values': unbreached_values,
+            'corrections': corrections, 'slope_term': slope_term, 'uncertainty': uncertainty_vec, 'sd1': sd1_vec,
+            'sd2': sd2_vec, 'restricted_sd2': restricted, 'restricted': restricted + 10 * corrected,
+            'corrected': corrected, 'weighted_values': weighted_values, 'local_sigma': local_sigma_vec}
+
+
+# Steps of smooth_profile, also used by the streaming version (stream_smoothing in BasicStreaming.py), so that both give
+# the same results
+
+
+def _local_sigma(distances, first_distance, smooth_level):
+    # Gaussian curve size (sigma) is limited on the edges to avoid mismatch with downstream reaches
+    # hardcoded: 5 times the distance to the first point
+    local_sigma = np.minimum(smooth_level, (distances - first_distance)*5.)
+    return np.maximum(local_sigma, 10.)  # hardcoded: minimum standard deviation
+
+
+def _corrections(distances, abs_carving, centers, uncertainty_sigma, uncertainty_factor, truncation, weights=None):
+    # Uncertainty corrections of the centers: weighted average of the absolute carving (see smooth_profile)
+    if weights is None:
+        average = _gaussian_weighted_average(distances, centers, uncertainty_sigma, truncation,
+                                             lambda i, j: abs_carving[j])
+    else:
+        average = _get_weights(weights, distances, uncertainty_sigma, truncation).average(abs_carving, centers)
+    return average**uncertainty_factor
+
+
+def _slope_term(distances, values, centers, slope_sigma, truncation, weights=None):
+    # Slope term of the centers: weighted average of the differences of elevation with the surrounding points
+    if weights is None:
+        return _gaussian_weighted_average(distances, centers, slope_sigma, truncation,
+                                          lambda i, j: np.abs(values[i] - values[j]))
+    operator = _get_weights(weights, distances, slope_sigma, truncation)
+    return operator.pair_average(lambda i, j: np.abs(values[i] - values[j]), centers)
+
+
+def _uncertainty(corrections, slope_term, slope_factor):
+    # Uncertainty of the smoothed points, from their corrections and slope terms
+    deltaz = np.exp(slope_term) ** slope_factor
+    return corrections / deltaz
+
+
+def _restrict_point(distances, i, sd1, initial_sd2):
+    # Standard deviation of the Gaussian curve of point i (> 0), restricted by the curve of the previous point (sd1)
+    # Only the points where the Gaussian curve does not underflow can restrict it, so that the cost of the restriction
+    # is proportional to the width of the curve, not to the number of points downstream.
+    start = min(np.searchsorted(distances, distances[i] - PDF_UNDERFLOW_SIGMAS * initial_sd2, side='left'),
+                max(i - 1, 0))
+    return _restrict_sd(distances[start:i - 1], distances[i - 1], sd1, distances[i], initial_sd2)
+
+
+def _weighted_values(distances, values, centers, sd2, truncation):
+    # Smoothed values of the centers, before the monotonic correction: weighted averages with their Gaussian curves
+    return _gaussian_weighted_average(distances, centers, sd2, truncation, lambda i, j: values[j])
+
+
+def _monotonic_value(weighted_value, smoothed, previous_value):
+    # Smoothed value of a point from its weighted value: not lower than the smoothed value of the previous point (None
+    # for the first point). Return the value and whether it was corrected.
+    if smoothed and previous_value is not None and weighted_value < previous_value:
+        return previous_value, True
+    return weighted_value, False
+
+
+def _restrict_sd(x_values, mu1, sd1, mu2, sd2):
+    # In order to avoid the problem of the Gaussian curve being too wide, we need to make sure that the pdf of the
+    # gaussian curve (centered on mu2, standard deviation sd2) is lower than the previous one (centered on mu1,
+    # standard deviation sd1) on the left side of the previous one (x_values). Otherwise the resulting elevation can be
+    # lower than the previous one, creating a non-hydraulically valid profile.
+    # Return the (possibly reduced) sd2, the restriction flag (0: not restricted, 1: restricted, 2: restriction failed)
+    # and the method used ('closedform', 'optimized' or None).
+    F1 = norm.pdf(x_values, loc=mu1, scale=sd1)
+    F2 = norm.pdf(x_values, loc=mu2, scale=sd2)
+    validpdf = np.all(F1 >= F2)
+    if validpdf:
+        return sd2, 0, None
+
+    # The Gaussian curve is too wide, compared to the previous ones
+    # We need to reduce the standard deviation of the Gaussian curve in that case.
+    # The maximum possible standard deviation is first computed in closed form. The optimization is used only if the
+    # closed form solution can not be found.
+    closedform_sd2 = _max_admissible_sd(x_values, mu1, sd1, mu2, sd2)
+    if closedform_sd2 is not None:
+        return closedform_sd2, 1, 'closedform'
+
+    def objective(tested_sd2):
+        """Objective function to minimize: we want the negative of sd2 for maximization"""
+        F1 = norm.pdf(x_values, loc=mu1, scale=sd1)
+        F2 = norm.pdf(x_values, loc=mu2, scale=tested_sd2)
+        diff = F1 - F2
+        if np.any(diff < 0):
+            return np.inf  # violates the constraint
+        return -tested_sd2  # maximize sd2
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=RuntimeWarning)
+        result = minimize_scalar(objective, bounds=(0.001, sd2), method='bounded')
+        count("restriction_objective_evals", result.nfev)
+    # The bounded search can end on an infeasible sd2 (objective inf) while reporting a success: it is then rejected
+    if result.success and np.isfinite(result.fun):
+        return result.x, 1, 'optimized'
+    # If optimization fails, the best guess is to use the previous sd (always admissible, as mu1 < mu2)
+    return sd1, 2, 'optimized'
+
+
+def _near_changes(distances, changed, half_width):
+    # Return a boolean mask of the points that are at most half_width (one value or one value per point) away from a
+    # changed point, i.e. whose truncated Gaussian window contains a changed point
+    # A small margin is added, so that the rounding of the window bounds can not exclude a changed point
+    changed_distances = distances[changed]
+    if len(changed_distances) == 0:
+        return np.zeros(len(distances), dtype=bool)
+    position = np.searchsorted(changed_distances, distances)
+    after = changed_distances[np.minimum(position, len(changed_distances) - 1)]
+    before = changed_distances[np.maximum(position - 1, 0)]
+    nearest = np.minimum(np.abs(after - distances), np.abs(distances - before))
+    return nearest <= half_width * (1 + 1e-9) + 1e-9
+
+
+def _max_admissible_sd(x_values, mu1, sd1, mu2, sd2_max):
+    # Closed form of the restriction of the Gaussian curve of execute_WSsmoothing: return an sd2 <= sd2_max such that
+    # norm.pdf(x, mu2, sd2) <= norm.pdf(x, mu1, sd1) at every point x of x_values (as computed by norm.pdf). Return None
+    # if it could not be found.
+    # The result is slightly below the largest admissible sd2, because of two conservative margins: the bound is reduced
+    # by a relative 1e-9, and where the density of the first curve underflows to 0, the density of the second curve is
+    # required to be below exp(LOG_ZERO_DENSITY - 1), instead of just rounding to 0. When such points restrict the curve,
+    # a larger sd2 (typically by less than 0.1%) can also pass the norm.pdf check.
+    # For a given x at a distance d from mu2, the log-density of the second curve as a function of sd2 increases up to
+    # sd2 = d and then decreases, so the constraint is violated on an interval of sd2. With u = (sd2/d)^2, the bounds
+    # of that interval are the roots of log(u) + 1/u = 2K, which are given by the two real branches of the Lambert W
+    # function. The largest admissible sd2 is the lower bound of the group of overlapping intervals containing sd2_max.
+    d = mu2 - x_values
+    if len(x_values) == 0 or np.any(d <= 0):
+        return None
+    # The bounds are the densities of the first curve as computed by norm.pdf. Where they underflow to 0, the density of
+    # the second curve must underflow too: it must be below the rounding threshold, with a margin.
+    f1 = norm.pdf(x_values, loc=mu1, scale=sd1)
+    with np.errstate(divide='ignore'):
+        log_f1 = np.where(f1 > 0, np.log(f1), LOG_ZERO_DENSITY - 1.)
+    K = -log_f1 - LOG_SQRT_2PI - np.log(d)
+    violable = K > 0.5 # log(u) + 1/u >= 1, so there is no violation for K <= 0.5
+    d = d[violable]
+    K = K[violable]
+    with np.errstate(over='ignore', divide='ignore'):
+        w_0 = np.exp(-2 * K) # asymptotic value for large K, where exp(-2K) underflows
+        w_m1 = 2 * K
+        for _ in range(4):
+            w_m1 = 2 * K + np.log(w_m1)
+        regular = 2 * K < 700
+        arg = -np.exp(-2 * K[regular])
+        w_0[regular] = -lambertw(arg, 0).real
+        w_m1[regular] = -lambertw(arg, -1).real
+        lower = d / np.sqrt(w_m1)
+        upper = d / np.sqrt(w_0)
+
+    sd2 = sd2_max
+    while True:
+        inside = (lower < sd2) & (sd2 < upper)
+        if not np.any(inside):
+            break
+        sd2 = np.min(lower[inside]) * (1 - 1e-9) # small margin, so that the constraint holds after rounding
+    if not sd2 >= 0.001: # same lower bound as the optimization
+        return None
+    # Check with the densities as computed in the original constraint
+    if not np.all(f1 >= norm.pdf(x_values, loc=mu2, scale=sd2)):
+        return None
+    return sd2
+
+
+class GaussianWeights():
+    # Truncated Gaussian weights of every point of a distance grid around every point (centers), as a banded sparse
+    # matrix: row i holds the weights of the points within +/- truncation*sigma of distances[i]. The matrix is built
+    # once, then the weighted averages are sparse matrix-vector products. The weights and the sums are computed in the
+    # same order as _gaussian_weighted_average, so the results are identical.
+
+    def __init__(self, distances, sigma, truncation=8.):
+        distances = np.asarray(distances, dtype=float)
+        npts = len(distances)
+        self.distances = distances
+        self.sigma = sigma
+        self.truncation = truncation
+        lower = np.searchsorted(distances, distances - truncation * sigma, side='left')
+        upper = np.searchsorted(distances, distances + truncation * sigma, side='right')
+        counts = upper - lower
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        rows = np.repeat(np.arange(npts), counts)
+        indices = np.arange(indptr[-1]) - indptr[rows] + lower[rows]
+        # The normalisation constant of the Gaussian pdf is not needed, as the weights are normalized
+        data = np.exp(-0.5 * ((distances[indices] - distances[rows]) / sigma) ** 2)
+        self.matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(npts, npts))
+        self.sum_weights = self.matrix @ np.ones(npts)
+
+    def matches(self, distances, sigma, truncation):
+        return sigma == self.sigma and truncation == self.truncation and np.array_equal(distances, self.distances)
+
+    def average(self, values, centers=None):
+        # Weighted averages of values around the centers (all the points by default)
+        matrix = self._rows(centers)
+        return (matrix @ values) / self.sum_weights[self._centers(centers)]
+
+    def pair_average(self, pair_values, centers=None):
+        # Weighted averages of pair_values(i, j) over the points j, around the centers i (see _gaussian_weighted_average)
+        matrix = self._rows(centers)
+        centers = self._centers(centers)
+        i = np.repeat(centers, np.diff(matrix.indptr))
+        products = scipy.sparse.csr_matrix((matrix.data * pair_values(i, matrix.indices), matrix.indices, matrix.indptr),
+                                           shape=matrix.shape)
+        return (products @ np.ones(matrix.shape[1])) / self.sum_weights[centers]
+
+    def _centers(self, centers):
+        return np.arange(self.matrix.shape[0]) if centers is None else centers
+
+    def _rows(self, centers):
+        # The centers are sorted and unique: as many centers as rows means all the rows
+        if centers is None or len(centers) == self.matrix.shape[0]:
+            return self.matrix
+        return self.matrix[centers]
+
+
+def _get_weights(weights, distances, sigma, truncation):
+    # GaussianWeights from the cache (weights dictionary), built if needed
+    operator = weights.get(sigma)
+    if operator is None or not operator.matches(distances, sigma, truncation):
+        operator = weights[sigma] = GaussianWeights(distances, sigma, truncation)
+        count("gaussian_weights_built")
+    return operator
 
-    # Assign the smoothed values to the cross-sections
-    i = 0
-    for cs in datapoints.browse_down_to_up():
-        cs.z_smoothed = smoothed_values[i]
-        #cs.ws_uncertainty = uncertainty_vec[i]
-        #cs.restricted = restricted[i]
-        #cs.sd2 = sd2_vec[i]
-        #cs.local_sigma = local_sigma_vec[i]
-        i +=1
-    return
 
+def _gaussian_weighted_average(distances, centers, sigma, truncation, pair_values):
+    # For every point i in centers, compute the average of pair_values(i, j) over the points j, weighted by a Gaussian
+    # curve centered on distances[i] (sigma can be one value or one value per center).
+    # The Gaussian curve is truncated at +/- truncation*sigma: the window of points j is found with a binary search on
+    # the (sorted) distances, and all the centers are processed together, one offset j-i at a time.
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), centers.shape)
+    lower = np.searchsorted(distances, distances[centers] - truncation * sigma, side='left')
+    upper = np.searchsorted(distances, distances[centers] + truncation * sigma, side='right')
+    weighted_sum = np.zeros(len(centers))
+    sum_weights = np.zeros(len(centers))
+    if len(centers) == 0:
+        return weighted_sum
+    for offset in range(np.min(lower - centers), np.max(upper - centers)):
+        j = centers + offset
+        inwindow = np.flatnonzero((j >= lower) & (j < upper))
+        i = centers[inwindow]
+        j = j[inwindow]
+        # The normalisation constant of the Gaussian pdf is not needed, as the weights are normalized
+        weights = np.exp(-0.5 * ((distances[j] - distances[i]) / sigma[inwindow]) ** 2)
+        weighted_sum[inwindow] += weights * pair_values(i, j)
+        sum_weights[inwindow] += weights
+    return weighted_sum / sum_weights
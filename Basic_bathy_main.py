@@ -8,14 +8,39 @@ import matplotlib.pyplot as plt
 from BasicWSSmoothing import *
 from BasicBedAssessment import *
 from BasicRiverDataStructure import *
+from BasicColumnIO import read_columns, write_columns
 
 
+def plot_bed_profiles(df_beddata, df_beddata_reduced, df_data, filename=None):
+    # Plot the bed and water surface profiles, and show the figure (or save it in filename, without showing it)
+    plt.figure(figsize=(12, 6))
+    # Plot original bed elevation
+    plt.plot(df_beddata['dist'], df_beddata['z'], label='Original Bed Elevation', alpha=0.7)
+    # Plot reduced (RDP) bed elevation
+    plt.plot(df_beddata_reduced['dist'], df_beddata_reduced['z'], label='Reduced Bed Elevation (RDP)', marker='o', linestyle='--')
+    # Plot original water surface
+    plt.plot(df_data['dist'], df_data['z_ws'], label='Original Water Surface', color='cyan', alpha=0.5)
+    # Plot ws_validation from reduced data
+    if 'ws_validation' in df_beddata_reduced.columns:
+        plt.plot(df_beddata_reduced['dist'], df_beddata_reduced['ws_validation'], label='WS Validation', color='magenta', linestyle=':')
+    plt.xlabel('dist')
+    plt.ylabel('Elevation (m)')
+    plt.title('Bed Elevation and Water Surface Profiles')
+    plt.legend()
+    if filename is None:
+        plt.show()
+    else:
+        plt.savefig(filename)
+        plt.close()
+
 
 if __name__ == "__main__":
 
 
     # Simple synthetic data to test the algorithm
     # can be replaced by data provided in a csv file with: df_data = pd.read_csv(r'path\to\your\data.csv')
+    # or, for large files, by reading only the four fields below from a csv, Parquet or Arrow file, or from a folder of
+    # .npy files (one per field), with: data = Databrowser.from_columns(read_columns(r'path\to\your\data.parquet'))
     # The input data represent charateristics at points measured along the river:
     # - dist: a longitudinal distance along the river (from downstream to upstream), situating the point
     # - z_ws: the water surface elevation, usually extracted from LiDAR data, at a measurement point
@@ -53,23 +78,8 @@ if __name__ == "__main__":
     execute_SimpleHydro(data_reduced, 0.03, downstream_slope)
     df_beddata_reduced = data_reduced.topandasdf(["dist", "z_ws", "ztosmooth", "z_smoothed", "z", "Fr", "ws_validation"])
 
-    # Save it as a csv
-    df_beddata_reduced.to_csv(r'D:\NRCAN2\temp\DebugTetraTech\BCCR_14_QLidar_20221104_bed.csv', index=False)
+    # Save it as a csv (or as a Parquet or Arrow file, or a folder of .npy files, depending on the extension)
+    write_columns('bed_reduced.csv', data_reduced, ["dist", "z_ws", "ztosmooth", "z_smoothed", "z", "Fr", "ws_validation"])
 
     # Plot data
-    plt.figure(figsize=(12, 6))
-    # Plot original bed elevation
-    plt.plot(df_beddata['dist'], df_beddata['z'], label='Original Bed Elevation', alpha=0.7)
-    # Plot reduced (RDP) bed elevation
-    plt.plot(df_beddata_reduced['dist'], df_beddata_reduced['z'], label='Reduced Bed Elevation (RDP)', marker='o', linestyle='--')
-    # Plot original water surface
-    plt.plot(df_data['dist'], df_data['z_ws'], label='Original Water Surface', color='cyan', alpha=0.5)
-    # Plot ws_validation from reduced data
-    if 'ws_validation' in df_beddata_reduced.columns:
-        plt.plot(df_beddata_reduced['dist'], df_beddata_reduced['ws_validation'], label='WS Validation', color='magenta', linestyle=':')
-    plt.xlabel('dist')
-    plt.ylabel('Elevation (m)')
-    plt.title('Bed Elevation and Water Surface Profiles')
-    plt.legend()
-    plt.show()
-
+    plot_bed_profiles(df_beddata, df_beddata_reduced, df_data)
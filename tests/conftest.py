@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+# The modules of the project are flat modules at the root of the repository
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Storage of the Databrowser (permanent slots, order of the rows, copy-on-write selections, categorical fields),
+# compared with a plain model: a list of rows kept sorted by distance, the points at the same distance keeping their
+# order
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from BasicRiverDataStructure import Databrowser
+
+CATEGORIES = ["regular", "manning up", "min_slope", None]
+
+
+class Model():
+    # Rows as dictionaries, sorted by distance (stable sort) when read, as the Databrowser does
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.unsorted = True
+        self.next_id = len(rows)
+
+    def sorted_rows(self):
+        if self.unsorted:
+            self.rows.sort(key=lambda row: row['dist'])
+            self.unsorted = False
+        return self.rows
+
+    def add_point(self, distance):
+        rows = self.sorted_rows()
+        position = sum(row['dist'] <= distance for row in rows)
+        row = {'dist': distance, 'id': float(self.next_id), 'v': np.nan, 'cat': None}
+        rows.insert(position, row)
+        self.next_id += 1
+        return row
+
+    def column(self, field):
+        return [row[field] for row in self.sorted_rows()]
+
+    def set_column(self, field, values):
+        for row, value in zip(self.sorted_rows(), values):
+            row[field] = value
+        self.unsorted = self.unsorted or field == 'dist'
+
+
+def check(data, model):
+    assert len(data) == len(model.rows)
+    for field in ('dist', 'id', 'v'):
+        np.testing.assert_array_equal(data.get_column(field), np.array(model.column(field), dtype=float),
+                                      err_msg=field)
+    assert data.get_column('cat').tolist() == model.column('cat')
+    assert [cs.id for cs in data.browse_down_to_up()] == model.column('id')
+    assert [cs.id for cs in data.browse_up_to_down()] == model.column('id')[::-1]
+
+
+def random_distances(rng, nb):
+    # Few distinct distances, so that many points are at the same distance
+    return (rng.integers(0, 60, nb) * 0.5).tolist()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_databrowser_matches_sorted_list(seed):
+    rng = np.random.default_rng(seed)
+    npts = 200
+    columns = {'dist': random_distances(rng, npts), 'id': np.arange(npts, dtype=float).tolist(),
+               'v': rng.normal(size=npts).tolist(), 'cat': [CATEGORIES[k] for k in rng.integers(0, 4, npts)]}
+    data = Databrowser(pd.DataFrame(columns), dtypes={'cat': 'category'})
+    model = Model([dict(zip(columns, values)) for values in zip(*columns.values())])
+    check(data, model)
+
+    for _ in range(300):
+        operation = rng.integers(0, 8)
+        if operation == 0:
+            distance = random_distances(rng, 1)[0]
+            data.add_point(distance).id = model.add_point(distance)['id']
+        elif operation == 1:
+            distances = random_distances(rng, rng.integers(0, 20))
+            for newobj, distance in zip(data.add_points(distances), distances):
+                newobj.id = model.add_point(distance)['id']
+        elif operation == 2:
+            distances = random_distances(rng, len(data))
+            data.set_column('dist', distances)
+            model.set_column('dist', distances)
+        elif operation == 3:
+            # Distance of one row modified through its view: the rows are sorted again when needed
+            row = rng.integers(0, len(data))
+            distance = random_distances(rng, 1)[0]
+            list(data.browse_down_to_up())[row].dist = distance
+            model.sorted_rows()[row]['dist'] = distance
+            model.unsorted = True
+        elif operation == 4:
+            values = rng.normal(size=len(data))
+            data.set_column('v', values)
+            model.set_column('v', values.tolist())
+        elif operation == 5:
+            row = rng.integers(0, len(data))
+            value = float(rng.normal())
+            list(data.browse_down_to_up())[row].v = value
+            model.sorted_rows()[row]['v'] = value
+        elif operation == 6:
+            values = [CATEGORIES[k] for k in rng.integers(0, 4, len(data))]
+            data.set_column('cat', values)
+            model.set_column('cat', values)
+        else:
+            # Selection: the columns are shared until one of the Databrowsers modifies them
+            mask = rng.random(len(data)) < 0.5
+            selected = data.select(mask)
+            selected_model = Model([dict(row) for row, kept in zip(model.sorted_rows(), mask) if kept])
+            selected_model.unsorted = False
+            check(selected, selected_model)
+            values = rng.normal(size=len(selected))
+            selected.set_column('v', values)
+            selected_model.set_column('v', values.tolist())
+            if len(selected) > 0:
+                selected.get_first_point().dist = 100.
+                selected_model.sorted_rows()[0]['dist'] = 100.
+                selected_model.unsorted = True
+            selected.add_point(-1.).id = selected_model.add_point(-1.)['id']
+            check(selected, selected_model)
+            values = rng.normal(size=len(data))
+            data.set_column('v', values)
+            model.set_column('v', values.tolist())
+            check(selected, selected_model)
+        check(data, model)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# Parity of the array version of the inverse 1D hydraulic solver (BasicHydroKernel.py, compiled with numba if
+# installed) with the object based version, used as the reference: both must give the same cross-sections, including
+# the points added when the Froude number varies too much.
+
+import numpy as np
+import pytest
+
+from BasicBenchmark import synthetic_profile
+from BasicBedAssessment import execute_BedAssessment
+from BasicRiverDataStructure import Databrowser
+from BasicWSSmoothing import execute_WSsmoothing
+
+FIELDS = ['dist', 'width', 'Q', 'z_smoothed', 'y', 'z', 'v', 's', 'h', 'Fr', 'nfev', 'converged', 'type']
+
+
+def smoothed_profile(npts, seed):
+    datapoints = Databrowser(synthetic_profile(npts, seed=seed))
+    execute_WSsmoothing(datapoints)
+    return datapoints.topandasdf(['dist', 'z_ws', 'width', 'Q', 'ztosmooth', 'z_smoothed'])
+
+
+@pytest.mark.parametrize("npts, seed", [(24, 0), (300, 1), (1000, 2)])
+def test_kernel_matches_object_solver(npts, seed):
+    df = smoothed_profile(npts, seed)
+    reference = Databrowser(df)
+    kernel = Databrowser(df)
+    execute_BedAssessment(reference, 0.03, 1e-5)
+    execute_BedAssessment(kernel, 0.03, 1e-5, kernel=True)
+
+    assert len(kernel) == len(reference)
+    assert np.array_equal(kernel.get_column('solver'), reference.get_column('solver'))
+    for field in FIELDS:
+        # Both versions do the same operations in the same order: only the last bit may differ
+        np.testing.assert_allclose(kernel.get_column(field), reference.get_column(field), rtol=1e-12, atol=1e-15,
+                                   err_msg=field)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# The incremental runs must give the same results (bit for bit) as a full computation with execute_WSsmoothing and
+# execute_BedAssessment
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from BasicBenchmark import synthetic_profile
+from BasicBedAssessment import execute_BedAssessment
+from BasicIncremental import IncrementalRun
+from BasicRiverDataStructure import Databrowser
+from BasicWSSmoothing import execute_WSsmoothing
+
+
+def full_computation(df, smoothing_params):
+    data = Databrowser(df)
+    execute_WSsmoothing(data, **smoothing_params)
+    execute_BedAssessment(data, 0.03, 1e-5)
+    return data
+
+
+def assert_same_results(data, reference):
+    assert sorted(data.get_fields()) == sorted(reference.get_fields())
+    fields = reference.get_fields()
+    df = data.topandasdf(fields)
+    df_reference = reference.topandasdf(fields)
+    for field in fields:
+        if pd.api.types.is_numeric_dtype(df_reference[field]):
+            np.testing.assert_array_equal(df[field].to_numpy(float), df_reference[field].to_numpy(float),
+                                          err_msg=field)
+        else:
+            assert df[field].equals(df_reference[field]), field
+
+
+@pytest.mark.parametrize("smoothing_params", [{}, {'diagnostics': True}, {'cache_weights': True}])
+def test_incremental_matches_full_computation(smoothing_params):
+    df = synthetic_profile(400, seed=4)
+    npts = len(df)
+    run = IncrementalRun(0.03, 1e-5, smoothing_params=smoothing_params)
+    assert_same_results(run.run(df), full_computation(df, smoothing_params))
+    assert run.last_stats['mode'] == 'full'
+
+    # Changes of the water surface, of the discharge and of the width, one at a time, then the same inputs again
+    changes = [('z_ws', npts // 3, 0.05), ('Q', npts // 4, 0.3), ('width', npts // 2, 1.), ('width', 3, 1.),
+               (None, None, None)]
+    for field, index, change in changes:
+        df = df.copy()
+        if field is not None:
+            df.loc[index, field] += change
+        data = run.run(df)
+        assert run.last_stats['mode'] == 'incremental'
+        assert_same_results(data, full_computation(df, smoothing_params))
+    assert run.last_stats['bed_restart'] is None # nothing to recompute without changes
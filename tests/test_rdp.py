@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+# Ramer-Douglas-Peucker reduction of the bed profiles
+
+import numpy as np
+import pytest
+
+from BasicRiverDataStructure import rdp_mask, rdp_significance
+
+
+def random_polylines(nb):
+    # Profiles such as the bed elevations: increasing distances, random walk of the elevations, with a few repeated
+    # points
+    rng = np.random.default_rng(0)
+    for _ in range(nb):
+        npts = rng.integers(2, 300)
+        x = np.cumsum(rng.uniform(0., 10., npts))
+        y = np.cumsum(rng.normal(0., 0.2, npts))
+        yield x, y, rng.uniform(0.01, 0.5)
+
+
+@pytest.mark.filterwarnings("ignore::DeprecationWarning") # np.cross on 2D vectors, in the rdp package
+def test_rdp_mask_matches_rdp_package():
+    # rdp_mask replaced the rdp package: the kept points must be the same
+    rdp = pytest.importorskip("rdp")
+    for x, y, epsilon in random_polylines(200):
+        expected = rdp.rdp(np.column_stack([x, y]), epsilon=epsilon, return_mask=True)
+        np.testing.assert_array_equal(rdp_mask(x, y, epsilon), expected)
+
+
+def test_rdp_significance_gives_every_mask():
+    # A point is kept by rdp_mask(x, y, epsilon) if and only if its significance is higher than epsilon
+    for x, y, _ in random_polylines(200):
+        significance = rdp_significance(x, y)
+        for epsilon in (0.01, 0.05, 0.1, 0.3, 1.):
+            np.testing.assert_array_equal(significance > epsilon, rdp_mask(x, y, epsilon))
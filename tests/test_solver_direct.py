@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+# Normal depth of the direct solver: the vectorized Newton's method of manning_normaldepth against the fsolve reference
+
+import numpy as np
+
+from BasicSolverDirect import manning_normaldepth, manning_normaldepth_fsolve
+
+
+def test_normaldepth_matches_fsolve():
+    rng = np.random.default_rng(0)
+    Q = 10 ** rng.uniform(-1., 2., 200)
+    width = rng.uniform(2., 50., 200)
+    n = rng.uniform(0.02, 0.06, 200)
+    s = 10 ** rng.uniform(-5., -2., 200)
+
+    y, iterations = manning_normaldepth(Q, width, n, s)
+    reference = [manning_normaldepth_fsolve(*values) for values in zip(Q, width, n, s)]
+
+    np.testing.assert_allclose(y, reference, rtol=1e-8)
+    assert iterations.max() <= 10
+
+
+def test_normaldepth_single_depth():
+    # A single depth is returned as arrays of one element, as used by manning_inversesolver
+    y, iterations = manning_normaldepth(1., 10., 0.03, 0.0005)
+    assert y.shape == iterations.shape == (1,)
+    np.testing.assert_allclose(y[0], manning_normaldepth_fsolve(1., 10., 0.03, 0.0005), rtol=1e-8)
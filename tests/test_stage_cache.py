@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+# Results read from the stage cache must be the same as the results of the stages
+
+import numpy as np
+
+from BasicBenchmark import synthetic_profile
+from BasicRiverDataStructure import Databrowser
+from BasicStageCache import StageCache, cached_WSsmoothing
+
+
+def test_cached_smoothing_keeps_diagnostics(tmp_path):
+    cache = StageCache(str(tmp_path))
+    df = synthetic_profile(200, seed=3)
+    computed = Databrowser(df)
+    cached_WSsmoothing(computed, cache, diagnostics=True)
+    read = Databrowser(df)
+    cached_WSsmoothing(read, cache, diagnostics=True)
+
+    assert sorted(read.get_fields()) == sorted(computed.get_fields())
+    for field in computed.get_fields():
+        np.testing.assert_array_equal(read.get_column(field), computed.get_column(field), err_msg=field)
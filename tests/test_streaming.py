@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# The streaming version of the processing must give the same results as the in-memory one (execute_WSsmoothing with
+# carving windows, followed by execute_BedAssessment), whatever the size of the blocks
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from BasicBenchmark import synthetic_profile
+from BasicBedAssessment import execute_BedAssessment
+from BasicRiverDataStructure import Databrowser
+from BasicStreaming import execute_streaming, iter_blocks
+from BasicWSSmoothing import execute_WSsmoothing
+
+
+@pytest.mark.parametrize("npts, noise, window_size, block_size, smoothing_params", [
+    (1500, 0.02, 300, 250, {}),
+    (1500, 0.1, 400, 999, {'smooth_level': 300}),
+])
+def test_streaming_matches_in_memory(npts, noise, window_size, block_size, smoothing_params):
+    df = synthetic_profile(npts, noise=noise, seed=3)
+    data = Databrowser(df)
+    execute_WSsmoothing(data, carving_window_size=window_size, **smoothing_params)
+    execute_BedAssessment(data, 0.03, 1e-5)
+    reference = data.topandasdf(data.get_fields())
+
+    columns = {field: df[field].to_numpy(float) for field in ['dist', 'z_ws', 'width', 'Q']}
+    blocks = execute_streaming(iter_blocks(columns, block_size), 0.03, 1e-5, carving_window_size=window_size,
+                               smoothing_params=smoothing_params, block_size=block_size)
+    streamed = pd.concat([pd.DataFrame(block) for block in blocks]).sort_values('dist', kind='stable')
+    streamed = streamed.reset_index(drop=True)
+
+    # The streamed blocks also hold the derived fields (h, Fr...)
+    assert set(reference.columns) <= set(streamed.columns)
+    assert len(streamed) == len(reference)
+    for field in reference.columns:
+        if not pd.api.types.is_numeric_dtype(reference[field]):
+            assert reference[field].equals(streamed[field]), field
+        else:
+            np.testing.assert_array_equal(streamed[field].to_numpy(float), reference[field].to_numpy(float),
+                                          err_msg=field)
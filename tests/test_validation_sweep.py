@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+# The validation of several RDP tolerances at once (execute_SimpleHydroSweep) must give the same metrics as the
+# reduction and validation of every tolerance (reduce_bedpoints_RDP followed by execute_SimpleHydro)
+
+import numpy as np
+
+from BasicBenchmark import synthetic_profile
+from BasicBedAssessment import execute_BedAssessment, execute_SimpleHydro, execute_SimpleHydroSweep
+from BasicRiverDataStructure import Databrowser
+from BasicWSSmoothing import execute_WSsmoothing
+
+EPSILONS = [0.01, 0.03, 0.1, 0.3]
+
+
+def test_sweep_matches_reduction_and_validation():
+    data = Databrowser(synthetic_profile(300, noise=0.05, seed=5))
+    execute_WSsmoothing(data)
+    execute_BedAssessment(data, 0.03, 1e-5)
+    down_slope = data.get_first_point().s
+    sweep = execute_SimpleHydroSweep(data, 0.03, down_slope, EPSILONS)
+
+    dist = data.get_column('dist')
+    z_ws = data.get_column('z_ws')
+    measured = ~np.isnan(z_ws)
+    for epsilon, metrics in zip(EPSILONS, sweep.to_dict('records')):
+        reduced = data.reduce_bedpoints_RDP(epsilon)
+        execute_SimpleHydro(reduced, 0.03, down_slope)
+        errors = np.interp(dist[measured], reduced.get_column('dist'), reduced.get_column('ws_validation')) - \
+            z_ws[measured]
+        assert metrics['epsilon'] == epsilon
+        assert metrics['nb_points'] == len(reduced)
+        assert metrics['nb_not_converged'] == np.sum(~reduced.get_column('converged_validation').astype(bool))
+        np.testing.assert_allclose([metrics['bias'], metrics['mae'], metrics['rmse'], metrics['max_error']],
+                                   [np.mean(errors), np.mean(np.abs(errors)), np.sqrt(np.mean(errors ** 2)),
+                                    np.max(np.abs(errors))], rtol=1e-9, atol=1e-12)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Restriction of the Gaussian curves of the water surface smoothing
+
+import numpy as np
+from scipy.stats import norm
+
+import BasicWSSmoothing
+from BasicBenchmark import synthetic_profile
+from BasicRiverDataStructure import Databrowser
+
+
+def admissible(x_values, mu1, sd1, mu2, sd2):
+    # The constraint of _restrict_sd, with the densities as computed by norm.pdf
+    return np.all(norm.pdf(x_values, loc=mu1, scale=sd1) >= norm.pdf(x_values, loc=mu2, scale=sd2))
+
+
+def test_max_admissible_sd_is_admissible_and_tight(monkeypatch):
+    # The restrictions of the smoothing of noisy profiles are recorded, then checked: the closed form sd2 must be
+    # admissible, and less than 0.1% below the largest admissible sd2 (the margins of _max_admissible_sd are smaller)
+    calls = []
+    max_admissible_sd = BasicWSSmoothing._max_admissible_sd
+
+    def recorded(*args):
+        sd2 = max_admissible_sd(*args)
+        calls.append((args, sd2))
+        return sd2
+
+    monkeypatch.setattr(BasicWSSmoothing, "_max_admissible_sd", recorded)
+    for npts in (200, 800):
+        BasicWSSmoothing.execute_WSsmoothing(Databrowser(synthetic_profile(npts, noise=0.1, seed=1)))
+
+    solved = [(args, sd2) for args, sd2 in calls if sd2 is not None]
+    assert len(solved) > 100
+    for (x_values, mu1, sd1, mu2, sd2_max), sd2 in solved:
+        assert sd2 <= sd2_max
+        assert admissible(x_values, mu1, sd1, mu2, sd2)
+        larger = sd2 * (1 + 1e-3)
+        assert larger > sd2_max or not admissible(x_values, mu1, sd1, mu2, larger)